@@ -10,6 +10,7 @@ from pkg_resources import get_distribution
 import gevent
 
 from puppyserv.app import Config, VideoStreamApp
+from puppyserv.greenlet import HubMonitor
 from puppyserv.settings import ReloadableSettings
 
 log = logging.getLogger(__name__)
@@ -24,6 +25,9 @@ def main(global_config, **local_config):
     config = Config(settings)
 
     gevent.spawn(_watch_config, config, settings)
+    if settings.get('hub_monitor.threshold'):
+        HubMonitor.from_settings(
+            settings, stream_stat_manager=config.stream_stat_manager)
 
     log.info("App starting!")
     return VideoStreamApp(config)
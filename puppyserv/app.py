@@ -3,22 +3,41 @@
 """
 from __future__ import absolute_import, division
 
+from array import array
+from collections import deque
 from functools import wraps
+import json
 import logging
+import math
 from pkg_resources import resource_filename
+import time
 
 import gevent
 from gevent.lock import Semaphore
 
 from webob import Response
 from webob.dec import wsgify
-from webob.exc import HTTPGatewayTimeout, HTTPMethodNotAllowed, HTTPNotFound
+from webob.exc import (
+    HTTPBadRequest,
+    HTTPForbidden,
+    HTTPGatewayTimeout,
+    HTTPInternalServerError,
+    HTTPMethodNotAllowed,
+    HTTPNotFound,
+    )
 
 from puppyserv import webcam
-from puppyserv.greenlet import Condition
+from puppyserv.avi import avi_size, jpeg_dimensions, mjpeg_avi
+from puppyserv.greenlet import (
+    Condition,
+    call_in_threadpool,
+    iterate_in_threadpool,
+    )
+from puppyserv.interfaces import VideoFrame
+from puppyserv.recorder import Clip, Recording, recording_directory
 from puppyserv.stats import StreamStatManager
 from puppyserv.stream import StaticFrame, StaticVideoStreamBuffer
-from puppyserv.util import BucketRateLimiter
+from puppyserv.util import BucketRateLimiter, asbool, parse_iso8601
 
 log = logging.getLogger(__name__)
 
@@ -26,44 +45,108 @@ EOL = b'\r\n'
 
 def _GET_only(view_method, allow=('GET', 'HEAD')):
     @wraps(view_method)
-    def wrapper(self, request):
+    def wrapper(self, request, *args):
         if request.method not in allow:
             return HTTPMethodNotAllowed(allow=allow)
-        response = view_method(self, request)
+        response = view_method(self, request, *args)
         if request.method == 'HEAD':
             response.body = b''
         return response
     return wrapper
 
+def _stats_only(view_method):
+    """ Restrict a view to the ``stats_allowed_addresses``.
+
+    If none are configured, the view is disabled.
+
+    """
+    @wraps(view_method)
+    def wrapper(self, request, *args):
+        allowed = self.config.stats_allowed_addresses
+        if not allowed:
+            return HTTPNotFound()
+        # (Not client_addr, which trusts X-Forwarded-For)
+        if request.remote_addr not in allowed:
+            return HTTPForbidden()
+        return view_method(self, request, *args)
+    return wrapper
+
 
 class VideoStreamApp(object):
     boundary = b'puppyserv-92af5f768c28fad8'
 
+    sleep = staticmethod(gevent.sleep)
+
+    # Map path (relative to the camera) to view method name
+    routes = {
+        '/': 'stream',
+        '/snapshot': 'snapshot',
+        '/clip': 'clip',
+        '/metrics': 'metrics',
+        '/status': 'status',
+        '/history': 'history',
+        }
+
+    camera_prefix = '/cam/'
+
     def __init__(self, config):
         self.config = config
         self.buffer_manager = BufferManager(config)
+        self.camera_buffer_managers = {}
 
     @wsgify
     def __call__(self, request):
-        if request.path_info == '/':
-            return self.stream(request)
-        elif request.path_info == '/snapshot':
-            return self.snapshot(request)
-        return HTTPNotFound()
+        path_info = request.path_info
+        camera = None
+        if path_info.startswith(self.camera_prefix):
+            camera, sep, rest = path_info[len(self.camera_prefix):] \
+                                .partition('/')
+            if not sep:
+                return HTTPNotFound()
+            path_info = '/' + rest
+        view_name = self.routes.get(path_info)
+        if view_name is None:
+            return HTTPNotFound()
+        buffer_manager = self._get_buffer_manager(camera)
+        if buffer_manager is None:
+            return HTTPNotFound()
+        return getattr(self, view_name)(request, buffer_manager)
+
+    def _get_buffer_manager(self, camera):
+        """ Get the buffer manager for the named camera.
+
+        Buffer managers for named cameras are created as they are
+        first needed.  Returns ``None`` if the camera is not configured.
+
+        """
+        if camera is None:
+            return self.buffer_manager
+        if camera not in self.config.cameras:
+            return None
+        buffer_manager = self.camera_buffer_managers.get(camera)
+        if buffer_manager is None:
+            buffer_manager = BufferManager(self.config, camera)
+            self.camera_buffer_managers[camera] = buffer_manager
+        return buffer_manager
 
     @_GET_only
-    def stream(self, request):
+    def stream(self, request, buffer_manager):
+        if 't' in request.GET or 'from' in request.GET:
+            return self._replay(request, buffer_manager)
         return Response(
             content_type='multipart/x-mixed-replace',
             content_type_params={'boundary': self.boundary},
             cache_control='no-cache',
-            app_iter = self._app_iter(request))
+            app_iter = self._app_iter(request, buffer_manager))
 
     @_GET_only
-    def snapshot(self, request):
-        with self.buffer_manager as stream:
+    def snapshot(self, request, buffer_manager):
+        with buffer_manager as stream:
             try:
                 frame = next(stream)
+                if isinstance(frame, RetainedFrame):
+                    # A snapshot should be current: wait for a new frame
+                    frame = next(stream)
             except StopIteration:
                 # XXX: maybe different error?
                 return HTTPGatewayTimeout('Not connected to webcam')
@@ -72,39 +155,311 @@ class VideoStreamApp(object):
         return Response(
             cache_control='no-cache',
             content_type=frame.content_type,
-            body=frame.image_data)
+            body=frame.image_data,
+            etag=frame.digest,
+            conditional_response=True)
 
+    @_GET_only
+    @_stats_only
+    def metrics(self, request, buffer_manager):
+        """ Stream statistics, for Prometheus.
+
+        These cover all cameras, whichever camera prefix is used.
+
+        """
+        return Response(
+            cache_control='no-cache',
+            content_type='text/plain',
+            content_type_params={'version': '0.0.4', 'charset': 'utf-8'},
+            body=self.config.stream_stat_manager.metrics().encode('utf-8'))
+
+    @_GET_only
+    @_stats_only
+    def status(self, request, buffer_manager):
+        """ The current state of all client and ingest streams, as JSON.
+
+        Like the metrics, this covers all cameras.
+
+        """
+        return Response(
+            cache_control='no-cache',
+            content_type='application/json',
+            body=json.dumps(self.config.stream_stat_manager.status(),
+                            sort_keys=True))
 
-    def _app_iter(self, request):
+    @_GET_only
+    @_stats_only
+    def history(self, request, buffer_manager):
+        """ Recent activity (for all cameras), as JSON time series.
+
+        ``Resolution`` is ``second`` or ``minute`` (the default.)  The
+        start of the series may be limited by passing either ``t``
+        (seconds relative to now) or ``from`` (an ISO 8601
+        date/time.)
+
+        """
+        series = self.config.stream_stat_manager.series
+        params = request.GET
+        resolution = params.get('resolution', 'minute')
+        if resolution not in series:
+            return HTTPBadRequest("Unknown resolution %r" % resolution)
+        try:
+            if 'from' in params:
+                since = parse_iso8601(params['from'])
+            elif 't' in params:
+                t = float(params['t'])
+                if math.isnan(t) or math.isinf(t):
+                    raise ValueError("t must be finite")
+                since = time.time() + t
+            else:
+                since = None
+        except ValueError as ex:
+            return HTTPBadRequest(str(ex))
+        return Response(
+            cache_control='no-cache',
+            content_type='application/json',
+            body=json.dumps(series[resolution].query(since), sort_keys=True))
+
+    @_GET_only
+    def clip(self, request, buffer_manager):
+        """ Download recorded frames.
+
+        The ``from`` and ``to`` query parameters give the time range
+        as ISO 8601 date/times.  (``to`` defaults to now.)  If
+        ``format`` is ``avi`` (the default) the clip is served as an
+        MJPEG AVI file, otherwise as a multipart file like that
+        served by the stream view.
+
+        """
+        directory = buffer_manager.recording_directory
+        if directory is None:
+            return HTTPNotFound('Recording is not enabled')
+        params = request.GET
+        try:
+            if 'from' not in params:
+                raise ValueError("No start time given")
+            start = parse_iso8601(params['from'])
+            if 'to' in params:
+                end = parse_iso8601(params['to'])
+            else:
+                end = time.time()
+            if end <= start:
+                raise ValueError("Clip ends before it starts")
+            format_ = params.get('format', 'avi')
+            if format_ not in ('avi', 'multipart'):
+                raise ValueError("Unknown format %r" % format_)
+        except ValueError as ex:
+            return HTTPBadRequest(str(ex))
+
+        clip = call_in_threadpool(Clip, directory, start, end)
+        if len(clip) == 0:
+            return HTTPNotFound('No frames were recorded in that time range')
+        self.config.stream_stat_manager.count('clips',
+                                              camera=buffer_manager.camera)
+        filename = 'clip-%s' % time.strftime('%Y%m%dT%H%M%S',
+                                             time.localtime(start))
+        if format_ == 'multipart':
+            response = Response(
+                content_type='multipart/x-mixed-replace',
+                content_type_params={'boundary': self.boundary},
+                app_iter=self._clip_multipart_iter(clip))
+            filename += '.mjpeg'
+        else:
+            response = self._clip_avi(clip)
+            filename += '.avi'
+        response.content_disposition = 'attachment; filename=%s' % filename
+        return response
+
+    def _clip_avi(self, clip):
+        info = call_in_threadpool(_avi_info, clip)
+        if info is None:
+            return HTTPNotFound('No JPEG frames were recorded '
+                                'in that time range')
+        sizes, frame_rate, dimensions = info
+        if dimensions is None:
+            return HTTPInternalServerError('Can not parse recorded JPEG')
+        width, height = dimensions
+        frames = iterate_in_threadpool(clip.frames())
+        jpegs = (frame.image_data for frame in frames
+                 if _is_jpeg(frame.content_type))
+        return Response(
+            content_type='video/x-msvideo',
+            content_length=avi_size(sizes),
+            app_iter=self._closing(
+                frames, mjpeg_avi(jpegs, sizes, width, height, frame_rate)))
+
+    def _clip_multipart_iter(self, clip):
+        frames = iterate_in_threadpool(clip.frames())
+        try:
+            for frame in frames:
+                yield self._serialize_part(frame)
+            yield b'--' + self.boundary + b'--' + EOL
+        finally:
+            frames.close()
+
+    @staticmethod
+    def _closing(frames, chunks):
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            frames.close()
+
+    def _app_iter(self, request, buffer_manager):
         config = self.config
-        buffer_manager = self.buffer_manager
         frame = None
 
-        def max_rate():
-            return config.max_total_framerate / buffer_manager.n_clients
-
         stream_name = "> %s" % request.client_addr
         with buffer_manager as stream:
-            limiter = BucketRateLimiter(max_rate=max_rate(), bucket_size=10)
+            limiter = BucketRateLimiter(
+                max_rate=buffer_manager.client_max_rate, bucket_size=10)
             stream = limiter(stream)
-            with config.stream_stat_manager(stream, stream_name) as frames:
-                for frame in frames:
+            with config.stream_stat_manager(stream, stream_name,
+                                            camera=buffer_manager.camera,
+                                            client=request.client_addr,
+                                            limiter=limiter) \
+                     as monitored:
+                record = monitored.record
+                for frame in stream:
+                    record(frame)
                     if frame is None:
                         frame = config.timeout_image
-                    limiter.max_rate = max_rate()
-                    yield self._part_for_frame(frame)
+                    limiter.max_rate = buffer_manager.client_max_rate
+                    yield self._part_for_frame(frame,
+                                               buffer_manager.part_cache)
 
             yield b'--' + self.boundary + b'--' + EOL
 
-    def _part_for_frame(self, frame):
+    def _replay(self, request, buffer_manager):
+        """ Stream recorded frames.
+
+        The ``t`` query parameter gives the start time in seconds
+        relative to now (it should be negative); alternatively
+        ``from`` gives it as an ISO 8601 date/time.  Frames are served
+        with their original timing (subject to the client rate
+        limit.)  Replay does not touch the live stream buffer.
+
+        """
+        directory = buffer_manager.recording_directory
+        if directory is None:
+            return HTTPNotFound('Recording is not enabled')
+        try:
+            if 'from' in request.GET:
+                start = parse_iso8601(request.GET['from'])
+            else:
+                t = float(request.GET['t'])
+                if math.isnan(t) or math.isinf(t):
+                    raise ValueError("t must be finite")
+                if t > 0:
+                    raise ValueError("Can not replay the future")
+                start = time.time() + t
+        except ValueError as ex:
+            return HTTPBadRequest(str(ex))
+        return Response(
+            content_type='multipart/x-mixed-replace',
+            content_type_params={'boundary': self.boundary},
+            cache_control='no-cache',
+            app_iter=self._replay_iter(request, buffer_manager,
+                                       Recording(directory), start))
+
+    def _replay_iter(self, request, buffer_manager, recording, start):
+        config = self.config
+        stream_name = "> %s [replay]" % request.client_addr
+        limiter = BucketRateLimiter(
+            max_rate=buffer_manager.client_max_rate, bucket_size=10)
+        offset = None
+        frames = recording.frames(start)
+        with config.stream_stat_manager(frames, stream_name,
+                                        camera=buffer_manager.camera,
+                                        role='replay',
+                                        client=request.client_addr,
+                                        limiter=limiter) \
+                 as monitored:
+            record = monitored.record
+            for frame in frames:
+                record(frame)
+                # Pace frames according to their timestamps
+                now = time.time()
+                if offset is None:
+                    offset = now - frame.timestamp
+                delay = frame.timestamp + offset - now
+                if delay > 0:
+                    self.sleep(delay)
+                limiter.max_rate = buffer_manager.client_max_rate
+                if limiter.tokens < 1:
+                    # Recorded faster than the client may receive
+                    continue
+                next(limiter)
+                yield self._serialize_part(frame)
+
+        yield b'--' + self.boundary + b'--' + EOL
+
+    def _part_for_frame(self, frame, part_cache=None):
+        # Each frame is generally sent to many clients: serialize it once
+        if part_cache is None or isinstance(frame, RetainedFrame):
+            return self._serialize_part(frame)
+        part = part_cache.get(frame)
+        if part is None:
+            part = self._serialize_part(frame)
+            part_cache.add(frame, part)
+        return part
+
+    def _serialize_part(self, frame):
         data = frame.image_data
-        return b''.join([
-            b'--', self.boundary, EOL,
-            b'Content-Type: ', frame.content_type, EOL,
-            b'Content-length: ', str(len(data)), EOL,
-            EOL,
-            data, EOL,
-            ])
+        if frame.part_headers is not None:
+            # Relay the upstream headers unchanged
+            headers = [frame.part_headers]
+        else:
+            headers = [
+                b'Content-Type: ', frame.content_type, EOL,
+                b'Content-length: ', str(len(data)), EOL,
+                ]
+        if self.config.mark_stale_frames and isinstance(frame, RetainedFrame):
+            headers.extend([b'X-Frame-Age: ', b'%.1f' % frame.age, EOL])
+        return b''.join([b'--', self.boundary, EOL]
+                        + headers
+                        + [EOL, data, EOL])
+
+def _is_jpeg(content_type):
+    # Only JPEG frames may be included in an MJPEG file
+    return content_type == 'image/jpeg'
+
+def _avi_info(clip):
+    """ Gather what is needed to write ``clip`` as an MJPEG AVI file.
+
+    Returns the sizes of the clip's JPEG frames, their average frame
+    rate, and the image dimensions (``None`` if they can not be
+    determined.)  Returns ``None`` if there are no JPEG frames.
+
+    This reads the recording, so should be called off the hub.
+
+    """
+    sizes = array('L')
+    first = last = None
+    for timestamp, content_type, length in clip.frame_infos():
+        if _is_jpeg(content_type):
+            sizes.append(length)
+            if first is None:
+                first = timestamp
+            last = timestamp
+    if not sizes:
+        return None
+    # Get the image dimensions from the first frame
+    dimensions = None
+    frames = clip.frames()
+    try:
+        for frame in frames:
+            if _is_jpeg(frame.content_type):
+                dimensions = jpeg_dimensions(frame.image_data)
+                break
+    finally:
+        frames.close()
+    # AVI requires a constant frame rate: use the average
+    if last > first:
+        frame_rate = (len(sizes) - 1) / (last - first)
+    else:
+        frame_rate = 1.0
+    return sizes, frame_rate, dimensions
 
 class Config(object):
     def __init__(self, settings):
@@ -170,6 +525,11 @@ class Config(object):
         ('stop_stream_holdoff', 15.0, 'positive_float'),
         ('timeout_image', DEFAULT_TIMEOUT_IMAGE, 'image'),
         ('buffer_factory', None, 'buffer_factory'),
+        ('cameras', {}, 'cameras'),
+        ('max_retained_frame_age', 3600.0, 'nonnegative_float'),
+        ('mark_stale_frames', False, 'bool'),
+        ('recording_directory', None, 'recording_directory'),
+        ('stats_allowed_addresses', '', 'addresses'),
         )
 
     @staticmethod
@@ -179,22 +539,70 @@ class Config(object):
             raise ValueError("%s is not positive", value)
         return value
 
+    @staticmethod
+    def _coerce_nonnegative_float(value, settings):
+        value = float(value)
+        if value < 0:
+            raise ValueError("%s is negative", value)
+        return value
+
+    @staticmethod
+    def _coerce_bool(value, settings):
+        return asbool(value)
+
+    @staticmethod
+    def _coerce_addresses(value, settings):
+        return frozenset(value.split())
+
+    @staticmethod
+    def _coerce_recording_directory(value, settings):
+        return recording_directory(settings)
+
     @staticmethod
     def _coerce_image(value, settings):
         return StaticFrame(value)
 
     def _coerce_buffer_factory(self, value, settings):
         from puppyserv import SERVER_NAME
-        if settings.get('static.images'):
+        if settings.get('static.images') or settings.get('static.archive'):
             config = dict((k, v) for k, v in settings.items()
                           if k.startswith('static.'))
             return Factory(StaticVideoStreamBuffer.from_settings, config)
-        config = dict((k, v) for k, v in settings.items()
-                      if k.startswith('webcam.'))
+        config, camera_settings = webcam.split_camera_settings(settings)
         return Factory(webcam.stream_buffer_from_settings, config,
                        stream_stat_manager=self.stream_stat_manager,
                        user_agent=SERVER_NAME)
 
+    def _coerce_cameras(self, value, settings):
+        """ Configure the named cameras.
+
+        Returns a dict mapping camera name to a dict containing that
+        camera's ``buffer_factory`` and ``stop_stream_holdoff``.  The
+        latter is ``None`` unless specifically configured for the
+        camera, in which case the global value should be used.
+
+        """
+        from puppyserv import SERVER_NAME
+        default_settings, camera_settings = \
+            webcam.split_camera_settings(settings)
+        cameras = {}
+        for name, config in camera_settings.items():
+            holdoff = config.pop('webcam.stop_stream_holdoff', None)
+            if holdoff is not None:
+                holdoff = self._coerce_positive_float(holdoff, settings)
+            buffer_factory = Factory(
+                webcam.stream_buffer_from_settings, config,
+                camera=name,
+                stream_stat_manager=self.stream_stat_manager,
+                user_agent=SERVER_NAME)
+            cameras[name] = {
+                'buffer_factory': buffer_factory,
+                'stop_stream_holdoff': holdoff,
+                'recording_directory': recording_directory(config,
+                                                           camera=name),
+                }
+        return cameras
+
 class Factory(object):
     """ This is like functools.partial, except it has equality comparison.
     """
@@ -212,23 +620,150 @@ class Factory(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+class RetainedFrame(VideoFrame):
+    """ A frame retained from a previous buffer.
+
+    This is served to clients while a new buffer is starting up.
+    ``Age`` is the number of seconds since the frame was captured.
+
+    """
+    __slots__ = ('age',)
+
+    def __init__(self, frame, age):
+        super(RetainedFrame, self).__init__(
+            frame.image_data, frame.content_type,
+            timestamp=frame.timestamp, source=frame.source, seq=frame.seq)
+        self.age = age
+
 _successful_greenlet = gevent.spawn(lambda : None)
 _successful_greenlet.join()
 
+class PartCache(object):
+    """ The serialized multipart parts of the ``size`` most recently
+    added frames.
+    """
+    def __init__(self, size=32):
+        self.size = size
+        # Keyed by id(frame).  The frame is kept in the value so that
+        # its id can not be reused.
+        self._parts = {}
+        self._order = deque()
+
+    def __len__(self):
+        return len(self._parts)
+
+    def get(self, frame):
+        cached = self._parts.get(id(frame))
+        if cached is not None and cached[0] is frame:
+            return cached[1]
+        return None
+
+    def add(self, frame, part):
+        key = id(frame)
+        if key not in self._parts:
+            self._order.append(key)
+        self._parts[key] = frame, part
+        while len(self._order) > self.size:
+            del self._parts[self._order.popleft()]
+
+class _DeliveryCounter(object):
+    """ Counts the frames taken by one client.
+    """
+    __slots__ = ('n_frames',)
+
+    def __init__(self):
+        self.n_frames = 0
+
 class BufferManager(object):
-    def __init__(self, config):
+    time = staticmethod(time.time)
+
+    #: How often (in seconds) the rates at which our clients take
+    #: frames are measured
+    demand_interval = 5.0
+    #: The demand is set this factor above the fastest client's rate,
+    #: so that it rises again while the clients keep up
+    demand_headroom = 1.5
+    #: The demand is never set lower than this
+    min_demand = 0.5
+
+    def __init__(self, config, camera=None):
+        self.camera = camera
         with config:
-            self.buffer_factory = config.buffer_factory
-            self.stop_stream_holdoff = config.stop_stream_holdoff
+            self.buffer_factory, self.stop_stream_holdoff = \
+                self._configuration(config)
+            self.max_retained_frame_age = config.max_retained_frame_age
+            self.max_total_framerate = config.max_total_framerate
+            self.recording_directory = self._recording_directory(config)
             config.listen(self._config_changed)
         self._n_clients = 0
         self._buffer = None
+        self._buffer_is_fresh = False
+        self._last_frame = None
         self._stopper = _successful_greenlet
+        # Each camera's frames are cached separately, so that a busy
+        # camera can not evict another's
+        self.part_cache = PartCache()
+        self._counters = set()
+        self._measured_since = None
+        self._measured_rate = None
 
     @property
     def n_clients(self):
         return self._n_clients
 
+    @property
+    def client_max_rate(self):
+        """ The maximum frame rate for each client.
+
+        The total frame rate is shared equally between clients.
+
+        """
+        return self.max_total_framerate / max(1, self._n_clients)
+
+    def _update_demand(self):
+        """ Let the buffer know how fast our clients can consume frames.
+
+        This is the rate at which the fastest client has been taking
+        frames (plus some headroom), but no more than the maximum
+        rate for each client.
+
+        """
+        if self._buffer is not None and self._n_clients > 0:
+            demand = self.client_max_rate
+            if self._measured_rate is not None:
+                demand = min(demand, max(
+                    self.min_demand,
+                    self.demand_headroom * self._measured_rate))
+            self._buffer.demand = demand
+
+    def _reset_demand(self):
+        """ Forget the measured rates, e.g. when a new client arrives.
+
+        Until the next measurement, the demand is the maximum rate
+        for each client.
+
+        """
+        for counter in self._counters:
+            counter.n_frames = 0
+        self._measured_since = self.time()
+        self._measured_rate = None
+
+    def _measure_demand(self):
+        """ Measure the client rates, every ``demand_interval`` seconds.
+        """
+        now = self.time()
+        elapsed = now - self._measured_since
+        if elapsed < self.demand_interval:
+            return
+        counters = self._counters
+        if counters:
+            self._measured_rate = max(
+                counter.n_frames for counter in counters) / elapsed
+            for counter in counters:
+                counter.n_frames = 0
+        self._measured_since = now
+        self._update_demand()
+
     # XXX: These would need a mutex if they were to be called from more
     # than one thread, but since we're geventing, we don't need it.
     def __enter__(self):
@@ -239,22 +774,54 @@ class BufferManager(object):
                 assert not self._stopper.ready()
                 self._stopper.kill(block=False)
         self._n_clients += 1
+        self._reset_demand()
+        self._update_demand()
         log.debug("BufferManager: nclients = %d", self._n_clients)
 
         return self._stream()
 
     def _stream(self):
         buffer_ = self._buffer
+        retained_frame = self._retained_frame()
+        if retained_frame is not None:
+            yield retained_frame
         stream = buffer_.stream()
-        while True:
-            try:
-                yield next(stream)
-            except StopIteration:
-                if buffer_ is not self._buffer:
-                    buffer_ = self._buffer
-                    stream = buffer_.stream()
-                else:
-                    break
+        counter = _DeliveryCounter()
+        self._counters.add(counter)
+        try:
+            while True:
+                try:
+                    frame = next(stream)
+                except StopIteration:
+                    if buffer_ is not self._buffer:
+                        buffer_ = self._buffer
+                        stream = buffer_.stream()
+                        continue
+                    else:
+                        break
+                if frame is not None:
+                    if frame is not self._last_frame:
+                        self._last_frame = frame
+                        self._buffer_is_fresh = False
+                    counter.n_frames += 1
+                    self._measure_demand()
+                yield frame
+        finally:
+            self._counters.discard(counter)
+
+    def _retained_frame(self):
+        """ Get the last frame from the previous buffer, if appropriate.
+
+        This is only returned if our current buffer has yet to produce
+        any frames.
+
+        """
+        if not self._buffer_is_fresh or self._last_frame is None:
+            return None
+        age = max(0, self.time() - self._last_frame.timestamp)
+        if age > self.max_retained_frame_age:
+            return None
+        return RetainedFrame(self._last_frame, age)
 
     def __exit__(self, exc_type, exc_value, exc_tb):
         assert self._n_clients > 0
@@ -262,16 +829,44 @@ class BufferManager(object):
         if self._n_clients == 0:
             assert self._buffer is not None
             self._stop_stream(self.stop_stream_holdoff)
+        else:
+            self._update_demand()
         log.debug("BufferManager: nclients = %d", self._n_clients)
 
+    def _configuration(self, config):
+        """ Get our buffer factory and stop stream holdoff from config.
+        """
+        if self.camera is None:
+            return config.buffer_factory, config.stop_stream_holdoff
+        camera_config = config.cameras[self.camera]
+        stop_stream_holdoff = camera_config['stop_stream_holdoff']
+        if stop_stream_holdoff is None:
+            stop_stream_holdoff = config.stop_stream_holdoff
+        return camera_config['buffer_factory'], stop_stream_holdoff
+
+    def _recording_directory(self, config):
+        if self.camera is None:
+            return config.recording_directory
+        return config.cameras[self.camera]['recording_directory']
+
     def _config_changed(self, config):
-        self.stop_stream_holdoff = config.stop_stream_holdoff
-        if self.buffer_factory != config.buffer_factory:
-            self._change_buffer_factory(config.buffer_factory)
+        if self.camera is not None and self.camera not in config.cameras:
+            # Camera has been unconfigured.  The app will no longer
+            # route new clients to us.
+            return
+        buffer_factory, self.stop_stream_holdoff = self._configuration(config)
+        self.max_retained_frame_age = config.max_retained_frame_age
+        self.max_total_framerate = config.max_total_framerate
+        self.recording_directory = self._recording_directory(config)
+        if self.buffer_factory != buffer_factory:
+            self._change_buffer_factory(buffer_factory)
+        self._update_demand()
 
     def _change_buffer_factory(self, buffer_factory):
         log.info("Stream configuration changed.")
         self.buffer_factory = buffer_factory
+        # The last frame may well be from a different camera
+        self._last_frame = None
         if self._buffer is not None:
             self._stop_stream(0)
             if self._n_clients > 0:
@@ -279,6 +874,8 @@ class BufferManager(object):
 
     def _start_stream(self):
         self._buffer = self.buffer_factory()
+        self._buffer_is_fresh = True
+        self._update_demand()
         log.info("Started stream capture %r", self._buffer)
 
     def _stop_stream(self, holdoff):
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+""" Packed frame archives.
+
+An archive is a single file holding a sequence of frames, with their
+timestamps, for use by the static video stream.
+
+The file starts with `MAGIC`.  Then follow the frames, each stored as
+a record in the same format as used by `puppyserv.recorder` (a
+`RECORD_HEADER`, the content type, then the image data.)  After the
+frames comes the index: an `INDEX_ENTRY` (timestamp, offset of
+record) for each frame.  The file ends with a `TRAILER` giving the
+offset of the index, the number of frames, and `MAGIC` again.
+
+"""
+from __future__ import absolute_import, division, print_function
+
+import mimetypes
+import mmap
+from optparse import OptionParser
+import os
+import struct
+import sys
+
+from puppyserv.interfaces import VideoFrame
+from puppyserv.recorder import INDEX_ENTRY, RECORD_HEADER, RecordedFrame
+
+MAGIC = b'PUPARCH1'
+TRAILER = struct.Struct('<QQ8s')
+
+class FrameArchive(object):
+    """ A memory-mapped frame archive.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size < len(MAGIC) + TRAILER.size:
+                raise ValueError("%s: not a frame archive" % filename)
+            self.map = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+        index_offset, n_frames, magic = TRAILER.unpack_from(
+            self.map, size - TRAILER.size)
+        if (self.map[:len(MAGIC)] != MAGIC or magic != MAGIC
+            or index_offset + n_frames * INDEX_ENTRY.size
+               != size - TRAILER.size):
+            self.close()
+            raise ValueError("%s: not a frame archive" % filename)
+        self.timestamps = []
+        self.offsets = []
+        for n in range(n_frames):
+            timestamp, offset = INDEX_ENTRY.unpack_from(
+                self.map, index_offset + n * INDEX_ENTRY.size)
+            self.timestamps.append(timestamp)
+            self.offsets.append(offset)
+
+    def __repr__(self):
+        return u"<%s %s>" % (self.__class__.__name__, self.filename)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        self.map.close()
+
+    def frame(self, i):
+        """ Get the `RecordedFrame` at position ``i``.
+        """
+        offset = self.offsets[i]
+        timestamp, length, ctype_length = RECORD_HEADER.unpack_from(
+            self.map, offset)
+        start = offset + RECORD_HEADER.size + ctype_length
+        content_type = self.map[start - ctype_length:start]
+        return RecordedFrame(self.map[start:start + length], content_type,
+                             timestamp)
+
+class ArchiveWriter(object):
+    """ Write a frame archive to the file ``fp``.
+
+    Frames must be written in timestamp order.
+
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.index = []
+        self.offset = len(MAGIC)
+        fp.write(MAGIC)
+
+    def write(self, timestamp, frame):
+        content_type = frame.content_type
+        data = frame.image_data
+        header = RECORD_HEADER.pack(timestamp, len(data), len(content_type))
+        self.fp.write(header + content_type)
+        self.fp.write(data)
+        self.index.append(INDEX_ENTRY.pack(timestamp, self.offset))
+        self.offset += len(header) + len(content_type) + len(data)
+
+    def close(self):
+        self.fp.write(b''.join(self.index))
+        self.fp.write(TRAILER.pack(self.offset, len(self.index), MAGIC))
+        self.fp.close()
+
+def _image_files(paths):
+    """ Expand directories in ``paths`` to the image files they contain.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                filename = os.path.join(path, name)
+                content_type, encoding = mimetypes.guess_type(filename)
+                if (content_type or '').startswith('image/') \
+                       and os.path.isfile(filename):
+                    yield filename
+        else:
+            yield path
+
+def main(argv=None):
+    """ Build a frame archive from image files.
+    """
+    parser = OptionParser(
+        usage="%prog [options] OUTPUT IMAGE...",
+        description=main.__doc__.strip()
+        + "  IMAGEs may be image files, or directories containing them.")
+    parser.add_option(
+        '-r', '--frame-rate', type='float',
+        help="Play images at this rate (frames per second). "
+        "By default the images' modification times are used.")
+    options, args = parser.parse_args(argv)
+    if len(args) < 2:
+        parser.error("An output file and at least one image are required")
+    output, images = args[0], args[1:]
+
+    frames = []
+    for filename in _image_files(images):
+        content_type, encoding = mimetypes.guess_type(filename)
+        if not content_type:
+            parser.error("%s: can not guess content type" % filename)
+        frames.append((os.path.getmtime(filename), filename, content_type))
+    if options.frame_rate is not None:
+        frames = [(n / options.frame_rate, filename, content_type)
+                  for n, (mtime, filename, content_type)
+                  in enumerate(frames)]
+    else:
+        frames.sort()
+
+    with open(output, 'wb') as outfp:
+        try:
+            writer = ArchiveWriter(outfp)
+            for timestamp, filename, content_type in frames:
+                with open(filename, 'rb') as fp:
+                    frame = VideoFrame(fp.read(), content_type)
+                writer.write(timestamp, frame)
+            writer.close()
+        except:
+            # Do not leave a truncated archive behind
+            outfp.close()
+            os.unlink(output)
+            raise
+    print("Wrote %d frames to %s" % (len(frames), output))
+
+if __name__ == '__main__':
+    sys.exit(main())
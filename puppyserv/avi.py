@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+""" Writing of MJPEG AVI files.
+
+The file is generated as a stream of byte strings.  The lengths of
+the frames must be known in advance (they are needed for the headers
+at the start of the file), but the frame data is only read as it is
+written, so memory use does not depend on the length of the clip.
+
+"""
+from __future__ import absolute_import, division
+
+import struct
+
+from six.moves import zip
+
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+
+MAIN_HEADER = struct.Struct('<10I16x')          # avih
+STREAM_HEADER = struct.Struct('<4s4sIHH8I4H')   # strh
+BITMAP_INFO = struct.Struct('<IiiHH4sIiiII')    # strf
+CHUNK_HEADER = struct.Struct('<4sI')
+INDEX_ENTRY = struct.Struct('<4sIII')
+
+FRAME_CHUNK_ID = b'00dc'
+
+# JPEG start-of-frame markers (other than DHT, JPG and DAC)
+_SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - set([0xc4, 0xc8, 0xcc])
+# Markers which are not followed by a segment length
+_STANDALONE_MARKERS = frozenset(range(0xd0, 0xda)) | set([0x01])
+
+def jpeg_dimensions(data):
+    """ Get the ``(width, height)`` of a JPEG image.
+
+    Returns ``None`` if the dimensions can not be determined.
+
+    """
+    if data[:2] != b'\xff\xd8':
+        return None
+    pos = 2
+    try:
+        while True:
+            ff, marker = struct.unpack_from('BB', data, pos)
+            if ff != 0xff:
+                return None
+            if marker == 0xff:
+                pos += 1                # fill byte
+                continue
+            pos += 2
+            if marker in _STANDALONE_MARKERS:
+                continue
+            if marker in _SOF_MARKERS:
+                height, width = struct.unpack_from('>HH', data, pos + 3)
+                return width, height
+            length, = struct.unpack_from('>H', data, pos)
+            pos += length
+    except struct.error:
+        return None
+
+def _chunk(fourcc, data):
+    return CHUNK_HEADER.pack(fourcc, len(data)) + data
+
+def _list(list_type, data):
+    return CHUNK_HEADER.pack(b'LIST', 4 + len(data)) + list_type + data
+
+def _padded(size):
+    return size + (size & 1)
+
+def mjpeg_avi(frames, sizes, width, height, frame_rate):
+    """ Generate an MJPEG AVI file.
+
+    ``Frames`` is an iterable of JPEG image data; ``sizes`` is a
+    sequence of the lengths of those images.  AVI files have a
+    constant frame rate: the frames are played at ``frame_rate``
+    frames per second.
+
+    Generates the contents of the file as a sequence of byte strings.
+    Use `avi_size` to compute the total length.
+
+    """
+    n_frames = len(sizes)
+    max_size = max(sizes) if sizes else 0
+    usec_per_frame = int(round(1e6 / frame_rate))
+    rate = int(round(frame_rate * 1000))
+
+    avih = MAIN_HEADER.pack(
+        usec_per_frame,
+        int(max_size * frame_rate), # max bytes per second
+        0,                          # padding granularity
+        AVIF_HASINDEX,
+        n_frames,
+        0,                          # initial frames
+        1,                          # streams
+        max_size,                   # suggested buffer size
+        width, height)
+    strh = STREAM_HEADER.pack(
+        b'vids', b'MJPG',
+        0,                          # flags
+        0, 0,                       # priority, language
+        0,                          # initial frames
+        1000, rate,                 # scale, rate
+        0,                          # start
+        n_frames,
+        max_size,                   # suggested buffer size
+        0xffffffff,                 # quality (default)
+        0,                          # sample size
+        0, 0, width, height)        # frame rectangle
+    strf = BITMAP_INFO.pack(
+        BITMAP_INFO.size, width, height,
+        1, 24,                      # planes, bit count
+        b'MJPG',
+        width * height * 3,         # image size
+        0, 0, 0, 0)
+    hdrl = _list(b'hdrl', _chunk(b'avih', avih)
+                 + _list(b'strl', _chunk(b'strh', strh)
+                         + _chunk(b'strf', strf)))
+
+    movi_size = 4 + sum(CHUNK_HEADER.size + _padded(size) for size in sizes)
+    idx1_size = INDEX_ENTRY.size * n_frames
+    riff_size = (4 + len(hdrl) + CHUNK_HEADER.size + movi_size
+                 + CHUNK_HEADER.size + idx1_size)
+
+    yield CHUNK_HEADER.pack(b'RIFF', riff_size) + b'AVI ' + hdrl
+    yield CHUNK_HEADER.pack(b'LIST', movi_size) + b'movi'
+
+    n = 0
+    for data, size in zip(frames, sizes):
+        if len(data) != size:
+            raise ValueError("Frame size changed")
+        yield CHUNK_HEADER.pack(FRAME_CHUNK_ID, size)
+        yield data
+        if size & 1:
+            yield b'\0'
+        n += 1
+    if n != n_frames:
+        raise ValueError("Frame missing")
+
+    yield CHUNK_HEADER.pack(b'idx1', idx1_size)
+    # Offsets are relative to the "movi" list type
+    offset = 4
+    index = []
+    for size in sizes:
+        index.append(INDEX_ENTRY.pack(FRAME_CHUNK_ID, AVIIF_KEYFRAME,
+                                      offset, size))
+        offset += CHUNK_HEADER.size + _padded(size)
+        if len(index) >= 1024:
+            yield b''.join(index)
+            index = []
+    yield b''.join(index)
+
+def avi_size(sizes):
+    """ Compute the length of the file generated by `mjpeg_avi`.
+    """
+    # RIFF header, hdrl list, movi list header, idx1 header
+    overhead = (12
+                + 12 + CHUNK_HEADER.size + MAIN_HEADER.size
+                + 12 + CHUNK_HEADER.size + STREAM_HEADER.size
+                + CHUNK_HEADER.size + BITMAP_INFO.size
+                + 12
+                + CHUNK_HEADER.size)
+    return overhead + sum(CHUNK_HEADER.size + _padded(size)
+                          + INDEX_ENTRY.size
+                          for size in sizes)
@@ -3,13 +3,66 @@
 """
 from __future__ import absolute_import
 
+from collections import deque
+import logging
+import sys
+import time
+import traceback
 from weakref import WeakKeyDictionary
 
 import gevent
+from gevent.event import Event
 from gevent.monkey import get_original
 
+from puppyserv.stats import dummy_stream_stat_manager
+
 current_thread = get_original('threading', 'current_thread')
+get_ident = get_original('thread', 'get_ident')
 RLock = get_original('threading', 'RLock')
+Thread = get_original('threading', 'Thread')
+ThreadEvent = get_original('threading', 'Event')
+thread_sleep = get_original('time', 'sleep')
+
+log = logging.getLogger(__name__)
+
+def call_in_threadpool(func, *args):
+    """ Call ``func(*args)`` in the hub's thread pool, and wait for
+    the result.
+
+    Use this for blocking calls (e.g. file system access) which would
+    otherwise stall every greenlet.  Exceptions raised by ``func`` are
+    re-raised in the caller.
+
+    """
+    def call():
+        # (The gevent thread pool does not propagate exceptions)
+        try:
+            return func(*args), None
+        except:
+            return None, sys.exc_info()
+    result, exc_info = gevent.get_hub().threadpool.apply(call)
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return result
+
+def iterate_in_threadpool(iterable):
+    """ Iterate over ``iterable``, advancing it in the hub's thread pool.
+
+    The iterator is closed (if it can be) when the iteration is done.
+
+    """
+    iterator = iter(iterable)
+    try:
+        while True:
+            try:
+                item = call_in_threadpool(next, iterator)
+            except StopIteration:
+                break
+            yield item
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
 
 class Condition(object):
     """ A gevent-aware version of threading.Condition.
@@ -28,7 +81,7 @@ class Condition(object):
         if lock is None:
             lock = RLock()              # a real threading.Lock
         self.lock = lock
-        self.waiters_by_thread = WeakKeyDictionary()
+        self.broadcasters_by_thread = WeakKeyDictionary()
 
         self.acquire = lock.acquire
         self.release = lock.release
@@ -43,31 +96,200 @@ class Condition(object):
     def wait(self, timeout=None):
         # FIXME: check that we own and have locked the lock?
         try:
-            async, waiters = self.waiters_by_thread[current_thread()]
+            broadcaster = self.broadcasters_by_thread[current_thread()]
         except KeyError:
-            # How we communicate from other threads to the gevent thread
-            async = gevent.get_hub().loop.async()
-            async.start(self._notify_all)
-            waiters = []
-            self.waiters_by_thread[current_thread()] = async, waiters
-
-        waiter = gevent.lock.Semaphore(0)
-        waiters.append(waiter)
+            broadcaster = _Broadcaster()
+            self.broadcasters_by_thread[current_thread()] = broadcaster
+
+        # Grab the current event while we still hold the lock, so that
+        # we can not miss a notification.
+        event = broadcaster.event
         self.release()
         try:
-            if not waiter.wait(timeout):
-                waiters.remove(waiter)
+            event.wait(timeout)
         finally:
             self.acquire()
 
     def notifyAll(self):
         # FIXME: check that we own and have locked the lock?
-        for async, waiters in self.waiters_by_thread.values():
-            async.send()
-
-    def _notify_all(self):
-        with self.lock:
-            async, waiters = self.waiters_by_thread[current_thread()]
-        for waiter in waiters:
-            waiter.release()
-        waiters[:] = []
+        this_thread = current_thread()
+        for thread, broadcaster in self.broadcasters_by_thread.items():
+            if thread is this_thread:
+                # No need to go through the loop's async watcher
+                broadcaster.broadcast()
+            else:
+                broadcaster.send()
+
+class _Broadcaster(object):
+    """ Wakes all of the greenlets in one thread which are waiting on a
+    :class:`Condition`.
+
+    All current waiters share a single event.  A notification swaps in
+    a fresh event, then sets the old one, so that waking any number of
+    greenlets costs a single new object.  Waiters which time out simply
+    stop waiting on the event; there is no list of waiters to maintain.
+
+    This must be constructed in the thread whose greenlets will wait on it.
+
+    """
+    def __init__(self):
+        self.event = Event()
+        # How we communicate from other threads to the gevent thread
+        self.async = gevent.get_hub().loop.async()
+        self.async.start(self.broadcast)
+
+    def send(self):
+        self.async.send()
+
+    def broadcast(self):
+        event, self.event = self.event, Event()
+        event.set()
+
+class HubThread(object):
+    """ A separate OS thread running its own gevent hub.
+
+    Functions may be spawned, as greenlets, in the hub thread from any
+    other thread.  Many greenlets doing cooperative I/O can thus be
+    multiplexed by a single thread.
+
+    """
+    def __init__(self, name=None):
+        self._pending = deque()
+        started = ThreadEvent()
+        self.thread = Thread(target=self._run, args=(started,), name=name)
+        self.thread.daemon = True
+        self.thread.start()
+        started.wait()
+
+    def __repr__(self):
+        return "<{0.__class__.__name__} [{0.thread.name}]>".format(self)
+
+    def _run(self, started):
+        self._async = gevent.get_hub().loop.async()
+        self._async.start(self._spawn_pending)
+        self._stopped = Event()
+        started.set()
+        self._stopped.wait()
+
+    def _spawn_pending(self):
+        pending = self._pending
+        while pending:
+            func, args, done = pending.popleft()
+            gevent.spawn(self._call, func, args, done)
+
+    @staticmethod
+    def _call(func, args, done):
+        try:
+            func(*args)
+        finally:
+            done.set()
+
+    def spawn(self, func, *args):
+        """ Run ``func(*args)`` in a greenlet in the hub thread.
+
+        Returns a (real) ``threading.Event`` which is set once ``func``
+        has returned.
+
+        """
+        done = ThreadEvent()
+        self._pending.append((func, args, done))
+        self._async.send()
+        return done
+
+    def stop(self):
+        self.spawn(self._stopped.set)
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+class HubMonitor(object):
+    """ Watch for the gevent hub being blocked.
+
+    A greenlet wakes every ``interval`` seconds, and measures how late
+    it was in doing so (the loop lag.)  The lags are passed to the
+    stream stat manager.
+
+    A separate OS thread checks that those wake-ups keep happening.
+    If one is more than ``threshold`` seconds overdue, the hub is
+    blocked: the stack of whatever is running in the hub's thread
+    (i.e. the culprit) is logged, and the ``hub_blocks`` counter is
+    incremented.
+
+    This must be constructed in the thread whose hub is to be watched.
+
+    """
+    time = staticmethod(time.time)
+
+    def __init__(self, threshold=0.1, interval=0.1,
+                 stream_stat_manager=dummy_stream_stat_manager):
+        self.threshold = threshold
+        self.interval = interval
+        self.stream_stat_manager = stream_stat_manager
+        self.ident = get_ident()
+        self.last_tick = self.time()
+        self.blocked = False
+        self.closed = False
+        self.ticker = gevent.spawn(self._tick)
+        self.watchdog = Thread(target=self._watch, name='hub monitor')
+        self.watchdog.daemon = True
+        self.watchdog.start()
+
+    def __repr__(self):
+        return "<{0.__class__.__name__} threshold={0.threshold}>".format(self)
+
+    @classmethod
+    def from_settings(cls, settings, prefix='hub_monitor.', **kwargs):
+        """ Create a monitor from settings.
+
+        Returns ``None`` unless a positive ``threshold`` is configured.
+
+        """
+        threshold = float(settings.get(prefix + 'threshold') or 0)
+        if threshold <= 0:
+            return None
+        if prefix + 'interval' in settings:
+            kwargs['interval'] = float(settings[prefix + 'interval'])
+        return cls(threshold, **kwargs)
+
+    def close(self):
+        self.closed = True
+        self.ticker.kill(block=False)
+
+    def _tick(self):
+        while not self.closed:
+            t0 = self.time()
+            gevent.sleep(self.interval)
+            t = self.last_tick = self.time()
+            self.blocked = False
+            lag = max(0, t - t0 - self.interval)
+            self.stream_stat_manager.add_loop_lag(lag)
+            if lag > self.threshold:
+                log.warning("Hub was blocked for %.3fs", lag)
+
+    def check(self):
+        """ Check whether the hub is blocked.
+
+        This is called periodically from the watchdog thread.
+
+        """
+        if self.blocked:
+            return                      # already reported
+        overdue = self.time() - self.last_tick - self.interval
+        if overdue <= self.threshold:
+            return
+        self.blocked = True
+        self.stream_stat_manager.count('hub_blocks')
+        frame = sys._current_frames().get(self.ident)
+        if frame is not None:
+            stack = ''.join(traceback.format_stack(frame))
+        else:
+            stack = '(unknown)\n'
+        log.warning("Hub blocked for %.3fs in:\n%s", overdue, stack)
+
+    def _watch(self):
+        while not self.closed:
+            thread_sleep(self.threshold / 2)
+            try:
+                self.check()
+            except:
+                log.exception('check failed')
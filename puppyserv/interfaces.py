@@ -3,15 +3,57 @@
 """
 from __future__ import absolute_import, division
 
+import hashlib
+from itertools import count
+import time
+
+_frame_seq = count(1)
+
 class VideoFrame(object):
     """ A frame in a video stream.
 
     These currently are always JPEG images.
 
+    ``Part_headers``, if set, are the exact header bytes of the
+    multipart part in which the frame was received.  They are used
+    verbatim when relaying the frame.
+
+    Each frame also carries some metadata: ``seq`` is a sequence
+    number (frames created later have larger sequence numbers),
+    ``timestamp`` is the time the frame was captured (by default, the
+    time it was created), and ``source`` (if known) identifies where
+    the frame came from (e.g. the webcam URL.)  ``Ingest_time`` is
+    set to the time the frame was received by a stream buffer from a
+    live source, and ``ingest_seq`` to its position in that buffer's
+    sequence of frames; both are ``None`` for other frames.
+
     """
-    def __init__(self, image_data, content_type='image/jpeg'):
+    __slots__ = ('image_data', 'content_type', 'part_headers',
+                 'seq', 'timestamp', 'source', 'ingest_time', 'ingest_seq',
+                 '_digest')
+
+    def __init__(self, image_data, content_type='image/jpeg',
+                 part_headers=None, timestamp=None, source=None, seq=None):
         self.image_data = image_data
         self.content_type = content_type
+        self.part_headers = part_headers
+        self.seq = next(_frame_seq) if seq is None else seq
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.source = source
+        self.ingest_time = None
+        self.ingest_seq = None
+        self._digest = None
+
+    @property
+    def digest(self):
+        """ A hex digest of the image data.
+
+        This is computed when first needed.
+
+        """
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.image_data).hexdigest()
+        return self._digest
 
 class VideoStream(object):
     """ A source of video frames.
@@ -19,6 +61,15 @@ class VideoStream(object):
     A VideoStream is a source of VideoFrames.
 
     """
+    #: The highest frame rate at which any consumer is currently
+    #: consuming frames, or ``None`` if unknown.  Streams may use
+    #: this as a hint to reduce their acquisition rate.
+    demand = None
+
+    #: False if the stream is known to be unable to produce frames
+    #: (e.g. its source is down.)
+    healthy = True
+
     def next(self):
         """ Get the next frame in the stream.
 
@@ -41,6 +92,11 @@ class VideoBuffer(object):
     """ A buffered source of video frames.
 
     """
+    #: The highest frame rate at which any client is currently
+    #: consuming frames, or ``None`` if unknown.  Buffers should pass
+    #: this on to their sources.
+    demand = None
+
     def stream(self):
         """ Get an iterator for the buffered stream.
 
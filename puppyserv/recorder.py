@@ -0,0 +1,566 @@
+# -*- coding: utf-8 -*-
+""" Recording of ingested frames to disk.
+
+Frames are appended to segment files.  Each segment consists of a
+data file (``<start>.seg``) holding the frames, and an index file
+(``<start>.idx``) mapping frame timestamps to offsets in the data
+file.  ``<start>`` is the time of the first frame in the segment, in
+milliseconds since the epoch.
+
+Each record in the data file is a `RECORD_HEADER` (timestamp, length
+of image data, length of content type) followed by the content type
+and the image data.  Each entry in the index is an `INDEX_ENTRY`
+(timestamp, offset of record.)
+
+"""
+from __future__ import absolute_import, division
+
+from bisect import bisect_left
+from collections import deque
+import errno
+import glob
+import logging
+import mmap
+import os
+import struct
+import time
+
+import gevent
+
+from puppyserv.greenlet import Thread, ThreadEvent, call_in_threadpool
+from puppyserv.interfaces import VideoFrame
+
+log = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct('<dIH')
+INDEX_ENTRY = struct.Struct('<dQ')
+
+DATA_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+
+class Segment(object):
+    """ A recorded segment.
+    """
+    def __init__(self, directory, start):
+        self.directory = directory
+        self.start = start
+        basename = os.path.join(directory, '%013d' % int(start * 1000))
+        self.data_path = basename + DATA_SUFFIX
+        self.index_path = basename + INDEX_SUFFIX
+
+    def __repr__(self):
+        return u"<%s %s>" % (self.__class__.__name__, self.data_path)
+
+    @property
+    def size(self):
+        """ The total size, in bytes, of the segment's files.
+        """
+        size = 0
+        for path in self.data_path, self.index_path:
+            try:
+                size += os.path.getsize(path)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+        return size
+
+    @property
+    def end(self):
+        """ The timestamp of the last frame in the segment.
+        """
+        index = self.read_index()
+        if index:
+            return index[-1][0]
+        return self.start
+
+    def read_index(self):
+        """ Read the index.
+
+        Returns a list of ``(timestamp, offset)`` pairs.
+
+        """
+        try:
+            with open(self.index_path, 'rb') as fp:
+                data = fp.read()
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return []
+        # Ignore any partially written entry
+        n = len(data) // INDEX_ENTRY.size
+        return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size)
+                for i in range(n)]
+
+    def read_frame(self, fp, offset):
+        """ Read the frame recorded at ``offset`` in the (open) data file.
+        """
+        fp.seek(offset)
+        timestamp, length, ctype_length = RECORD_HEADER.unpack(
+            fp.read(RECORD_HEADER.size))
+        content_type = fp.read(ctype_length)
+        return timestamp, VideoFrame(fp.read(length), content_type)
+
+    def frames(self):
+        """ Iterate over the ``(timestamp, frame)`` pairs in the segment.
+        """
+        with open(self.data_path, 'rb') as fp:
+            for timestamp, offset in self.read_index():
+                yield self.read_frame(fp, offset)
+
+    def remove(self):
+        for path in self.data_path, self.index_path:
+            try:
+                os.unlink(path)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+
+def list_segments(directory):
+    """ List the segments in ``directory``, oldest first.
+    """
+    segments = []
+    for path in glob.glob(os.path.join(directory, '*' + DATA_SUFFIX)):
+        name = os.path.basename(path)[:-len(DATA_SUFFIX)]
+        try:
+            start = int(name) / 1000
+        except ValueError:
+            continue
+        segments.append(Segment(directory, start))
+    segments.sort(key=lambda segment: segment.start)
+    return segments
+
+class RecordedFrame(VideoFrame):
+    """ A frame read from a recording.
+
+    ``Timestamp`` is the time at which the frame was recorded.
+
+    """
+    __slots__ = ()
+
+    def __init__(self, image_data, content_type, timestamp):
+        super(RecordedFrame, self).__init__(image_data, content_type,
+                                            timestamp=timestamp)
+
+class SegmentReader(object):
+    """ Read frames from a segment, which may still be being written.
+
+    The data file is memory-mapped.  Call ``refresh`` to pick up
+    frames which have been recorded since the reader was created.
+
+    """
+    def __init__(self, segment):
+        self.segment = segment
+        self.data_fp = open(segment.data_path, 'rb')
+        self.index_fp = open(segment.index_path, 'rb')
+        self.map = None
+        self.timestamps = []
+        self.offsets = []
+        self._partial = b''
+        self.refresh()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.data_fp.close()
+        self.index_fp.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def refresh(self):
+        """ Read any new index entries.
+        """
+        data = self._partial + self.index_fp.read()
+        n = len(data) // INDEX_ENTRY.size
+        for i in range(n):
+            timestamp, offset = INDEX_ENTRY.unpack_from(
+                data, i * INDEX_ENTRY.size)
+            self.timestamps.append(timestamp)
+            self.offsets.append(offset)
+        self._partial = data[n * INDEX_ENTRY.size:]
+
+    def find(self, timestamp):
+        """ Find the position of the first frame recorded at or after
+        ``timestamp``.
+        """
+        return bisect_left(self.timestamps, timestamp)
+
+    def frame(self, pos):
+        """ Get the frame at position ``pos``.
+        """
+        timestamp, content_type, start, length = self._record(pos)
+        return RecordedFrame(self.map[start:start + length], content_type,
+                             timestamp)
+
+    def frame_info(self, pos):
+        """ Get the timestamp, content type and image data length of
+        the frame at position ``pos``, without reading its data.
+        """
+        timestamp, content_type, start, length = self._record(pos)
+        return timestamp, content_type, length
+
+    def _record(self, pos):
+        offset = self.offsets[pos]
+        if self.map is None or len(self.map) < offset + RECORD_HEADER.size:
+            self._remap()
+        timestamp, length, ctype_length = RECORD_HEADER.unpack_from(
+            self.map, offset)
+        start = offset + RECORD_HEADER.size + ctype_length
+        if len(self.map) < start + length:
+            self._remap()
+        content_type = self.map[start - ctype_length:start]
+        return timestamp, content_type, start, length
+
+    def _remap(self):
+        # The data file has grown.  (The index is written after the
+        # data, so the data for every indexed frame is present.)
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.data_fp.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+
+def _open_reader(segment):
+    """ Open a `SegmentReader`, or return ``None`` if the segment has
+    been deleted (or is not yet fully created.)
+    """
+    try:
+        return SegmentReader(segment)
+    except IOError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+        return None
+
+class Recording(object):
+    """ The recorded frames in ``directory``.
+
+    The directory scans and segment opens (which do blocking file
+    I/O) are done in the hub's thread pool.
+
+    """
+    sleep = staticmethod(gevent.sleep)
+    call_in_threadpool = staticmethod(call_in_threadpool)
+
+    def __init__(self, directory, poll_interval=0.5):
+        self.directory = directory
+        self.poll_interval = poll_interval
+
+    def __repr__(self):
+        return u"<%s %s>" % (self.__class__.__name__, self.directory)
+
+    def frames(self, start, follow=True):
+        """ Iterate over the frames recorded since ``start``.
+
+        The frames are `RecordedFrame` instances.  If ``follow`` is
+        set, the iteration continues with frames as they are
+        recorded.  Otherwise, it stops once the end of the recording
+        is reached.
+
+        """
+        call = self.call_in_threadpool
+        reader = None
+        while reader is None:
+            segments = self._wait_for_segments(follow)
+            if not segments:
+                return
+            # Start with the last segment which starts before ``start``
+            starts = [segment.start for segment in segments]
+            segment = segments[max(0, bisect_left(starts, start) - 1)]
+            reader = call(_open_reader, segment)
+        try:
+            pos = reader.find(start)
+            while True:
+                while pos < len(reader):
+                    frame = reader.frame(pos)
+                    pos += 1
+                    if frame.timestamp >= start:
+                        yield frame
+                next_segment, next_reader = call(
+                    self._next_reader, segment, reader, pos)
+                if next_reader is not None:
+                    reader.close()
+                    segment, reader = next_segment, next_reader
+                    pos = 0
+                elif pos < len(reader):
+                    continue
+                elif follow:
+                    self.sleep(self.poll_interval)
+                else:
+                    break
+        finally:
+            reader.close()
+
+    def _next_reader(self, segment, reader, pos):
+        """ Refresh ``reader`` (which has been read up to ``pos``) and,
+        if it has no more frames, open the next segment after
+        ``segment``.
+
+        Returns ``(next_segment, next_reader)``, or ``(None, None)`` if
+        there is no next segment (yet.)
+
+        """
+        later = [s for s in list_segments(self.directory)
+                 if s.start > segment.start]
+        # Re-check for frames which were recorded before the
+        # segment was finished.
+        reader.refresh()
+        if pos < len(reader):
+            return None, None
+        for next_segment in later:
+            next_reader = _open_reader(next_segment)
+            if next_reader is not None:
+                return next_segment, next_reader
+        return None, None
+
+    def _wait_for_segments(self, follow):
+        while True:
+            segments = self.call_in_threadpool(list_segments, self.directory)
+            if segments or not follow:
+                return segments
+            self.sleep(self.poll_interval)
+
+class Clip(object):
+    """ The frames recorded in ``directory`` between ``start`` and
+    ``end``.
+
+    The segments are scanned (their indexes read) when the clip is
+    created.  Only one segment at a time is open while the clip is
+    being read.  A segment which expires before it is read is
+    skipped.
+
+    Creating the clip, and reading from it, does blocking file I/O.
+    Do that off the hub (see `puppyserv.greenlet.call_in_threadpool`.)
+
+    """
+    def __init__(self, directory, start, end):
+        self.start = start
+        self.end = end
+        # List of (segment, first position, end position)
+        self.ranges = []
+        segments = list_segments(directory)
+        for segment, next_segment in zip(segments, segments[1:] + [None]):
+            if segment.start >= end:
+                break
+            if next_segment is not None and next_segment.start <= start:
+                continue                # ends before start
+            reader = _open_reader(segment)
+            if reader is None:
+                continue
+            try:
+                lo, hi = reader.find(start), reader.find(end)
+            finally:
+                reader.close()
+            if lo < hi:
+                self.ranges.append((segment, lo, hi))
+
+    def __len__(self):
+        return sum(hi - lo for segment, lo, hi in self.ranges)
+
+    def _read(self, method):
+        for segment, lo, hi in self.ranges:
+            reader = _open_reader(segment)
+            if reader is None:
+                log.warning("%r expired before it was read", segment)
+                continue
+            try:
+                read = getattr(reader, method)
+                for pos in range(lo, hi):
+                    yield read(pos)
+            finally:
+                reader.close()
+
+    def frames(self):
+        """ Iterate over the `RecordedFrame`\s in the clip.
+        """
+        return self._read('frame')
+
+    def frame_infos(self):
+        """ Iterate over ``(timestamp, content_type, length)`` for
+        the frames in the clip.
+        """
+        return self._read('frame_info')
+
+def recording_directory(settings, prefix='webcam.record.', camera=None):
+    """ Get the configured recording directory for ``camera``.
+
+    Returns ``None`` if recording is not configured.
+
+    """
+    directory = settings.get(prefix + 'directory', '').strip()
+    if not directory:
+        return None
+    if camera is not None:
+        directory = os.path.join(directory, camera)
+    return directory
+
+class SegmentWriter(object):
+    """ Appends frames to a segment.
+    """
+    def __init__(self, segment, buffering=64 * 1024):
+        self.segment = segment
+        self.data_fp = open(segment.data_path, 'ab', buffering)
+        self.index_fp = open(segment.index_path, 'ab', buffering)
+        self.offset = self.data_fp.tell()
+        self.n_frames = 0
+
+    def write(self, timestamp, frame):
+        content_type = frame.content_type
+        image_data = frame.image_data
+        self.data_fp.write(RECORD_HEADER.pack(
+            timestamp, len(image_data), len(content_type)))
+        self.data_fp.write(content_type)
+        self.data_fp.write(image_data)
+        self.index_fp.write(INDEX_ENTRY.pack(timestamp, self.offset))
+        self.offset += (RECORD_HEADER.size
+                        + len(content_type) + len(image_data))
+        self.n_frames += 1
+
+    def flush(self):
+        # Flush the data before the index, so that the index never
+        # refers to unwritten data.
+        self.data_fp.flush()
+        self.index_fp.flush()
+
+    def close(self):
+        self.flush()
+        self.data_fp.close()
+        self.index_fp.close()
+
+class FrameRecorder(object):
+    """ Record frames to segment files in ``directory``.
+
+    ``Record`` may be called from any thread or greenlet.  It only
+    queues the frame.  The frames are written by a separate writer
+    thread, so that file I/O never blocks the capture loop or the
+    hub.  If more than ``max_queue`` frames are waiting to be
+    written, new frames are dropped.
+
+    A new segment is started every ``segment_duration`` seconds, or
+    when the current segment reaches ``segment_size`` bytes.
+    Whenever a segment is finished, old segments are deleted so that
+    the recordings take no more than ``max_size`` bytes, and so that
+    no segment ends more than ``max_age`` seconds ago.
+
+    """
+    time = staticmethod(time.time)
+
+    def __init__(self, directory,
+                 segment_duration=60.0,
+                 segment_size=64 * 1024 * 1024,
+                 max_size=None,
+                 max_age=None,
+                 max_queue=100):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segment_duration = segment_duration
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_queue = max_queue
+        self.n_dropped = 0
+
+        self.queue = deque()
+        self.wakeup = ThreadEvent()
+        self.closed = False
+        self.writer = None
+        self.thread = Thread(target=self._run, name='FrameRecorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __repr__(self):
+        return u"<%s %s>" % (self.__class__.__name__, self.directory)
+
+    @classmethod
+    def from_settings(cls, settings, prefix='webcam.record.', camera=None):
+        """ Create a recorder from settings.
+
+        Returns ``None`` if no recording ``directory`` is configured.
+        Recordings for a named ``camera`` are made in a subdirectory
+        of ``directory``.
+
+        """
+        directory = recording_directory(settings, prefix, camera)
+        if directory is None:
+            return None
+        kwargs = {}
+        for key, coerce in [('segment_duration', float),
+                            ('segment_size', int),
+                            ('max_size', int),
+                            ('max_age', float)]:
+            if prefix + key in settings:
+                kwargs[key] = coerce(settings[prefix + key])
+        return cls(directory, **kwargs)
+
+    def record(self, frame):
+        if self.closed:
+            return
+        if len(self.queue) >= self.max_queue:
+            self.n_dropped += 1
+            return
+        self.queue.append((self.time(), frame))
+        self.wakeup.set()
+
+    def close(self):
+        """ Stop recording.
+
+        Frames which have already been queued are written.
+
+        """
+        self.closed = True
+        self.wakeup.set()
+
+    def _run(self):
+        queue = self.queue
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            try:
+                while queue:
+                    self._write(*queue.popleft())
+                if self.writer:
+                    self.writer.flush()
+            except Exception:
+                log.exception("%r: recording failed", self)
+            if self.closed and not queue:
+                break
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        if self.n_dropped:
+            log.warning("%r: dropped %d frames", self, self.n_dropped)
+
+    def _write(self, timestamp, frame):
+        writer = self.writer
+        if writer is not None:
+            segment = writer.segment
+            if (timestamp - segment.start >= self.segment_duration
+                or writer.offset >= self.segment_size):
+                writer.close()
+                writer = self.writer = None
+                self.expire()
+        if writer is None:
+            segment = Segment(self.directory, timestamp)
+            writer = self.writer = SegmentWriter(segment)
+        writer.write(timestamp, frame)
+
+    def expire(self):
+        """ Delete old segments.
+        """
+        segments = list_segments(self.directory)
+        total = sum(segment.size for segment in segments)
+        if self.writer is not None:
+            # Never delete the current segment
+            segments = [segment for segment in segments
+                        if segment.data_path != self.writer.segment.data_path]
+        if self.max_age is not None:
+            cutoff = self.time() - self.max_age
+            while segments and segments[0].end < cutoff:
+                segment = segments.pop(0)
+                total -= segment.size
+                segment.remove()
+        if self.max_size is not None:
+            while segments and total > self.max_size:
+                segment = segments.pop(0)
+                total -= segment.size
+                segment.remove()
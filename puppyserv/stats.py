@@ -3,9 +3,12 @@
 """
 from __future__ import absolute_import, division
 
+from array import array
+from bisect import bisect_left
 from contextlib import contextmanager
+import heapq
 import logging
-from operator import attrgetter
+from operator import attrgetter, itemgetter
 import time
 
 import gevent
@@ -14,9 +17,40 @@ Lock = gevent.monkey.get_original('threading', 'Lock')
 
 log = logging.getLogger(__name__)
 
-@contextmanager
-def dummy_stream_stat_manager(stream, stream_name=None):
-    yield stream
+class DummyStreamStatManager(object):
+    """ A stream stat manager which does nothing.
+    """
+    @contextmanager
+    def __call__(self, stream, stream_name=None, camera=None,
+                 role='client', buffer=None, client=None, limiter=None):
+        yield UnmonitoredStream(stream)
+
+    def for_camera(self, camera):
+        return self
+
+    def count(self, name, n=1, camera=None):
+        pass
+
+    def add_loop_lag(self, lag):
+        pass
+
+dummy_stream_stat_manager = DummyStreamStatManager()
+
+class UnmonitoredStream(object):
+    """ What the `DummyStreamStatManager` provides in place of a
+    `StatMonitoredStream`.
+
+    """
+    __slots__ = ('stream',)
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def record(self, frame):
+        pass
 
 class StreamStatManager(object):
     SUMMARY_FMT = (
@@ -26,25 +60,65 @@ class StreamStatManager(object):
 
 
     STATS_FMT = (
-        u"{stream_name:17s}:{time_connected:6.1f}s,"
+        u"{label:17s}:{time_connected:6.1f}s,"
         u"{frames_total:6d} f {frames_avg_rate:4.02f}/s"
         u" [{frames_cur_rate:4.02f}/s],"
-        u" {bytes_total} {bytes_avg_rate}/s [{bytes_cur_rate}/s]")
+        u" {bytes_total} {bytes_avg_rate}/s [{bytes_cur_rate}/s]"
+        u" lag {latency_p50}/{latency_p99}")
 
+    GROUP_FMT = (
+        u"{label:17s}:{n_streams:6d} streams,"
+        u"{frames_rate:8.02f} f/s, {bytes_rate}/s;"
+        u" per stream {fps_min:.02f}/{fps_median:.02f}/{fps_max:.02f} f/s")
 
-    def __init__(self, name='Current streams', log_interval=30):
+    LATENCY_FMT = u"frame latency: p50 {0} p90 {1} p99 {2} ({3} frames)"
+    LOOP_LAG_FMT = u"loop lag: p50 {0} p90 {1} p99 {2} ({3} samples)"
+
+
+    def __init__(self, name='Current streams', log_interval=30,
+                 top_streams=5, sample_interval=1.0,
+                 series_lengths=(('second', 1, 3600),
+                                 ('minute', 60, 1440))):
         self.name = name
         self.log_interval = log_interval
+        self.top_streams = top_streams
+        self.sample_interval = sample_interval
+        # Time series of activity, keyed by resolution name
+        self.series = dict((resolution, TimeSeries(interval, length))
+                           for resolution, interval, length
+                           in series_lengths)
+        self._last_sample = None
         self.streams = set()
+        self.counters = {}
+        # Frame and byte counts of terminated streams, keyed by
+        # (camera, role)
+        self.totals = {}
+        # Latency histograms of terminated streams, keyed by camera
+        self.latency_totals = {}
+        # Event loop lag (see `puppyserv.greenlet.HubMonitor`)
+        self.loop_lag = Histogram()
         self.runner = gevent.spawn(self._logger)
+        self.sampler = gevent.spawn(self._sampler)
         self.mutex = Lock()
 
     @contextmanager
-    def __call__(self, stream, stream_name=None):
+    def __call__(self, stream, stream_name=None, camera=None,
+                 role='client', buffer=None, client=None, limiter=None):
+        """ Monitor ``stream``.
+
+        ``Role`` is ``'client'`` for streams being sent to clients,
+        or ``'ingest'`` for streams being acquired from a camera.  If
+        ``buffer`` is given, its length is reported as the buffer
+        occupancy.  ``Client`` (the client's address) and ``limiter``
+        (the rate limiter applied to the stream) are reported by
+        `status`.
+
+        """
         if stream_name is None:
             stream_name = repr(stream)
-        monitored = StatMonitoredStream(stream, stream_name)
-        log.info("%s: stream started", stream_name)
+        monitored = StatMonitoredStream(stream, stream_name, camera,
+                                        role, buffer, client, limiter)
+        log.info("%s: stream started", monitored.label)
         with self.mutex:
             self.streams.add(monitored)
 
@@ -52,19 +126,296 @@ class StreamStatManager(object):
             yield monitored
         finally:
             log.info("%s: stream terminated: %s",
-                     stream_name, monitored.stats(format=self.SUMMARY_FMT))
+                     monitored.label,
+                     monitored.stats(format=self.SUMMARY_FMT))
+            camera = monitored.camera or u''
+            key = camera, monitored.role
             with self.mutex:
                 self.streams.remove(monitored)
+                n_frames, n_bytes = self.totals.get(key, (0, 0))
+                self.totals[key] = (n_frames + monitored.n_frames,
+                                    n_bytes + monitored.n_bytes)
+                if monitored.latency is not None:
+                    total = self.latency_totals.get(camera)
+                    if total is None:
+                        total = self.latency_totals[camera] = Histogram()
+                    total.merge(monitored.latency)
+
+    def for_camera(self, camera):
+        """ Get a stat manager which tags its streams with ``camera``.
+        """
+        return CameraStreamStatManager(self, camera)
+
+    def count(self, name, n=1, camera=None):
+        """ Increment the event counter ``name``.
+        """
+        key = camera or u'', name
+        with self.mutex:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def add_loop_lag(self, lag):
+        """ Record a measurement of the gevent hub's loop lag.
+        """
+        self.loop_lag.add(lag)
+
+    def latency(self, streams=None, latency_totals=None):
+        """ Get the aggregate frame latency histogram for each camera.
+
+        This includes both current and terminated client streams.
+
+        """
+        if streams is None:
+            with self.mutex:
+                streams = list(self.streams)
+                latency_totals = self.latency_totals.copy()
+        histograms = {}
+        def _merge(camera, histogram):
+            merged = histograms.get(camera)
+            if merged is None:
+                merged = histograms[camera] = Histogram()
+            merged.merge(histogram)
+        for camera, histogram in latency_totals.items():
+            _merge(camera, histogram)
+        for stream in streams:
+            if stream.latency is not None:
+                _merge(stream.camera or u'', stream.latency)
+        return histograms
+
+    def status(self):
+        """ Get the current state of all streams.
+
+        Returns a dict, suitable for JSON serialization, with a list
+        of the ``clients`` being served, a list of the ``ingest``
+        streams being acquired from cameras, and the event
+        ``counters`` (by camera.)
+
+        The mutex is only held while the set of streams is copied.
+
+        """
+        with self.mutex:
+            streams = list(self.streams)
+            counters = self.counters.copy()
+        streams.sort(key=attrgetter('camera_and_name'))
+        # The newest frame acquired from each source
+        heads = {}
+        for stream in streams:
+            head = stream.last_frame
+            if stream.role == 'ingest' and head is not None:
+                heads[stream.camera or u'', head.source] = head
+        clients = [stream.status(heads) for stream in streams
+                   if stream.role != 'ingest']
+        ingest = [stream.status() for stream in streams
+                  if stream.role == 'ingest']
+        by_camera = {}
+        for (camera, name), value in counters.items():
+            by_camera.setdefault(camera, {})[name] = value
+        return {
+            'time': time.time(),
+            'clients': clients,
+            'ingest': ingest,
+            'counters': by_camera,
+            }
+
+    def sample(self, t=None):
+        """ Add the activity since the last sample to the time series.
+        """
+        if t is None:
+            t = time.time()
+        with self.mutex:
+            streams = list(self.streams)
+            totals = self.totals.copy()
+            dropped = sum(value
+                          for (camera, name), value in self.counters.items()
+                          if name == 'frames_dropped')
+        viewers = 0
+        cumulative = {'client': [0, 0], 'ingest': [0, 0]}
+        for (camera, role), (n_frames, n_bytes) in totals.items():
+            counts = cumulative['ingest' if role == 'ingest' else 'client']
+            counts[0] += n_frames
+            counts[1] += n_bytes
+        for stream in streams:
+            if stream.role == 'ingest':
+                counts = cumulative['ingest']
+            else:
+                counts = cumulative['client']
+                viewers += 1
+            counts[0] += stream.n_frames + stream.d_frames
+            counts[1] += stream.n_bytes + stream.d_bytes
+
+        current = (cumulative['client'][1], cumulative['client'][0],
+                   cumulative['ingest'][0], dropped)
+        last = self._last_sample
+        self._last_sample = current
+        if last is None:
+            # Nothing to compare with yet
+            last = current
+        deltas = [max(0, now - then) for now, then in zip(current, last)]
+        for series in self.series.values():
+            series.add(t, viewers, *deltas)
 
     def log_stats(self):
+        """ Log a summary of the current streams.
+
+        Streams are summarized by camera and role: the number of
+        streams, their total rates, and the minimum, median and
+        maximum frame rate of the individual streams.  Only the
+        ``top_streams`` busiest streams (by current byte rate) are
+        logged individually.
+
+        """
         with self.mutex:
-            streams = sorted(self.streams, key=attrgetter('stream_name'))
+            streams = list(self.streams)
+            counters = self.counters.copy()
+            latency_totals = self.latency_totals.copy()
         if streams:
-            stats = u"\n ".join(stream.stats(format=self.STATS_FMT)
-                                 for stream in streams)
-            log.info(u"%s:\n %s", self.name, stats)
+            groups = {}
+            for stream in streams:
+                frames_rate, bytes_rate = stream.current_rates()
+                key = stream.camera or u'', stream.role
+                groups.setdefault(key, []).append(
+                    (bytes_rate, frames_rate, stream))
+            summaries = []
+            for (camera, role), group in sorted(groups.items()):
+                fps = sorted(frames_rate for _, frames_rate, _ in group)
+                summaries.append(self.GROUP_FMT.format(
+                    label=_label(camera, role),
+                    n_streams=len(group),
+                    frames_rate=sum(fps),
+                    bytes_rate=format_byte_size(
+                        sum(bytes_rate for bytes_rate, _, _ in group)),
+                    fps_min=fps[0],
+                    fps_median=fps[len(fps) // 2],
+                    fps_max=fps[-1]))
+            log.info(u"%s:\n %s", self.name, u"\n ".join(summaries))
+
+            busiest = heapq.nlargest(
+                self.top_streams,
+                (rates for group in groups.values() for rates in group),
+                key=itemgetter(0))
+            if busiest:
+                log.info(u"%s: busiest %d of %d:\n %s",
+                         self.name, len(busiest), len(streams),
+                         u"\n ".join(stream.stats(format=self.STATS_FMT,
+                                                  reset=False)
+                                     for _, _, stream in busiest))
+            for stream in streams:
+                stream.reset()
         else:
             log.debug(u"%s: No streams", self.name)
+        if counters:
+            log.info(u"%s: %s", self.name, u", ".join(
+                u"%s=%d" % (_label(camera, name), value)
+                for (camera, name), value in sorted(counters.items())))
+        aggregate = Histogram()
+        for histogram in self.latency(streams, latency_totals).values():
+            aggregate.merge(histogram)
+        for fmt, histogram in [(self.LATENCY_FMT, aggregate),
+                               (self.LOOP_LAG_FMT, self.loop_lag)]:
+            if histogram.count:
+                log.info(u"%s: %s", self.name, fmt.format(
+                    format_latency(histogram.quantile(0.5)),
+                    format_latency(histogram.quantile(0.9)),
+                    format_latency(histogram.quantile(0.99)),
+                    histogram.count))
+
+    def metrics(self):
+        """ Format the current stats in the Prometheus text exposition
+        format.
+
+        Streams are aggregated by camera and role, so the output does
+        not grow with the number of clients.
+
+        """
+        with self.mutex:
+            streams = list(self.streams)
+            counters = self.counters.copy()
+            totals = self.totals.copy()
+            latency_totals = self.latency_totals.copy()
+
+        n_streams = {}
+        frames = {}
+        bytes_ = {}
+        buffered = {}
+        for key, (n_frames, n_bytes) in totals.items():
+            frames[key] = n_frames
+            bytes_[key] = n_bytes
+            n_streams.setdefault(key, 0)
+        for stream in streams:
+            key = stream.camera or u'', stream.role
+            n_streams[key] = n_streams.get(key, 0) + 1
+            frames[key] = (frames.get(key, 0)
+                           + stream.n_frames + stream.d_frames)
+            bytes_[key] = bytes_.get(key, 0) + stream.n_bytes + stream.d_bytes
+            if stream.buffer is not None:
+                camera = stream.camera or u''
+                buffered[camera] = buffered.get(camera, 0) + len(stream.buffer)
+
+        by_name = {}
+        for (camera, name), value in counters.items():
+            by_name.setdefault(name, {})[camera] = value
+
+        lines = []
+        def family(name, type_, help, values, label_names):
+            lines.append(u"# HELP puppyserv_%s %s" % (name, help))
+            lines.append(u"# TYPE puppyserv_%s %s" % (name, type_))
+            for labels, value in sorted(values.items()):
+                if not isinstance(labels, tuple):
+                    labels = labels,
+                lines.append(u"puppyserv_%s{%s} %s" % (
+                    name,
+                    u",".join(u'%s="%s"' % (label_name, _escape(label))
+                              for label_name, label
+                              in zip(label_names, labels)),
+                    value))
+
+        family('streams', 'gauge', "Number of active streams.",
+               n_streams, ('camera', 'role'))
+        family('frames_total', 'counter', "Frames streamed.",
+               frames, ('camera', 'role'))
+        family('bytes_total', 'counter', "Bytes of image data streamed.",
+               bytes_, ('camera', 'role'))
+        family('buffered_frames', 'gauge', "Frames held in ingest buffers.",
+               buffered, ('camera',))
+        for name, values in sorted(by_name.items()):
+            family(name + '_total', 'counter', "Count of %s." % name,
+                   values, ('camera',))
+
+        def histogram_family(name, help, histograms, label_name=None):
+            name = u'puppyserv_' + name
+            lines.append(u"# HELP %s %s" % (name, help))
+            lines.append(u"# TYPE %s histogram" % name)
+            for label, histogram in sorted(histograms.items()):
+                labels = []
+                if label_name is not None:
+                    labels.append(u'%s="%s"' % (label_name, _escape(label)))
+                cumulative = 0
+                for bound, n in zip(histogram.bounds + [u'+Inf'],
+                                    histogram.counts):
+                    cumulative += n
+                    lines.append(u'%s_bucket{%s} %d' % (
+                        name, u",".join(labels + [u'le="%s"' % bound]),
+                        cumulative))
+                labels = u"{%s}" % u",".join(labels) if labels else u""
+                lines.append(u'%s_sum%s %s' % (name, labels, histogram.sum))
+                lines.append(u'%s_count%s %d'
+                             % (name, labels, histogram.count))
+
+        histogram_family('frame_latency_seconds',
+                         "Delay from ingest to delivery to clients.",
+                         self.latency(streams, latency_totals), 'camera')
+        loop_lag = self.loop_lag
+        histogram_family('loop_lag_seconds',
+                         "Lateness of timed wake-ups in the gevent hub.",
+                         {None: loop_lag} if loop_lag.count else {})
+        return u"\n".join(lines) + u"\n"
+
+    def _sampler(self):
+        while self.sample_interval > 0:
+            gevent.sleep(self.sample_interval)
+            try:
+                self.sample()
+            except:
+                log.exception('sample failed')
 
     def _logger(self):
         while self.log_interval > 0:
@@ -74,33 +425,161 @@ class StreamStatManager(object):
             except:
                 log.exception('log_stats failed')
 
+class CameraStreamStatManager(object):
+    """ A view of a :class:`StreamStatManager` which tags all streams
+    with a camera name.
+
+    """
+    def __init__(self, manager, camera):
+        self.manager = manager
+        self.camera = camera
+
+    def __call__(self, stream, stream_name=None, role='client', buffer=None,
+                 client=None, limiter=None):
+        return self.manager(stream, stream_name, camera=self.camera,
+                            role=role, buffer=buffer,
+                            client=client, limiter=limiter)
+
+    def count(self, name, n=1):
+        self.manager.count(name, n, camera=self.camera)
+
+    def for_camera(self, camera):
+        return self.manager.for_camera(camera)
+
 class StatMonitoredStream(object):
+    """ Stats for a stream.
+
+    This may be iterated over in place of the stream.  Alternatively
+    (saving a layer of iteration in the per-frame path) one may
+    iterate over the stream directly, passing each frame to `record`.
+
+    """
+    __slots__ = ('stream', 'stream_name', 'camera', 'role', 'buffer',
+                 'client', 'limiter', 'last_frame', 'dropped', 'latency',
+                 'n_frames', 'n_bytes', 'd_frames', 'd_bytes', 't0', 't')
+
     time = staticmethod(time.time)
 
-    def __init__(self, stream, stream_name):
+    def __init__(self, stream, stream_name, camera=None, role='client',
+                 buffer=None, client=None, limiter=None):
         self.stream = iter(stream)
         self.stream_name = stream_name
+        self.camera = camera
+        self.role = role
+        self.buffer = buffer
+        self.client = client
+        self.limiter = limiter
+        self.last_frame = None
+        # Frames skipped by this stream (since it was behind)
+        self.dropped = 0
+        # Latency is only measured for frames sent to clients
+        self.latency = Histogram() if role == 'client' else None
         self.n_frames = 0
         self.n_bytes = 0
         self.d_frames = 0
         self.d_bytes = 0
         self.t0 = self.t = self.time()
 
+    @property
+    def label(self):
+        return _label(self.camera, self.stream_name)
+
+    @property
+    def camera_and_name(self):
+        return self.camera or u'', self.stream_name
+
     def __iter__(self):
         return self
 
     def next(self):
         frame = next(self.stream)
+        self.record(frame)
+        return frame
+
+    def record(self, frame):
+        """ Count ``frame``, which has been taken from the stream.
+        """
         if frame is not None:
             self.d_frames += 1
             self.d_bytes += len(frame.image_data)
-        return frame
+            if self.latency is not None and frame.ingest_time is not None:
+                self.latency.add(self.time() - frame.ingest_time)
+            last = self.last_frame
+            if (last is not None and frame.ingest_seq is not None
+                and last.ingest_seq is not None
+                and frame.source == last.source):
+                self.dropped += max(0, frame.ingest_seq - last.ingest_seq - 1)
+            self.last_frame = frame
+
+    def current_rates(self, t=None):
+        """ Get the frame and byte rates since the last reset.
+        """
+        if t is None:
+            t = self.time()
+        dt = max(0.01, t - self.t)
+        return self.d_frames / dt, self.d_bytes / dt
+
+    def status(self, heads=None):
+        """ Get the current state of the stream, as a dict.
+
+        ``Heads`` maps ``(camera, source)`` to the newest frame
+        acquired from that source.  It is used to compute how far a
+        client stream lags behind.
+
+        This does not reset the current rate measurement.
+
+        """
+        if heads is None:
+            heads = {}
+        stats = self.stats(reset=False)
+        status = {
+            'name': self.stream_name,
+            'camera': self.camera,
+            'role': self.role,
+            'connected_at': self.t0,
+            'time_connected': stats['time_connected'],
+            'frames': stats['frames_total'],
+            'bytes': stats['bytes_total_raw'],
+            'fps_avg': stats['frames_avg_rate'],
+            'fps_current': stats['frames_cur_rate'],
+            'bytes_per_second_avg': stats['bytes_avg_rate_raw'],
+            }
+        last = self.last_frame
+        if self.role == 'ingest':
+            has_frame = last is not None
+            status.update({
+                'source': last.source if has_frame else None,
+                'healthy': getattr(self.stream, 'healthy', None),
+                'demand': getattr(self.stream, 'demand', None),
+                'buffered_frames': (len(self.buffer)
+                                    if self.buffer is not None else None),
+                'last_frame_at': last.ingest_time if has_frame else None,
+                })
+        else:
+            lag_frames = lag_seconds = None
+            if last is not None:
+                head = heads.get((self.camera or u'', last.source))
+                if (head is not None and head.ingest_seq is not None
+                    and last.ingest_seq is not None):
+                    lag_frames = max(0, head.ingest_seq - last.ingest_seq)
+                    lag_seconds = max(0, head.ingest_time - last.ingest_time)
+            status.update({
+                'client': self.client,
+                'dropped_frames': self.dropped,
+                'max_rate': (self.limiter.max_rate
+                             if self.limiter is not None else None),
+                'lag_frames': lag_frames,
+                'lag_seconds': lag_seconds,
+                })
+        return status
 
     def stats(self, format=None, reset=True):
         t = self.time()
         time_connected = t - self.t0
         dt = t - self.t
         stream_name = self.stream_name
+        camera = self.camera
+        label = self.label
         frames_total = self.n_frames + self.d_frames
         frames_avg_rate = frames_total / max(0.01, time_connected)
         frames_cur_rate = self.d_frames / max(0.01, dt)
@@ -110,6 +589,11 @@ class StatMonitoredStream(object):
         bytes_total = format_byte_size(bytes_total_raw)
         bytes_avg_rate = format_byte_size(bytes_avg_rate_raw)
         bytes_cur_rate = format_byte_size(bytes_cur_rate_raw)
+        latency = self.latency
+        latency_p50 = latency_p99 = format_latency(None)
+        if latency is not None:
+            latency_p50 = format_latency(latency.quantile(0.5))
+            latency_p99 = format_latency(latency.quantile(0.99))
 
         if reset:
             self.reset()
@@ -127,6 +611,154 @@ class StatMonitoredStream(object):
         self.d_frames = 0
         self.d_bytes = 0
 
+#: Upper bounds of the latency histogram buckets (seconds)
+LATENCY_BOUNDS = [0.001 * 2 ** n for n in range(17)]
+
+class Histogram(object):
+    """ A histogram with logarithmically spaced buckets.
+
+    Bucket ``n`` counts values greater than ``bounds[n - 1]`` and no
+    greater than ``bounds[n]``.  There is a final bucket for values
+    greater than the last bound.
+
+    """
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        """ Add the counts from ``other``, which must have the same
+        bounds.
+        """
+        assert other.bounds == self.bounds
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        """ Estimate the ``q``-th quantile.
+
+        The result is the upper bound of the bucket containing the
+        quantile (or infinity, for the final bucket), or ``None`` if
+        the histogram is empty.
+
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, n in zip(self.bounds, self.counts):
+            cumulative += n
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+class TimeSeries(object):
+    """ A fixed-size ring of per-interval activity aggregates.
+
+    Each slot holds one ``interval`` (seconds) worth of activity: the
+    peak number of ``viewers``, and the total ``egress_bytes``,
+    ``delivered_frames``, ``ingest_frames`` and ``dropped_frames``.
+    Only the last ``length`` intervals are kept.  Storage is
+    allocated up front.
+
+    """
+    FIELDS = ('viewers', 'egress_bytes', 'delivered_frames',
+              'ingest_frames', 'dropped_frames')
+
+    def __init__(self, interval, length):
+        self.interval = interval
+        self.length = length
+        # The interval number held in each slot (-1 if none)
+        self.slots = array('l', [-1]) * length
+        self.data = dict((field, array('d', [0.0]) * length)
+                         for field in self.FIELDS)
+
+    def _slot(self, t):
+        n = int(t // self.interval)
+        slot = n % self.length
+        if self.slots[slot] != n:
+            self.slots[slot] = n
+            for values in self.data.values():
+                values[slot] = 0.0
+        return slot
+
+    def add(self, t, viewers, egress_bytes=0, delivered_frames=0,
+            ingest_frames=0, dropped_frames=0):
+        """ Record activity at time ``t``.
+        """
+        slot = self._slot(t)
+        data = self.data
+        data['viewers'][slot] = max(data['viewers'][slot], viewers)
+        data['egress_bytes'][slot] += egress_bytes
+        data['delivered_frames'][slot] += delivered_frames
+        data['ingest_frames'][slot] += ingest_frames
+        data['dropped_frames'][slot] += dropped_frames
+
+    def query(self, since=None, t=None):
+        """ Get the recorded intervals, oldest first.
+
+        Only intervals which end after ``since`` (if given) are
+        included.  Returns a dict, suitable for JSON serialization,
+        mapping ``time`` (the start of each interval) and each of the
+        fields to a list of values.  The frame counts are given as
+        rates (``delivered_fps``, etc.)
+
+        """
+        if t is None:
+            t = time.time()
+        interval = self.interval
+        last = int(t // interval)
+        # (Unused slots hold -1, so never look before interval zero)
+        first = max(0, last - self.length + 1)
+        if since is not None:
+            first = max(first, int(since // interval))
+        times = []
+        columns = dict((field, []) for field in self.FIELDS)
+        for n in range(first, last + 1):
+            slot = n % self.length
+            if self.slots[slot] != n:
+                continue
+            times.append(n * interval)
+            for field, values in self.data.items():
+                columns[field].append(values[slot])
+        result = {
+            'interval': interval,
+            'time': times,
+            'viewers': [int(v) for v in columns['viewers']],
+            'egress_bytes': [int(v) for v in columns['egress_bytes']],
+            }
+        for field in 'delivered_frames', 'ingest_frames', 'dropped_frames':
+            rate_field = field.replace('_frames', '_fps')
+            result[rate_field] = [v / interval for v in columns[field]]
+        return result
+
+def format_latency(seconds):
+    if seconds is None:
+        return u"-"
+    elif seconds == float('inf'):
+        return u"inf"
+    elif seconds < 1:
+        return u"%dms" % round(seconds * 1000)
+    return u"%.1fs" % seconds
+
+def _label(camera, name):
+    if not camera:
+        return name
+    return u"%s:%s" % (camera, name)
+
+def _escape(label):
+    return (label.replace(u'\\', u'\\\\')
+            .replace(u'"', u'\\"')
+            .replace(u'\n', u'\\n'))
+
 def format_byte_size(nbytes):
     value = nbytes
     if round(value / 1024.0, 2) < 1.0:
@@ -3,10 +3,12 @@
 """
 from __future__ import absolute_import, division
 
+from bisect import bisect_right
 from collections import deque
 import glob
 import logging
 import mimetypes
+import os
 import time
 
 import gevent
@@ -15,57 +17,173 @@ import gevent.monkey
 Thread = gevent.monkey.get_original('threading', 'Thread')
 
 import puppyserv.greenlet
+from puppyserv.archive import FrameArchive
 from puppyserv.interfaces import VideoBuffer, VideoFrame
 from puppyserv.stats import dummy_stream_stat_manager
 from puppyserv.util import asbool
 
 log = logging.getLogger(__name__)
 
+def _guess_content_type(filename):
+    content_type, encoding = mimetypes.guess_type(filename)
+    if not content_type:
+        raise ValueError("Can not guess content type")
+    return content_type
+
 class StaticFrame(VideoFrame):
+    __slots__ = ('filename',)
+
     def __init__(self, filename):
-        content_type, encoding = mimetypes.guess_type(filename)
-        if not content_type:
-            raise ValueError("Can not guess content type")
+        content_type = _guess_content_type(filename)
         with open(filename, 'rb') as fp:
-            super(StaticFrame, self).__init__(fp.read(), content_type)
+            image_data = fp.read()
+        super(StaticFrame, self).__init__(image_data, content_type,
+                                          source=filename)
         self.filename = filename
 
     def __repr__(self):
         return u"{0.__class__.__name__}({0.filename!r})".format(self)
 
     def __eq__(self, other):
-        return type(self) == type(other) and self.__dict__ == other.__dict__
+        # Frame metadata (sequence number, etc.) is not compared
+        return (type(self) == type(other)
+                and self.filename == other.filename
+                and self.content_type == other.content_type
+                and self.image_data == other.image_data)
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+class CachedFrames(object):
+    """ Base for sequences of frames which are loaded as they are needed.
+
+    Only the most recently used ``cache_size`` frames are kept in
+    memory.  Subclasses must implement ``__len__`` and ``_load``.
+
+    """
+    #: Frame timestamps, if the frames should be played with their
+    #: original timing
+    timestamps = None
+
+    def __init__(self, cache_size=16):
+        self.cache_size = cache_size
+        self._cache = {}
+        # Cached indexes, least recently used first
+        self._lru = deque()
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        cache = self._cache
+        lru = self._lru
+        frame = cache.get(i)
+        if frame is None:
+            frame = cache[i] = self._load(i)
+        else:
+            lru.remove(i)
+        lru.append(i)
+        while len(lru) > self.cache_size:
+            del cache[lru.popleft()]
+        return frame
+
+    def _load(self, i):
+        raise NotImplementedError()
+
+    def close(self):
+        """ Release any resources held by the frames.
+        """
+        self._cache.clear()
+        self._lru.clear()
+
+class StaticFrames(CachedFrames):
+    """ A sequence of `StaticFrame`\s read from image files.
+    """
+    def __init__(self, filenames, cache_size=16):
+        super(StaticFrames, self).__init__(cache_size)
+        filenames = [fn for fn in filenames if os.path.isfile(fn)]
+        for filename in filenames:
+            _guess_content_type(filename) # check that we can
+        self.filenames = filenames
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def _load(self, i):
+        return StaticFrame(self.filenames[i])
+
+class ArchiveFrames(CachedFrames):
+    """ The frames in a `FrameArchive`.
+    """
+    def __init__(self, archive, cache_size=16):
+        super(ArchiveFrames, self).__init__(cache_size)
+        self.archive = archive
+        self.timestamps = archive.timestamps
+
+    def __len__(self):
+        return len(self.archive)
+
+    def _load(self, i):
+        return self.archive.frame(i)
+
+    def close(self):
+        super(ArchiveFrames, self).close()
+        self.archive.close()
+
 class StaticVideoStreamBuffer(VideoBuffer):
     """ A video stream from static images.  For testing.
+
+    If ``timestamps`` is given, the frames are played with their
+    original timing, rather than at ``frame_rate``.
+
     """
     time = staticmethod(time.time)
     sleep = staticmethod(gevent.sleep)
 
-    def __init__(self, frames, loop=True, frame_rate=4.0):
+    def __init__(self, frames, loop=True, frame_rate=4.0, timestamps=None):
         self.frames = frames
         self.loop = loop
         self.start = self.time()
         self.frame_rate = frame_rate
         self.closed = False
+        self.offsets = None
+        if timestamps:
+            self.offsets = [t - timestamps[0] for t in timestamps]
+            if len(timestamps) > 1 and self.offsets[-1] > 0:
+                mean_interval = self.offsets[-1] / (len(timestamps) - 1)
+            else:
+                mean_interval = 1 / frame_rate
+            # Loop duration
+            self.period = self.offsets[-1] + mean_interval
 
     @classmethod
     def from_settings(cls, settings, prefix='static.'):
-        images = settings[prefix + 'images']
+        archive = settings.get(prefix + 'archive')
         loop = asbool(settings.get(prefix + 'loop', True))
         frame_rate = float(settings.get(prefix + 'frame_rate', 4.0))
+        cache_size = int(settings.get(prefix + 'cache_size', 16))
 
-        image_filenames = sorted(glob.glob(images))
-        frames = map(StaticFrame, image_filenames)
-        return cls(frames, loop, frame_rate)
+        if archive:
+            frames = ArchiveFrames(FrameArchive(archive), cache_size)
+        else:
+            image_filenames = sorted(glob.glob(settings[prefix + 'images']))
+            frames = StaticFrames(image_filenames, cache_size)
+        return cls(frames, loop, frame_rate, frames.timestamps)
 
     def close(self):
-        self.closed = True
+        if not self.closed:
+            self.closed = True
+            close = getattr(self.frames, 'close', None)
+            if close is not None:
+                close()
 
     def stream(self):
+        if self.offsets is not None:
+            return self._timed_stream()
+        return self._fixed_rate_stream()
+
+    def _fixed_rate_stream(self):
         last_frame = None
         while not self.closed:
             pos = max(0, self.frame_rate * (self.time() - self.start))
@@ -81,123 +199,396 @@ class StaticVideoStreamBuffer(VideoBuffer):
                 break
             yield self.frames[frame]
 
+    def _timed_stream(self):
+        offsets = self.offsets
+        last_pos = None
+        while not self.closed:
+            elapsed = max(0, self.time() - self.start)
+            if self.loop:
+                cycle, t = divmod(elapsed, self.period)
+            else:
+                cycle, t = 0, elapsed
+            pos = int(cycle), bisect_right(offsets, t) - 1
+            if pos == last_pos:
+                # Wait for the next frame
+                cycle, frame = pos
+                if frame + 1 < len(offsets):
+                    wait = offsets[frame + 1] - t
+                    pos = cycle, frame + 1
+                elif self.loop:
+                    wait = self.period - t
+                    pos = cycle + 1, 0
+                else:
+                    break
+                self.sleep(wait)
+            last_pos = pos
+            if self.closed:
+                break
+            yield self.frames[pos[1]]
+
+class FrameRing(object):
+    """ A fixed-size ring of frames indexed by sequence number.
+
+    There is a single writer.  Readers need not take any lock: each
+    slot records the sequence number of the frame it holds, so a
+    reader can tell when the frame it wanted has been overwritten.
+
+    ``length`` is the sequence number of the next frame to be
+    appended (i.e. the total number of frames appended so far.)
+
+    """
+    def __init__(self, size):
+        self.size = size
+        self.slots = [(-1, None)] * size
+        self.length = 0
+
+    def __len__(self):
+        return min(self.length, self.size)
+
+    def append(self, frame):
+        seq = self.length
+        # Fill the slot before bumping length, so that readers never see
+        # a sequence number whose slot has not yet been filled.
+        self.slots[seq % self.size] = (seq, frame)
+        self.length = seq + 1
+
+    def get(self, seq):
+        """ Get the frame with sequence number ``seq``.
+
+        Returns a ``(seq, frame)`` pair.  If the requested frame has
+        already been overwritten, the oldest frame still in the buffer
+        is returned instead.  It is an error to request a frame which
+        has not yet been appended.
+
+        This never retries, however fast the writer is: should the
+        writer overwrite the slot just before it is read, the newer
+        frame it now holds is returned.
+
+        """
+        assert seq < self.length
+        # Skip ahead to the oldest available frame
+        seq = max(seq, self.length - self.size)
+        return self.slots[seq % self.size]
+
 class ThreadedStreamBuffer(VideoBuffer):
     """ Stream video in a separate thread.
 
+    If a ``recorder`` (see `puppyserv.recorder.FrameRecorder`) is
+    given, each frame captured is also passed to it.  The recorder is
+    closed when capture terminates.
+
+    Frames are stamped with their ``ingest_time`` and ``ingest_seq``
+    as they are buffered.
+
     """
+    time = staticmethod(time.time)
+
     def __init__(self, source, timeout=None, buffer_size=10,
                  stream_stat_manager=dummy_stream_stat_manager,
-                 stream_name=None):
+                 stream_name=None,
+                 recorder=None):
         self.source = source
         self.timeout = timeout
 
         self.stream_stat_manager = stream_stat_manager
         self.stream_name = stream_name or repr(source)
 
-        self.framebuf = deque(maxlen=buffer_size)
-        self.length = 0
+        self.framebuf = FrameRing(buffer_size)
         self.condition = puppyserv.greenlet.Condition()
+        self.recorder = recorder
 
         self.closed = False
 
-        self.runner = Thread(target=self.run)
-        self.runner.daemon = True
-        self.runner.start()
+        self.runner = self._start_runner()
 
     def __repr__(self):
         return (
             "<{self.__class__.__name__} [{self.runner.name}] {self.source!r}>"
             .format(**locals()))
 
+    def _start_runner(self):
+        runner = Thread(target=self.run)
+        runner.daemon = True
+        runner.start()
+        return runner
+
     def close(self):
         self.closed = True
 
+    @property
+    def demand(self):
+        return self.source.demand
+    @demand.setter
+    def demand(self, value):
+        self.source.demand = value
+
     def is_alive(self):
         return self.runner.is_alive()
 
     def run(self):
         condition = self.condition
         framebuf = self.framebuf
-        log.debug("Capture thread starting: %r", self.source)
-        with self.stream_stat_manager(self.source, self.stream_name) as frames:
+        recorder = self.recorder
+        source = self.source
+        log.debug("Capture thread starting: %r", source)
+        with self.stream_stat_manager(source, self.stream_name,
+                                      role='ingest', buffer=framebuf) \
+                 as monitored:
+            record = monitored.record
             try:
                 while not self.closed:
-                    frame = next(frames)
+                    frame = next(source)
+                    if isinstance(frame, VideoFrame):
+                        frame.ingest_time = self.time()
+                        frame.ingest_seq = framebuf.length
+                    record(frame)
+                    framebuf.append(frame)
                     with condition:
-                        framebuf.append(frame)
-                        self.length += 1
                         condition.notifyAll()
+                    if recorder is not None and frame is not None:
+                        recorder.record(frame)
             except StopIteration:
                 self.closed = True
         log.debug("Capture thread terminating: %r", self.source)
         self.source.close()
+        if recorder is not None:
+            recorder.close()
 
     def stream(self):
         condition = self.condition
         framebuf = self.framebuf
-        pos = max(0, self.length - 1)
+        pos = max(0, framebuf.length - 1)
+        reported_down = False
         while not self.closed:
-            with condition:
-                if pos == self.length:
-                    self.condition.wait(self.timeout)
-                    if self.closed:
-                        break
-                if pos < self.length:
-                    bufstart = self.length - len(framebuf)
-                    if bufstart > pos:
-                        log.debug("Dropped %d frames", bufstart - pos)
-                        pos = bufstart
-                    frame = framebuf[pos - self.length]
-                    pos += 1
-                else:
-                    assert pos == self.length
-                    frame = None        # timed out
+            if pos == framebuf.length:
+                if not reported_down and not self.source.healthy:
+                    # The source is known to be down.  Report that now,
+                    # rather than waiting for the timeout.
+                    reported_down = True
+                    yield None
+                    continue
+                # Caught up.  Only now do we need the lock.
+                with condition:
+                    if pos == framebuf.length:
+                        condition.wait(self.timeout)
+                if self.closed:
+                    break
+                if pos == framebuf.length:
+                    yield None          # timed out
+                    continue
+            seq, frame = framebuf.get(pos)
+            if seq > pos:
+                log.debug("Dropped %d frames", seq - pos)
+                self.stream_stat_manager.count('frames_dropped', seq - pos)
+            pos = seq + 1
+            reported_down = False
             yield frame
 
+class GreenletStreamBuffer(ThreadedStreamBuffer):
+    """ Stream video in a greenlet, rather than in a separate thread.
+
+    The source must do its I/O cooperatively (using gevent sockets),
+    otherwise it will block the hub.  In exchange, there is no thread
+    handoff: readers are woken directly, rather than by way of the
+    event loop's async watcher.
+
+    """
+    def __repr__(self):
+        return (
+            "<{self.__class__.__name__} {self.source!r}>"
+            .format(**locals()))
+
+    def _start_runner(self):
+        return gevent.spawn(self.run)
+
+    def is_alive(self):
+        return not self.runner.ready()
+
+class ReactorStreamBuffer(GreenletStreamBuffer):
+    """ Stream video in a greenlet in a shared capture thread.
+
+    By default, all instances share a single :class:`HubThread`, whose
+    event loop multiplexes the (cooperative) socket I/O of all of their
+    sources.  This allows many cameras to be captured without a thread
+    for each.
+
+    """
+    _default_reactor = None
+
+    def __init__(self, source, reactor=None, **kwargs):
+        if reactor is None:
+            reactor = self.default_reactor()
+        self.reactor = reactor
+        super(ReactorStreamBuffer, self).__init__(source, **kwargs)
+
+    def __repr__(self):
+        return (
+            "<{self.__class__.__name__} [{self.reactor.thread.name}]"
+            " {self.source!r}>"
+            .format(**locals()))
+
+    @classmethod
+    def default_reactor(cls):
+        reactor = ReactorStreamBuffer._default_reactor
+        if reactor is None or not reactor.is_alive():
+            reactor = puppyserv.greenlet.HubThread(name='IngestReactor')
+            ReactorStreamBuffer._default_reactor = reactor
+        return reactor
+
+    def _start_runner(self):
+        return self.reactor.spawn(self.run)
+
+    def is_alive(self):
+        return not self.runner.is_set()
+
 class FailsafeStreamBuffer(VideoBuffer):
     """ A stream bufferwhich falls back to a backup stream buffer if
     the primary stream buffer times out.
 
+    If ``standby_rate`` is set, a backup buffer is kept running as a
+    hot standby (at a demand of ``standby_rate``) while the primary is
+    in use, so that failover is immediate.  In that case the
+    ``backup_buffer_factory`` must accept a ``demand`` keyword
+    argument.
+
+    Otherwise, after switching back to the primary, the backup buffer
+    is kept running for ``cool_down`` seconds in case the primary
+    fails again.  A failure within that window counts as a "flap".
+    After repeated flaps, the primary must work for a hold-down time
+    before we switch back to it.  The hold-down starts at
+    ``hold_down`` seconds and doubles with each successive flap, up
+    to ``max_hold_down``.
+
     """
-    def __init__(self, primary_buffer, backup_buffer_factory):
+    time = staticmethod(time.time)
+
+    def __init__(self, primary_buffer, backup_buffer_factory,
+                 standby_rate=None,
+                 hold_down=1.0,
+                 max_hold_down=300.0,
+                 cool_down=30.0,
+                 stream_stat_manager=dummy_stream_stat_manager):
         self.primary_buffer = primary_buffer
         self.backup_buffer_factory = backup_buffer_factory
+        self.standby_rate = standby_rate
+        self.hold_down = hold_down
+        self.max_hold_down = max_hold_down
+        self.cool_down = cool_down
+        self.stream_stat_manager = stream_stat_manager
         self.backup_buffer = None
+        self.standby_buffer = None
+        # Whether the current backup buffer was already running (as
+        # the standby) when we switched to it
+        self.backup_was_warm = False
+        self.flaps = 0
+        self._switched_back_at = None
+        self._demand = None
         self.closed = False
         self._monitor = gevent.spawn(lambda : None)
         self._monitor.join()
+        self._start_standby()
 
     def close(self):
         self.closed = True
         self.primary_buffer.close()
+        for attr in 'backup_buffer', 'standby_buffer':
+            buf = getattr(self, attr)
+            if buf is not None:
+                buf.close()
+                setattr(self, attr, None)
+        self._monitor.kill(block=True)
+
+    @property
+    def demand(self):
+        return self._demand
+    @demand.setter
+    def demand(self, value):
+        self._demand = value
+        self.primary_buffer.demand = value
         backup_buffer = self.backup_buffer
         if backup_buffer is not None:
-            backup_buffer.close()
-            self.backup_buffer = None
-        self._monitor.kill(block=True)
+            backup_buffer.demand = value
+
+    def _start_standby(self):
+        if self.standby_rate is None or self.closed:
+            return
+        standby_buffer = self.standby_buffer
+        if standby_buffer is None or standby_buffer.closed:
+            self.standby_buffer = self.backup_buffer_factory(
+                demand=self.standby_rate)
+
+    @property
+    def current_hold_down(self):
+        """ How long the primary must work before switching back to it.
+        """
+        if self.flaps == 0:
+            return 0
+        return min(self.hold_down * 2 ** (self.flaps - 1),
+                   self.max_hold_down)
 
     def switch_to_backup(self):
         if self.backup_buffer is None:
-            self.backup_buffer = self.backup_buffer_factory()
+            # Stop any cool-down in progress
+            self._monitor.kill()
+            switched_back_at = self._switched_back_at
+            if (switched_back_at is not None
+                and self.time() - switched_back_at < self.cool_down):
+                self.flaps += 1
+                self.stream_stat_manager.count('flaps')
+            else:
+                self.flaps = 0
+            standby_buffer = self.standby_buffer
+            self.standby_buffer = None
+            if standby_buffer is not None and not standby_buffer.closed:
+                self.backup_buffer = standby_buffer
+                self.backup_was_warm = True
+            else:
+                self.backup_buffer = self.backup_buffer_factory()
+                self.backup_was_warm = False
+            self.backup_buffer.demand = self._demand
             log.info("Switching to backup stream")
-            assert self._monitor.successful()
+            self.stream_stat_manager.count('failovers')
             self._monitor = gevent.spawn(self._monitor_primary)
 
     def _monitor_primary(self):
-        # Wait for consecutive non-timeouts
+        # Wait for consecutive non-timeouts, lasting at least the hold-down
+        hold_down = self.current_hold_down
         primary_stream = self.primary_buffer.stream()
         okay = deque([False], 3)
+        good_since = None
+        terminated = False
         try:
-            while not all(okay):
-                okay.append(next(primary_stream) is not None)
+            while True:
+                frame = next(primary_stream)
+                okay.append(frame is not None)
+                if frame is None:
+                    good_since = None
+                elif good_since is None:
+                    good_since = self.time()
+                if all(okay) and self.time() - good_since >= hold_down:
+                    break
         except StopIteration:
             # primary stream terminated, switch back to primary (and quit)
-            pass
+            terminated = True
 
         log.info("Switching to primary stream")
         backup_buffer = self.backup_buffer
         self.backup_buffer = None
-        backup_buffer.close()
+        self._switched_back_at = self.time()
+        if terminated or self.closed:
+            backup_buffer.close()
+        elif self.standby_rate is not None:
+            # Keep it around as the standby
+            backup_buffer.demand = self.standby_rate
+            self.standby_buffer = backup_buffer
+            self._start_standby()
+        else:
+            # Keep it around for a while, in case the primary fails again
+            self.standby_buffer = backup_buffer
+            gevent.sleep(self.cool_down)
+            if self.standby_buffer is backup_buffer:
+                self.standby_buffer = None
+            backup_buffer.close()
 
     def stream(self):
         while True:
@@ -207,6 +598,10 @@ class FailsafeStreamBuffer(VideoBuffer):
                 if frame is None:
                     # primary stream timeout
                     self.switch_to_backup()
+                    # (Whichever client made the switch)
+                    if self.backup_was_warm:
+                        # Go straight to the (already running) backup
+                        break
                 yield frame
 
             stream = self.backup_buffer.stream()
@@ -4,7 +4,10 @@
 from __future__ import absolute_import, division
 
 from itertools import count
+import json
+import shutil
 import tempfile
+import time
 import unittest
 
 import gevent
@@ -17,6 +20,8 @@ from puppyserv.interfaces import VideoBuffer, VideoFrame
 if not hasattr(unittest.TestCase, 'addCleanup'):
     import unittest2 as unittest
 
+LOCALHOST = '127.0.0.1'
+
 class TestVideoStreamApp(unittest.TestCase):
     def make_one(self, config=None, **kwargs):
         from puppyserv.app import VideoStreamApp
@@ -28,7 +33,12 @@ class TestVideoStreamApp(unittest.TestCase):
         from puppyserv.stats import dummy_stream_stat_manager
         attrs = {
             'buffer_factory': DummyVideoBuffer,
+            'cameras': {},
+            'mark_stale_frames': False,
+            'max_retained_frame_age': 3600.0,
             'max_total_framerate': 50.0,
+            'recording_directory': None,
+            'stats_allowed_addresses': frozenset([LOCALHOST]),
             'stop_stream_holdoff': 15.0,
             'stream_stat_manager': dummy_stream_stat_manager,
             'timeout_image': VideoFrame(b'timed out'),
@@ -36,6 +46,12 @@ class TestVideoStreamApp(unittest.TestCase):
         attrs.update(kwargs)
         return DummyConfig(**attrs)
 
+    def make_cameras(self, **buffer_factories):
+        return dict((name, {'buffer_factory': buffer_factory,
+                            'recording_directory': None,
+                            'stop_stream_holdoff': None})
+                    for name, buffer_factory in buffer_factories.items())
+
     def test_stream(self):
         req = Request.blank('/', accept='*/*')
         config = self.make_config()
@@ -62,6 +78,122 @@ class TestVideoStreamApp(unittest.TestCase):
         self.assertRegexpMatches(next(resp.app_iter), r'\r\nframe1\r\n\Z')
         self.assertRegexpMatches(next(resp.app_iter), r'\r\ntimed out\r\n\Z')
 
+    def make_recording(self, frames):
+        from puppyserv.recorder import Segment, SegmentWriter
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        writer = SegmentWriter(Segment(directory, frames[0][0]))
+        for timestamp, image_data in frames:
+            writer.write(timestamp, VideoFrame(image_data))
+        writer.close()
+        return directory
+
+    def test_replay(self):
+        now = time.time()
+        directory = self.make_recording([(now - 30, b'old'),
+                                         (now - 10, b'frame1'),
+                                         (now - 9, b'frame2')])
+        app = self.make_one(recording_directory=directory)
+        req = Request.blank('/?t=-20', accept='*/*')
+        # (Patching gevent.sleep itself would starve the hub, which is
+        # used for the recording's file I/O)
+        with patch.object(app, 'sleep') as sleep:
+            resp = app(req)
+            self.assertEqual(resp.content_type, 'multipart/x-mixed-replace')
+            self.assertRegexpMatches(next(resp.app_iter),
+                                     r'\r\nframe1\r\n\Z')
+            self.assertRegexpMatches(next(resp.app_iter),
+                                     r'\r\nframe2\r\n\Z')
+        self.assertEqual(len(sleep.mock_calls), 1)
+        self.assertAlmostEqual(sleep.call_args[0][0], 1.0, places=1)
+
+    def test_replay_from(self):
+        directory = self.make_recording([(1399990800.0, b'frame1')])
+        app = self.make_one(recording_directory=directory)
+        req = Request.blank('/?from=2014-05-13T14:20:00Z', accept='*/*')
+        resp = app(req)
+        self.assertRegexpMatches(next(resp.app_iter), r'\r\nframe1\r\n\Z')
+
+    def test_replay_not_recording(self):
+        app = self.make_one()
+        resp = app(Request.blank('/?t=-10', accept='*/*'))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_replay_bad_params(self):
+        app = self.make_one(recording_directory=tempfile.gettempdir())
+        for qs in ('t=foo', 't=10', 'from=yesterday',
+                   't=nan', 't=inf', 't=-inf'):
+            resp = app(Request.blank('/?' + qs, accept='*/*'))
+            self.assertEqual(resp.status_code, 400)
+
+    def test_clip(self):
+        from puppyserv.tests.test_avi import make_jpeg
+        frames = [make_jpeg(), make_jpeg(body=b'xxx'), make_jpeg()]
+        directory = self.make_recording([(1399990800.0, frames[0]),
+                                         (1399990801.0, frames[1]),
+                                         (1399990802.0, frames[2])])
+        app = self.make_one(recording_directory=directory)
+        req = Request.blank('/clip?from=2014-05-13T14:20:00Z'
+                            '&to=2014-05-13T14:20:01.5Z')
+        resp = req.get_response(app)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'video/x-msvideo')
+        self.assertRegexpMatches(resp.content_disposition,
+                                 r'attachment; filename=clip-\d{8}T\d{6}\.avi')
+        self.assertEqual(resp.content_length, len(resp.body))
+        self.assertIn(frames[0], resp.body)
+        self.assertIn(frames[1], resp.body)
+        self.assertEqual(resp.body.count(b'00dc'), 4) # 2 chunks + 2 index
+
+    def test_clip_reads_off_hub(self):
+        from puppyserv.app import _avi_info
+        from puppyserv.greenlet import call_in_threadpool
+        from puppyserv.recorder import Clip
+        from puppyserv.tests.test_avi import make_jpeg
+        directory = self.make_recording([(1399990800.0, make_jpeg())])
+        app = self.make_one(recording_directory=directory)
+        req = Request.blank('/clip?from=2014-05-13T14:20:00Z')
+        with patch('puppyserv.app.call_in_threadpool',
+                   side_effect=call_in_threadpool) as call_in_threadpool:
+            req.get_response(app)
+        self.assertEqual([args[0] for args, kwargs
+                          in call_in_threadpool.call_args_list],
+                         [Clip, _avi_info])
+
+    def test_clip_multipart(self):
+        directory = self.make_recording([(1399990800.0, b'frame1')])
+        app = self.make_one(recording_directory=directory)
+        req = Request.blank('/clip?from=2014-05-13T14:20:00Z&format=multipart')
+        resp = req.get_response(app)
+        self.assertEqual(resp.content_type, 'multipart/x-mixed-replace')
+        self.assertRegexpMatches(resp.content_disposition, r'\.mjpeg\Z')
+        self.assertRegexpMatches(resp.body, r'\r\nframe1\r\n--\S+--\r\n\Z')
+
+    def test_clip_not_jpeg(self):
+        directory = self.make_recording([(1399990800.0, b'frame1')])
+        app = self.make_one(recording_directory=directory)
+        req = Request.blank('/clip?from=2014-05-13T14:20:00Z')
+        resp = req.get_response(app)
+        self.assertEqual(resp.status_code, 500)
+
+    def test_clip_no_frames(self):
+        directory = self.make_recording([(1399990800.0, b'frame1')])
+        app = self.make_one(recording_directory=directory)
+        req = Request.blank('/clip?from=2014-05-13T14:21:00Z')
+        self.assertEqual(req.get_response(app).status_code, 404)
+
+    def test_clip_not_recording(self):
+        app = self.make_one()
+        req = Request.blank('/clip?from=2014-05-13T14:20:00Z')
+        self.assertEqual(req.get_response(app).status_code, 404)
+
+    def test_clip_bad_params(self):
+        app = self.make_one(recording_directory=tempfile.gettempdir())
+        for qs in ('', 'from=foo', 'from=2014-05-13&to=2014-05-12',
+                   'from=2014-05-13&format=mov'):
+            req = Request.blank('/clip?' + qs)
+            self.assertEqual(req.get_response(app).status_code, 400)
+
     def test_snapshot(self):
         req = Request.blank('/snapshot', accept='*/*')
         app = self.make_one(buffer_factory=DummyVideoBuffer)
@@ -92,6 +224,203 @@ class TestVideoStreamApp(unittest.TestCase):
         self.assertEqual(resp.status_code, 404)
         self.assertLess(len(resp.body), 1024)
 
+    def test_stream_marks_stale_frames(self):
+        from puppyserv.app import RetainedFrame
+        app = self.make_one(mark_stale_frames=True)
+        frame = RetainedFrame(VideoFrame(b'old'), 4.25)
+        self.assertIn(b'\r\nX-Frame-Age: 4.2\r\n', app._part_for_frame(frame))
+        app.config.mark_stale_frames = False
+        self.assertNotIn(b'X-Frame-Age', app._part_for_frame(frame))
+
+    def test_part_for_frame(self):
+        app = self.make_one()
+        frame = VideoFrame(b'data', 'image/png')
+        self.assertEqual(app._part_for_frame(frame), b''.join([
+            b'--', app.boundary, b'\r\n',
+            b'Content-Type: image/png\r\n',
+            b'Content-length: 4\r\n',
+            b'\r\n',
+            b'data\r\n']))
+
+    def test_part_for_frame_passthrough(self):
+        app = self.make_one()
+        headers = b'Content-Type: image/jpeg\r\nContent-Length: 4\r\nX: y\r\n'
+        frame = VideoFrame(b'data', part_headers=headers)
+        self.assertEqual(app._part_for_frame(frame), b''.join([
+            b'--', app.boundary, b'\r\n', headers, b'\r\n', b'data\r\n']))
+
+    def test_part_for_frame_caches(self):
+        from puppyserv.app import PartCache
+        app = self.make_one()
+        cache = PartCache(2)
+        frames = [VideoFrame(b'data%d' % n) for n in range(3)]
+        part = app._part_for_frame(frames[0], cache)
+        self.assertIs(app._part_for_frame(frames[0], cache), part)
+        app._part_for_frame(frames[1], cache)
+        app._part_for_frame(frames[2], cache)
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get(frames[0]), None)
+        self.assertIsNot(cache.get(frames[2]), None)
+
+    def test_cameras_have_separate_part_caches(self):
+        from puppyserv.app import BufferManager
+        config = DummyConfig(
+            buffer_factory=DummyVideoBuffer(),
+            cameras={'front': {'buffer_factory': DummyVideoBuffer(),
+                               'stop_stream_holdoff': None,
+                               'recording_directory': None}},
+            max_retained_frame_age=3600.0,
+            max_total_framerate=50.0,
+            recording_directory=None,
+            stop_stream_holdoff=15.0)
+        default = BufferManager(config)
+        front = BufferManager(config, 'front')
+        self.assertIsNot(default.part_cache, front.part_cache)
+
+    def test_snapshot_skips_retained_frames(self):
+        from puppyserv.app import RetainedFrame
+        req = Request.blank('/snapshot', accept='*/*')
+        app = self.make_one(buffer_factory=DummyVideoBuffer([b'new']),
+                            mark_stale_frames=True)
+        app.buffer_manager._retained_frame = \
+            lambda: RetainedFrame(VideoFrame(b'old'), 12)
+        resp = app(req)
+        self.assertEqual(resp.body, b'new')
+        self.assertNotIn('X-Frame-Age', resp.headers)
+
+    def test_snapshot_etag(self):
+        app = self.make_one(buffer_factory=DummyVideoBuffer)
+        resp = app(Request.blank('/snapshot', accept='*/*'))
+        etag = resp.etag
+        self.assertTrue(etag)
+        req = Request.blank('/snapshot', accept='*/*',
+                            if_none_match='"%s"' % etag)
+        app = self.make_one(buffer_factory=DummyVideoBuffer)
+        resp = req.get_response(app)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.body, b'')
+
+    def test_metrics(self):
+        from puppyserv.stats import StreamStatManager
+        stream_stat_manager = StreamStatManager(log_interval=0)
+        stream_stat_manager.count('clips')
+        app = self.make_one(stream_stat_manager=stream_stat_manager)
+        resp = Request.blank('/metrics', remote_addr=LOCALHOST).get_response(app)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/plain')
+        self.assertEqual(resp.content_type_params,
+                         {'version': '0.0.4', 'charset': 'utf-8'})
+        self.assertIn(b'puppyserv_clips_total{camera=""} 1\n', resp.body)
+
+    def test_status(self):
+        from puppyserv.stats import StreamStatManager
+        stream_stat_manager = StreamStatManager(log_interval=0)
+        app = self.make_one(buffer_factory=DummyVideoBuffer,
+                            stream_stat_manager=stream_stat_manager)
+        req = Request.blank('/', accept='*/*',
+                            environ={'REMOTE_ADDR': '10.0.0.1'})
+        stream_resp = req.get_response(app)
+        next(stream_resp.app_iter)
+        resp = Request.blank('/status', remote_addr=LOCALHOST).get_response(app)
+        stream_resp.app_iter.close()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        status = json.loads(resp.body)
+        client, = status['clients']
+        self.assertEqual(client['client'], '10.0.0.1')
+        self.assertEqual(client['frames'], 1)
+        self.assertEqual(client['max_rate'], 50.0)
+
+    def test_stats_disabled_by_default(self):
+        cameras = self.make_cameras(front=DummyVideoBuffer())
+        app = self.make_one(stats_allowed_addresses=frozenset(),
+                            cameras=cameras)
+        for path in '/metrics', '/status', '/history', '/cam/front/status':
+            resp = Request.blank(path, remote_addr=LOCALHOST) \
+                   .get_response(app)
+            self.assertEqual(resp.status_code, 404)
+
+    def test_stats_restricted(self):
+        app = self.make_one()
+        for path in '/metrics', '/status', '/history':
+            resp = Request.blank(path, remote_addr='10.0.0.1',
+                                 headers={'X-Forwarded-For': LOCALHOST}) \
+                   .get_response(app)
+            self.assertEqual(resp.status_code, 403)
+
+    def test_history(self):
+        from puppyserv.stats import StreamStatManager
+        stream_stat_manager = StreamStatManager(log_interval=0,
+                                                sample_interval=0)
+        stream_stat_manager.sample()
+        app = self.make_one(stream_stat_manager=stream_stat_manager)
+        resp = Request.blank('/history?resolution=second&t=-60', remote_addr=LOCALHOST) \
+               .get_response(app)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        history = json.loads(resp.body)
+        self.assertEqual(history['interval'], 1)
+        self.assertEqual(history['viewers'], [0])
+
+    def test_history_defaults_to_minutes(self):
+        from puppyserv.stats import StreamStatManager
+        stream_stat_manager = StreamStatManager(log_interval=0,
+                                                sample_interval=0)
+        app = self.make_one(stream_stat_manager=stream_stat_manager)
+        resp = Request.blank('/history', remote_addr=LOCALHOST).get_response(app)
+        self.assertEqual(json.loads(resp.body)['interval'], 60)
+
+    def test_history_bad_params(self):
+        from puppyserv.stats import StreamStatManager
+        stream_stat_manager = StreamStatManager(log_interval=0,
+                                                sample_interval=0)
+        app = self.make_one(stream_stat_manager=stream_stat_manager)
+        for query in ('resolution=hour', 't=soon', 'from=yesterday',
+                      't=nan', 't=-inf', 't=1e999'):
+            resp = Request.blank('/history?' + query, remote_addr=LOCALHOST).get_response(app)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_camera_stream(self):
+        req = Request.blank('/cam/front/', accept='*/*')
+        cameras = self.make_cameras(front=DummyVideoBuffer([b'front']))
+        app = self.make_one(buffer_factory=DummyVideoBuffer,
+                            cameras=cameras)
+        resp = app(req)
+        self.assertEqual(resp.content_type, 'multipart/x-mixed-replace')
+        self.assertRegexpMatches(next(resp.app_iter), r'\r\nfront\r\n\Z')
+
+    def test_camera_snapshot(self):
+        req = Request.blank('/cam/front/snapshot', accept='*/*')
+        cameras = self.make_cameras(front=DummyVideoBuffer([b'front']))
+        app = self.make_one(buffer_factory=DummyVideoBuffer,
+                            cameras=cameras)
+        resp = app(req)
+        self.assertEqual(resp.body, b'front')
+
+    def test_camera_buffer_managers(self):
+        cameras = self.make_cameras(front=DummyVideoBuffer,
+                                    back=DummyVideoBuffer)
+        app = self.make_one(cameras=cameras)
+        front = app._get_buffer_manager('front')
+        self.assertEqual(front.camera, 'front')
+        self.assertIs(app._get_buffer_manager('front'), front)
+        self.assertIsNot(app._get_buffer_manager('back'), front)
+        self.assertIs(app._get_buffer_manager(None), app.buffer_manager)
+
+    def test_unknown_camera(self):
+        req = Request.blank('/cam/back/', accept='*/*')
+        cameras = self.make_cameras(front=DummyVideoBuffer)
+        app = self.make_one(cameras=cameras)
+        resp = app(req)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_camera_without_trailing_slash(self):
+        req = Request.blank('/cam/front', accept='*/*')
+        cameras = self.make_cameras(front=DummyVideoBuffer)
+        app = self.make_one(cameras=cameras)
+        resp = app(req)
+        self.assertEqual(resp.status_code, 404)
+
 class Test_GET_only(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -149,6 +478,23 @@ class TestConfig(unittest.TestCase):
             config._coerce_positive_float('-0.1', {})
         self.assertEqual(config._coerce_positive_float('42', {}), 42.0)
 
+    def test_coerce_nonnegative_float(self):
+        config = self.make_one({})
+        with self.assertRaises(ValueError):
+            config._coerce_nonnegative_float('-0.1', {})
+        self.assertEqual(config._coerce_nonnegative_float('0', {}), 0.0)
+
+    def test_coerce_bool(self):
+        config = self.make_one({})
+        self.assertIs(config._coerce_bool('yes', {}), True)
+        self.assertIs(config._coerce_bool('0', {}), False)
+
+    def test_coerce_addresses(self):
+        config = self.make_one({})
+        self.assertEqual(config._coerce_addresses(' 127.0.0.1\n ::1 ', {}),
+                         frozenset(['127.0.0.1', '::1']))
+        self.assertEqual(config.stats_allowed_addresses, frozenset())
+
     def test_coerce_image(self):
         tmp = tempfile.NamedTemporaryFile(suffix=".jpg")
         tmp.write(u'data')
@@ -167,6 +513,14 @@ class TestConfig(unittest.TestCase):
                          StaticVideoStreamBuffer.from_settings)
         self.assertEqual(config.buffer_factory.args, (settings,))
 
+    def test_buffer_factory_static_archive(self):
+        from puppyserv.stream import StaticVideoStreamBuffer
+        settings = {'static.archive': 'loop.pup'}
+        config = self.make_one(settings)
+        self.assertEqual(config.buffer_factory.factory,
+                         StaticVideoStreamBuffer.from_settings)
+        self.assertEqual(config.buffer_factory.args, (settings,))
+
     def test_buffer_factory_stream_webcam(self):
         from puppyserv import webcam
         settings = {'webcam.foo': 'bar'}
@@ -175,6 +529,33 @@ class TestConfig(unittest.TestCase):
                          webcam.stream_buffer_from_settings)
         self.assertEqual(config.buffer_factory.args, (settings,))
 
+    def test_buffer_factory_ignores_camera_settings(self):
+        settings = {'webcam.foo': 'bar', 'webcam.front.url': 'URL'}
+        config = self.make_one(settings)
+        self.assertEqual(config.buffer_factory.args, ({'webcam.foo': 'bar'},))
+
+    def test_cameras(self):
+        from puppyserv import webcam
+        settings = {
+            'webcam.foo': 'bar',
+            'webcam.front.url': 'URL1',
+            'webcam.back.url': 'URL2',
+            'webcam.back.stop_stream_holdoff': '42',
+            }
+        config = self.make_one(settings)
+        self.assertEqual(set(config.cameras), set(['front', 'back']))
+        front = config.cameras['front']
+        self.assertIs(front['stop_stream_holdoff'], None)
+        self.assertEqual(front['buffer_factory'].factory,
+                         webcam.stream_buffer_from_settings)
+        self.assertEqual(front['buffer_factory'].args,
+                         ({'webcam.foo': 'bar', 'webcam.url': 'URL1'},))
+        self.assertEqual(front['buffer_factory'].kwargs['camera'], 'front')
+        back = config.cameras['back']
+        self.assertEqual(back['stop_stream_holdoff'], 42.0)
+        self.assertEqual(back['buffer_factory'].args,
+                         ({'webcam.foo': 'bar', 'webcam.url': 'URL2'},))
+
     def test_buffer_factory_empty_static_images_is_the_same_as_unset(self):
         from puppyserv import webcam
         settings = {'static.images': ''}
@@ -195,17 +576,20 @@ class TestFactory(unittest.TestCase):
         self.assertEqual(f.mock_calls, [call(1, b=2)])
 
 class TestBufferManager(unittest.TestCase):
-    def make_one(self, config=None, **kwargs):
+    def make_one(self, config=None, camera=None, **kwargs):
         from puppyserv.app import BufferManager
         if config is None:
             config = self.make_config(**kwargs)
-        return BufferManager(config)
+        return BufferManager(config, camera)
 
     def make_config(self, **kwargs):
         from puppyserv.stats import dummy_stream_stat_manager
         attrs = {
             'buffer_factory': Mock(name='buffer_factory', spec=()),
+            'mark_stale_frames': False,
+            'max_retained_frame_age': 3600.0,
             'max_total_framerate': 50.0,
+            'recording_directory': None,
             'stop_stream_holdoff': 15.0,
             'stream_stat_manager': dummy_stream_stat_manager,
             'timeout_image': VideoFrame(b'timed out'),
@@ -318,6 +702,138 @@ class TestBufferManager(unittest.TestCase):
             with self.assertRaises(StopIteration):
                 next(stream)
 
+    def test_client_max_rate(self):
+        manager = self.make_one(max_total_framerate=12.0)
+        self.assertEqual(manager.client_max_rate, 12.0)
+        with manager:
+            with manager:
+                self.assertEqual(manager.client_max_rate, 6.0)
+
+    def test_demand(self):
+        buffer_factory = Mock(name='buffer_factory', spec=())
+        manager = self.make_one(buffer_factory=buffer_factory,
+                                max_total_framerate=12.0,
+                                stop_stream_holdoff=0)
+        buf = buffer_factory.return_value
+        with manager:
+            self.assertEqual(buf.demand, 12.0)
+            with manager:
+                with manager:
+                    self.assertEqual(buf.demand, 4.0)
+                self.assertEqual(buf.demand, 6.0)
+
+    def test_demand_follows_client_rate(self):
+        manager = self.make_one(buffer_factory=DummyVideoBuffer(),
+                                max_total_framerate=12.0,
+                                stop_stream_holdoff=0)
+        buf = manager.buffer_factory
+        manager.time = lambda: 100
+        with manager as stream:
+            for n in range(10):
+                next(stream)
+            self.assertEqual(buf.demand, 12.0)
+            manager.time = lambda: 105
+            next(stream)
+            # 11 frames in 5 seconds, plus 50% headroom
+            self.assertAlmostEqual(buf.demand, 3.3)
+            manager.time = lambda: 110
+            next(stream)
+            self.assertEqual(buf.demand, manager.min_demand)
+            with manager:
+                # A new client gets the full rate until measured
+                self.assertEqual(buf.demand, 6.0)
+
+    def test_retains_last_frame(self):
+        from puppyserv.app import RetainedFrame
+        buffer_factory = Mock(name='buffer_factory', spec=(),
+                              side_effect=[DummyVideoBuffer([b'f1']),
+                                           DummyVideoBuffer([b'f2'])])
+        manager = self.make_one(buffer_factory=buffer_factory,
+                                stop_stream_holdoff=0)
+        with manager as stream:
+            frame = next(stream)
+            self.assertEqual(frame.image_data, b'f1')
+            first_seq = frame.seq
+        # The age is measured from when the frame was captured
+        manager.time = lambda: frame.timestamp + 42
+        with manager as stream:
+            frame = next(stream)
+            self.assertIsInstance(frame, RetainedFrame)
+            self.assertEqual(frame.image_data, b'f1')
+            self.assertEqual(frame.age, 42)
+            self.assertEqual(frame.seq, first_seq)
+            self.assertEqual(next(stream).image_data, b'f2')
+
+    def test_retained_frame_only_for_fresh_buffer(self):
+        manager = self.make_one(buffer_factory=DummyVideoBuffer(),
+                                stop_stream_holdoff=0.1)
+        with manager as stream:
+            self.assertEqual(next(stream).image_data, b'frame 1')
+        with manager as stream:
+            self.assertEqual(next(stream).image_data, b'frame 2')
+
+    def test_retained_frame_max_age(self):
+        buffer_factory = Mock(name='buffer_factory', spec=(),
+                              side_effect=[DummyVideoBuffer([b'f1']),
+                                           DummyVideoBuffer([b'f2'])])
+        manager = self.make_one(buffer_factory=buffer_factory,
+                                stop_stream_holdoff=0,
+                                max_retained_frame_age=10)
+        with manager as stream:
+            frame = next(stream)
+            self.assertEqual(frame.image_data, b'f1')
+        manager.time = lambda: frame.timestamp + 11
+        with manager as stream:
+            self.assertEqual(next(stream).image_data, b'f2')
+
+    def test_change_buffer_factory_discards_last_frame(self):
+        manager = self.make_one(buffer_factory=DummyVideoBuffer([b'f1']),
+                                stop_stream_holdoff=0)
+        with manager as stream:
+            self.assertEqual(next(stream).image_data, b'f1')
+        manager._change_buffer_factory(DummyVideoBuffer([b'f2']))
+        with manager as stream:
+            self.assertEqual(next(stream).image_data, b'f2')
+
+    def test_camera_configuration(self):
+        cameras = {
+            'front': {'buffer_factory': Mock(name='front'),
+                      'recording_directory': None,
+                      'stop_stream_holdoff': None},
+            'back': {'buffer_factory': Mock(name='back'),
+                     'recording_directory': '/var/rec/back',
+                     'stop_stream_holdoff': 42.0},
+            }
+        config = self.make_config(cameras=cameras)
+        manager = self.make_one(config, 'front')
+        self.assertIs(manager.buffer_factory,
+                      cameras['front']['buffer_factory'])
+        self.assertEqual(manager.stop_stream_holdoff, 15.0)
+        manager = self.make_one(config, 'back')
+        self.assertIs(manager.buffer_factory,
+                      cameras['back']['buffer_factory'])
+        self.assertEqual(manager.stop_stream_holdoff, 42.0)
+        self.assertEqual(manager.recording_directory, '/var/rec/back')
+
+    def test_camera_config_changed(self):
+        orig = Mock()
+        new = Mock()
+        cameras = {'front': {'buffer_factory': orig,
+                             'recording_directory': None,
+                             'stop_stream_holdoff': None}}
+        manager = self.make_one(camera='front', cameras=cameras)
+        with patch.object(manager, '_change_buffer_factory') \
+                 as change_buffer_factory:
+            manager._config_changed(Mock(cameras={}))
+            self.assertEqual(change_buffer_factory.mock_calls, [])
+            manager._config_changed(Mock(
+                cameras={'front': {'buffer_factory': new,
+                                   'recording_directory': '/rec',
+                                   'stop_stream_holdoff': 1}}))
+            self.assertEqual(change_buffer_factory.mock_calls, [call(new)])
+            self.assertEqual(manager.stop_stream_holdoff, 1)
+            self.assertEqual(manager.recording_directory, '/rec')
+
     def test_config_changed(self):
         orig = Mock()
         new = Mock()
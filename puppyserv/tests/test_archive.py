@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+from __future__ import absolute_import, division
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from puppyserv.interfaces import VideoFrame
+
+if not hasattr(unittest.TestCase, 'addCleanup'):
+    import unittest2 as unittest
+
+def make_archive(testcase, frames):
+    """ Write an archive of ``(timestamp, image_data)`` pairs.
+    """
+    from puppyserv.archive import ArchiveWriter
+    tmpfile = tempfile.NamedTemporaryFile(suffix='.pup')
+    testcase.addCleanup(tmpfile.close)
+    writer = ArchiveWriter(open(tmpfile.name, 'wb'))
+    for timestamp, image_data in frames:
+        writer.write(timestamp, VideoFrame(image_data))
+    writer.close()
+    return tmpfile.name
+
+class TestFrameArchive(unittest.TestCase):
+    def make_one(self, filename):
+        from puppyserv.archive import FrameArchive
+        archive = FrameArchive(filename)
+        self.addCleanup(archive.close)
+        return archive
+
+    def test(self):
+        archive = self.make_one(make_archive(self, [
+            (1.0, b'frame1'),
+            (2.5, b'frame2'),
+            ]))
+        self.assertEqual(len(archive), 2)
+        self.assertEqual(archive.timestamps, [1.0, 2.5])
+        frame = archive.frame(1)
+        self.assertEqual(frame.image_data, b'frame2')
+        self.assertEqual(frame.content_type, 'image/jpeg')
+        self.assertEqual(frame.timestamp, 2.5)
+
+    def test_empty(self):
+        archive = self.make_one(make_archive(self, []))
+        self.assertEqual(len(archive), 0)
+
+    def test_not_an_archive(self):
+        from puppyserv.archive import FrameArchive
+        tmpfile = tempfile.NamedTemporaryFile()
+        self.addCleanup(tmpfile.close)
+        for data in b'', b'x' * 100:
+            tmpfile.seek(0)
+            tmpfile.write(data)
+            tmpfile.flush()
+            with self.assertRaises(ValueError):
+                FrameArchive(tmpfile.name)
+
+    def test_truncated(self):
+        from puppyserv.archive import FrameArchive
+        filename = make_archive(self, [(1.0, b'frame1')])
+        with open(filename, 'r+b') as fp:
+            fp.seek(-1, os.SEEK_END)
+            fp.truncate()
+        with self.assertRaises(ValueError):
+            FrameArchive(filename)
+
+class Test_main(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.output = os.path.join(self.directory, 'out.pup')
+
+    def call_it(self, *argv):
+        from puppyserv.archive import main
+        with patch('sys.stdout'):
+            main(list(argv))
+
+    def make_image(self, name, mtime, data=None):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'wb') as fp:
+            fp.write(data or name)
+        os.utime(filename, (mtime, mtime))
+        return filename
+
+    def read_output(self):
+        from puppyserv.archive import FrameArchive
+        archive = FrameArchive(self.output)
+        self.addCleanup(archive.close)
+        return [(archive.timestamps[i], archive.frame(i).image_data)
+                for i in range(len(archive))]
+
+    def test_mtimes(self):
+        b = self.make_image('b.jpg', 1000)
+        a = self.make_image('a.jpg', 1002)
+        self.call_it(self.output, a, b)
+        self.assertEqual(self.read_output(), [(1000.0, b'b.jpg'),
+                                              (1002.0, b'a.jpg')])
+
+    def test_frame_rate(self):
+        self.make_image('b.jpg', 1000)
+        self.make_image('a.png', 1002)
+        self.make_image('notes.txt', 1001)
+        self.call_it('-r', '2', self.output, self.directory)
+        self.assertEqual(self.read_output(), [(0.0, b'a.png'),
+                                              (0.5, b'b.jpg')])
+
+    def test_unguessable_type(self):
+        noext = self.make_image('noext', 1000)
+        with patch('sys.stderr'):
+            with self.assertRaises(SystemExit):
+                self.call_it(self.output, noext)
+
+    def test_no_images(self):
+        with patch('sys.stderr'):
+            with self.assertRaises(SystemExit):
+                self.call_it(self.output)
+
+    def test_removes_partial_output(self):
+        a = self.make_image('a.jpg', 1000)
+        with patch('puppyserv.archive.ArchiveWriter.write',
+                   side_effect=IOError('disk full')):
+            with self.assertRaises(IOError):
+                self.call_it(self.output, a)
+        self.assertFalse(os.path.exists(self.output))
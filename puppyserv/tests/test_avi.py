@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+from __future__ import absolute_import, division
+
+import struct
+import unittest
+
+def make_jpeg(width=320, height=240, body=b'\x00' * 4):
+    """ Make something which looks enough like a JPEG to parse.
+    """
+    app0 = b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    sof0 = struct.pack('>BHHB', 8, height, width, 1) + b'\x01\x11\x00'
+    return b''.join([
+        b'\xff\xd8',
+        b'\xff\xe0', struct.pack('>H', len(app0) + 2), app0,
+        b'\xff\xc0', struct.pack('>H', len(sof0) + 2), sof0,
+        b'\xff\xda', body,
+        b'\xff\xd9',
+        ])
+
+class Test_jpeg_dimensions(unittest.TestCase):
+    def call_it(self, data):
+        from puppyserv.avi import jpeg_dimensions
+        return jpeg_dimensions(data)
+
+    def test(self):
+        self.assertEqual(self.call_it(make_jpeg(640, 480)), (640, 480))
+
+    def test_fill_bytes(self):
+        data = make_jpeg(640, 480)
+        data = data[:2] + b'\xff\xff' + data[2:]
+        self.assertEqual(self.call_it(data), (640, 480))
+
+    def test_not_jpeg(self):
+        self.assertIs(self.call_it(b'\x89PNG\r\n'), None)
+
+    def test_truncated(self):
+        self.assertIs(self.call_it(make_jpeg()[:20]), None)
+
+    def test_garbage(self):
+        self.assertIs(self.call_it(b'\xff\xd8junk'), None)
+
+def parse_chunks(data, pos=0, end=None):
+    """ Parse RIFF chunks into a list of (fourcc, data or list) pairs.
+    """
+    if end is None:
+        end = len(data)
+    chunks = []
+    while pos < end:
+        fourcc, size = struct.unpack_from('<4sI', data, pos)
+        pos += 8
+        if fourcc in (b'RIFF', b'LIST'):
+            list_type = data[pos:pos + 4]
+            chunks.append((fourcc + b' ' + list_type,
+                           parse_chunks(data, pos + 4, pos + size)))
+        else:
+            chunks.append((fourcc, data[pos:pos + size]))
+        pos += size + (size & 1)
+    return chunks
+
+class Test_mjpeg_avi(unittest.TestCase):
+    def call_it(self, frames, width=320, height=240, frame_rate=2.0):
+        from puppyserv.avi import mjpeg_avi
+        sizes = [len(frame) for frame in frames]
+        return b''.join(mjpeg_avi(iter(frames), sizes,
+                                  width, height, frame_rate))
+
+    def test_structure(self):
+        frames = [make_jpeg(), make_jpeg(body=b'\x01' * 5)]
+        data = self.call_it(frames)
+        riff, = parse_chunks(data)
+        self.assertEqual(riff[0], b'RIFF AVI ')
+        hdrl, movi, idx1 = riff[1]
+        self.assertEqual(hdrl[0], b'LIST hdrl')
+        self.assertEqual(movi, (b'LIST movi', [(b'00dc', frame)
+                                               for frame in frames]))
+        self.assertEqual(idx1[0], b'idx1')
+        self.assertEqual(len(idx1[1]), 32)
+
+    def test_headers(self):
+        data = self.call_it([make_jpeg()], width=640, height=480,
+                            frame_rate=4.0)
+        (avih, avih_data), (strl, ((strh, strh_data), (strf, strf_data))) \
+               = parse_chunks(data)[0][1][0][1]
+        usec_per_frame, = struct.unpack_from('<I', avih_data, 0)
+        self.assertEqual(usec_per_frame, 250000)
+        n_frames, = struct.unpack_from('<I', avih_data, 16)
+        self.assertEqual(n_frames, 1)
+        self.assertEqual(struct.unpack_from('<II', avih_data, 32), (640, 480))
+        self.assertEqual(strh_data[:8], b'vidsMJPG')
+        self.assertEqual(strf_data[16:20], b'MJPG')
+
+    def test_index(self):
+        frames = [make_jpeg(body=b'\x01'), make_jpeg()]
+        data = self.call_it(frames)
+        movi_pos = data.index(b'movi')
+        idx1 = parse_chunks(data)[0][1][2][1]
+        for n, frame in enumerate(frames):
+            fourcc, flags, offset, size = struct.unpack_from(
+                '<4sIII', idx1, n * 16)
+            self.assertEqual(fourcc, b'00dc')
+            self.assertEqual(size, len(frame))
+            chunk_pos = movi_pos + offset
+            self.assertEqual(data[chunk_pos:chunk_pos + 4], b'00dc')
+            self.assertEqual(data[chunk_pos + 8:chunk_pos + 8 + size], frame)
+
+    def test_pads_odd_frames(self):
+        frames = [b'odd', b'even']
+        data = self.call_it(frames)
+        self.assertIn(b'odd\x00', data)
+        self.assertEqual(len(data) % 2, 0)
+
+    def test_avi_size(self):
+        from puppyserv.avi import avi_size
+        for frames in [], [b'a'], [make_jpeg(), b'xyz', b'abcd']:
+            self.assertEqual(len(self.call_it(frames)),
+                             avi_size([len(frame) for frame in frames]))
+
+    def test_frames_read_lazily(self):
+        from puppyserv.avi import mjpeg_avi
+        read = []
+        def frames():
+            for n in range(3):
+                read.append(n)
+                yield b'frame'
+        chunks = mjpeg_avi(frames(), [5, 5, 5], 320, 240, 1.0)
+        next(chunks)                    # RIFF header
+        next(chunks)                    # movi list header
+        self.assertEqual(read, [])
+        next(chunks)                    # first frame chunk header
+        self.assertEqual(read, [0])
+
+    def test_frame_size_changed(self):
+        from puppyserv.avi import mjpeg_avi
+        chunks = mjpeg_avi(iter([b'abc']), [4], 320, 240, 1.0)
+        with self.assertRaises(ValueError):
+            list(chunks)
+
+    def test_frame_missing(self):
+        from puppyserv.avi import mjpeg_avi
+        chunks = mjpeg_avi(iter([b'abc']), [3, 3], 320, 240, 1.0)
+        with self.assertRaises(ValueError):
+            list(chunks)
@@ -11,6 +11,7 @@ import unittest
 
 import gevent
 from gevent.monkey import get_original
+from mock import Mock, patch
 
 if not hasattr(unittest.TestCase, 'addCleanup'):
     import unittest2 as unittest
@@ -63,6 +64,180 @@ class TestCondition(unittest.TestCase):
         map(methodcaller('join'), threads)
         self.assertEqual(result, [True, True])
 
+    def test_wakes_many_greenlets(self):
+        cond = self.make_one()
+        e = _Event(cond)
+        waiters = [gevent.spawn(e.wait, 1) for n in range(50)]
+        gevent.sleep(0.01)
+        Timer(0.01, e.set).start()
+        gevent.joinall(waiters, timeout=1)
+        self.assertEqual([w.value for w in waiters], [True] * 50)
+
+    def test_notify_after_timeout(self):
+        cond = self.make_one()
+        e = _Event(cond)
+        self.assertFalse(e.wait(0.01))
+        waiter = gevent.spawn(e.wait, 1)
+        gevent.sleep(0.01)
+        Timer(0.01, e.set).start()
+        self.assertTrue(waiter.get(timeout=1))
+
+class TestHubThread(unittest.TestCase):
+    def make_one(self, name='TestHub'):
+        from puppyserv.greenlet import HubThread
+        hub_thread = HubThread(name)
+        self.addCleanup(hub_thread.stop)
+        return hub_thread
+
+    def test_repr(self):
+        hub_thread = self.make_one()
+        self.assertEqual(repr(hub_thread), '<HubThread [TestHub]>')
+
+    def test_spawn(self):
+        hub_thread = self.make_one()
+        threads = []
+        done = hub_thread.spawn(
+            lambda: threads.append(get_original('thread', 'get_ident')()))
+        self.assertTrue(done.wait(1))
+        self.assertEqual(threads, [hub_thread.thread.ident])
+
+    def test_greenlets_are_concurrent(self):
+        hub_thread = self.make_one()
+        result = []
+        def sleeper(n):
+            gevent.sleep(0.05)
+            result.append(n)
+        t0 = time.time()
+        done = [hub_thread.spawn(sleeper, n) for n in range(10)]
+        for event in done:
+            self.assertTrue(event.wait(1))
+        self.assertLess(time.time() - t0, 0.2)
+        self.assertEqual(sorted(result), range(10))
+
+    def test_stop(self):
+        hub_thread = self.make_one()
+        hub_thread.stop()
+        hub_thread.thread.join(1)
+        self.assertFalse(hub_thread.is_alive())
+
+class Test_call_in_threadpool(unittest.TestCase):
+    def call_it(self, func, *args):
+        from puppyserv.greenlet import call_in_threadpool
+        return call_in_threadpool(func, *args)
+
+    def test(self):
+        get_ident = get_original('thread', 'get_ident')
+        self.assertNotEqual(self.call_it(get_ident), get_ident())
+        self.assertEqual(self.call_it(divmod, 7, 2), (3, 1))
+
+    def test_raises(self):
+        with self.assertRaises(ZeroDivisionError):
+            self.call_it(divmod, 1, 0)
+
+class Test_iterate_in_threadpool(unittest.TestCase):
+    def call_it(self, iterable):
+        from puppyserv.greenlet import iterate_in_threadpool
+        return iterate_in_threadpool(iterable)
+
+    def test(self):
+        get_ident = get_original('thread', 'get_ident')
+        def gen():
+            for n in range(3):
+                yield get_ident()
+        idents = list(self.call_it(gen()))
+        self.assertEqual(len(idents), 3)
+        self.assertNotIn(get_ident(), idents)
+
+    def test_close(self):
+        closed = []
+        def gen():
+            try:
+                yield 1
+                yield 2
+            finally:
+                closed.append(True)
+        it = self.call_it(gen())
+        self.assertEqual(next(it), 1)
+        it.close()
+        self.assertEqual(closed, [True])
+
+class TestHubMonitor(unittest.TestCase):
+    def make_one(self, threshold=0.05, interval=0.01, **kwargs):
+        from puppyserv.greenlet import HubMonitor
+        kwargs.setdefault('stream_stat_manager', Mock())
+        monitor = HubMonitor(threshold, interval, **kwargs)
+        self.addCleanup(monitor.close)
+        return monitor
+
+    def test_repr(self):
+        monitor = self.make_one()
+        self.assertEqual(repr(monitor), '<HubMonitor threshold=0.05>')
+
+    def test_measures_lag(self):
+        monitor = self.make_one()
+        gevent.sleep(0.05)
+        add_loop_lag = monitor.stream_stat_manager.add_loop_lag
+        self.assertGreater(len(add_loop_lag.mock_calls), 1)
+        (lag,), _ = add_loop_lag.call_args
+        self.assertGreaterEqual(lag, 0)
+
+    def test_detects_blocking(self):
+        monitor = self.make_one(threshold=0.05)
+        gevent.sleep(0.02)
+        with patch('puppyserv.greenlet.log') as log:
+            get_original('time', 'sleep')(0.2)
+            gevent.sleep(0.02)
+        monitor.stream_stat_manager.count.assert_called_once_with(
+            'hub_blocks')
+        blocked, was_blocked = log.warning.mock_calls[:2]
+        self.assertEqual(blocked[1][0], "Hub blocked for %.3fs in:\n%s")
+        self.assertIn('test_detects_blocking', blocked[1][2])
+        self.assertEqual(was_blocked[1][0], "Hub was blocked for %.3fs")
+        self.assertGreater(was_blocked[1][1], 0.15)
+        self.assertFalse(monitor.blocked)
+
+    def test_check(self):
+        monitor = self.make_one(threshold=1, interval=1)
+        monitor.close()
+        monitor.last_tick = 0
+        with patch.object(monitor, 'time', return_value=2.0):
+            monitor.check()
+            self.assertFalse(monitor.blocked)
+        with patch.object(monitor, 'time', return_value=2.5), \
+                 patch('puppyserv.greenlet.log') as log:
+            monitor.check()
+            self.assertTrue(monitor.blocked)
+            monitor.check()             # only reported once
+        self.assertEqual(len(log.warning.mock_calls), 1)
+        self.assertEqual(monitor.stream_stat_manager.count.mock_calls,
+                         [(('hub_blocks',), {})])
+
+    def test_close(self):
+        monitor = self.make_one()
+        monitor.close()
+        monitor.watchdog.join(1)
+        gevent.sleep(0)
+        self.assertFalse(monitor.watchdog.is_alive())
+        self.assertTrue(monitor.ticker.dead)
+
+class TestHubMonitor_from_settings(unittest.TestCase):
+    def call_it(self, settings):
+        from puppyserv.greenlet import HubMonitor
+        monitor = HubMonitor.from_settings(settings)
+        if monitor is not None:
+            self.addCleanup(monitor.close)
+        return monitor
+
+    def test_disabled(self):
+        self.assertIs(self.call_it({}), None)
+        self.assertIs(self.call_it({'hub_monitor.threshold': '0'}), None)
+
+    def test(self):
+        monitor = self.call_it({'hub_monitor.threshold': '0.25',
+                                'hub_monitor.interval': '0.5'})
+        self.assertEqual(monitor.threshold, 0.25)
+        self.assertEqual(monitor.interval, 0.5)
+
 class _Event(object):
     def __init__(self, cond):
         self.cond = cond
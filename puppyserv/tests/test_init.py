@@ -63,6 +63,25 @@ class Test_main(unittest.TestCase):
         (config,), _ = VideoStreamApp.call_args
         self.assertIs(config, Config.return_value)
 
+    @patch('puppyserv.HubMonitor')
+    @patch('puppyserv.VideoStreamApp')
+    @patch('puppyserv.Config')
+    def test_hub_monitor(self, Config, VideoStreamApp, HubMonitor):
+        config_uri = self.make_config('foo',
+                                      {'hub_monitor.threshold': '0.1'})
+        loadapp(config_uri, name='foo')
+        (settings,), kwargs = HubMonitor.from_settings.call_args
+        self.assertEqual(settings['hub_monitor.threshold'], '0.1')
+        self.assertEqual(kwargs, {'stream_stat_manager':
+                                  Config.return_value.stream_stat_manager})
+
+    @patch('puppyserv.HubMonitor')
+    @patch('puppyserv.VideoStreamApp', autospec=True)
+    @patch('puppyserv.Config', autospec=True)
+    def test_no_hub_monitor(self, Config, VideoStreamApp, HubMonitor):
+        loadapp(self.make_config('foo'), name='foo')
+        self.assertFalse(HubMonitor.from_settings.called)
+
 class Test_watch_config(unittest.TestCase):
     def call_it(self, config, settings, **kwargs):
         from puppyserv import _watch_config
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+from __future__ import absolute_import, division
+
+import hashlib
+import unittest
+
+from mock import patch
+
+class TestVideoFrame(unittest.TestCase):
+    def make_one(self, *args, **kwargs):
+        from puppyserv.interfaces import VideoFrame
+        return VideoFrame(*args, **kwargs)
+
+    def test_defaults(self):
+        with patch('time.time', return_value=42.0):
+            frame = self.make_one(b'data')
+        self.assertEqual(frame.image_data, b'data')
+        self.assertEqual(frame.content_type, 'image/jpeg')
+        self.assertIs(frame.part_headers, None)
+        self.assertEqual(frame.timestamp, 42.0)
+        self.assertIs(frame.source, None)
+        self.assertIs(frame.ingest_time, None)
+        self.assertIs(frame.ingest_seq, None)
+
+    def test_metadata(self):
+        frame = self.make_one(b'data', timestamp=1.5, source='http://cam/',
+                              seq=7)
+        self.assertEqual(frame.timestamp, 1.5)
+        self.assertEqual(frame.source, 'http://cam/')
+        self.assertEqual(frame.seq, 7)
+
+    def test_seq_increases(self):
+        frame1 = self.make_one(b'data')
+        frame2 = self.make_one(b'data')
+        self.assertGreater(frame2.seq, frame1.seq)
+
+    def test_digest(self):
+        frame = self.make_one(b'data')
+        self.assertEqual(frame.digest, hashlib.sha1(b'data').hexdigest())
+        frame.image_data = b'changed'   # digest is cached
+        self.assertEqual(frame.digest, hashlib.sha1(b'data').hexdigest())
+
+    def test_no_dict(self):
+        frame = self.make_one(b'data')
+        with self.assertRaises(AttributeError):
+            frame.foo = 1
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+from __future__ import absolute_import, division
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from puppyserv.interfaces import VideoFrame
+
+if not hasattr(unittest.TestCase, 'addCleanup'):
+    import unittest2 as unittest
+
+class RecorderTestBase(unittest.TestCase):
+    def make_directory(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
+class TestSegment(RecorderTestBase):
+    def make_one(self, directory=None, start=1400000000.5):
+        from puppyserv.recorder import Segment
+        if directory is None:
+            directory = self.make_directory()
+        return Segment(directory, start)
+
+    def write_frames(self, segment, frames):
+        from puppyserv.recorder import SegmentWriter
+        writer = SegmentWriter(segment)
+        for timestamp, frame in frames:
+            writer.write(timestamp, frame)
+        writer.close()
+
+    def test_paths(self):
+        segment = self.make_one('/tmp')
+        self.assertEqual(segment.data_path, '/tmp/1400000000500.seg')
+        self.assertEqual(segment.index_path, '/tmp/1400000000500.idx')
+
+    def test_frames(self):
+        segment = self.make_one()
+        self.write_frames(segment, [
+            (1.0, VideoFrame(b'frame1')),
+            (2.0, VideoFrame(b'frame2', 'image/png')),
+            ])
+        frames = [(timestamp, frame.image_data, frame.content_type)
+                  for timestamp, frame in segment.frames()]
+        self.assertEqual(frames, [(1.0, b'frame1', 'image/jpeg'),
+                                  (2.0, b'frame2', 'image/png')])
+
+    def test_read_index(self):
+        segment = self.make_one()
+        self.write_frames(segment, [(1.0, VideoFrame(b'frame1')),
+                                    (2.0, VideoFrame(b'frame2'))])
+        index = segment.read_index()
+        self.assertEqual([timestamp for timestamp, offset in index],
+                         [1.0, 2.0])
+        self.assertEqual(index[0][1], 0)
+
+    def test_read_index_ignores_partial_entry(self):
+        segment = self.make_one()
+        self.write_frames(segment, [(1.0, VideoFrame(b'frame1'))])
+        with open(segment.index_path, 'ab') as fp:
+            fp.write(b'\0' * 3)
+        self.assertEqual(len(segment.read_index()), 1)
+
+    def test_missing_files(self):
+        segment = self.make_one()
+        self.assertEqual(segment.read_index(), [])
+        self.assertEqual(segment.size, 0)
+        self.assertEqual(segment.end, segment.start)
+        segment.remove()
+
+    def test_size_and_end(self):
+        segment = self.make_one()
+        self.write_frames(segment, [(5.0, VideoFrame(b'frame1'))])
+        self.assertEqual(segment.end, 5.0)
+        self.assertEqual(segment.size, os.path.getsize(segment.data_path)
+                         + os.path.getsize(segment.index_path))
+
+    def test_remove(self):
+        segment = self.make_one()
+        self.write_frames(segment, [(5.0, VideoFrame(b'frame1'))])
+        segment.remove()
+        self.assertFalse(os.path.exists(segment.data_path))
+        self.assertFalse(os.path.exists(segment.index_path))
+
+class Test_list_segments(RecorderTestBase):
+    def call_it(self, directory):
+        from puppyserv.recorder import list_segments
+        return list_segments(directory)
+
+    def test(self):
+        directory = self.make_directory()
+        for name in '0000000002000.seg', '0000000001000.seg', 'junk.seg':
+            open(os.path.join(directory, name), 'wb').close()
+        self.assertEqual([segment.start
+                          for segment in self.call_it(directory)],
+                         [1.0, 2.0])
+
+class TestFrameRecorder(RecorderTestBase):
+    def setUp(self):
+        self.t = 1000.0
+
+    def time(self):
+        return self.t
+
+    def make_one(self, directory=None, **kwargs):
+        from puppyserv.recorder import FrameRecorder
+        if directory is None:
+            directory = self.make_directory()
+        recorder = FrameRecorder(directory, **kwargs)
+        recorder.time = self.time
+        self.addCleanup(recorder.close)
+        return recorder
+
+    def recorded(self, recorder):
+        from puppyserv.recorder import list_segments
+        return [[(timestamp, frame.image_data)
+                 for timestamp, frame in segment.frames()]
+                for segment in list_segments(recorder.directory)]
+
+    def stop(self, recorder):
+        recorder.close()
+        recorder.thread.join(5)
+        self.assertFalse(recorder.thread.is_alive())
+
+    def test_creates_directory(self):
+        directory = os.path.join(self.make_directory(), 'a', 'b')
+        self.make_one(directory)
+        self.assertTrue(os.path.isdir(directory))
+
+    def test_record(self):
+        recorder = self.make_one()
+        recorder.record(VideoFrame(b'frame1'))
+        self.t += 1
+        recorder.record(VideoFrame(b'frame2'))
+        self.stop(recorder)
+        self.assertEqual(self.recorded(recorder),
+                         [[(1000.0, b'frame1'), (1001.0, b'frame2')]])
+
+    def test_ignores_frames_after_close(self):
+        recorder = self.make_one()
+        self.stop(recorder)
+        recorder.record(VideoFrame(b'frame1'))
+        self.assertEqual(self.recorded(recorder), [])
+
+    def test_segment_duration(self):
+        recorder = self.make_one(segment_duration=10)
+        for n in range(4):
+            recorder.record(VideoFrame(b'frame%d' % n))
+            self.t += 5
+        self.stop(recorder)
+        self.assertEqual(self.recorded(recorder), [
+            [(1000.0, b'frame0'), (1005.0, b'frame1')],
+            [(1010.0, b'frame2'), (1015.0, b'frame3')],
+            ])
+
+    def test_segment_size(self):
+        recorder = self.make_one(segment_size=1)
+        for n in range(2):
+            recorder.record(VideoFrame(b'frame%d' % n))
+            self.t += 1
+        self.stop(recorder)
+        self.assertEqual(len(self.recorded(recorder)), 2)
+
+    def test_max_age(self):
+        recorder = self.make_one(segment_duration=10, max_age=15)
+        for n in range(6):
+            recorder.record(VideoFrame(b'frame%d' % n))
+            self.t += 5
+        self.stop(recorder)
+        self.assertEqual(self.recorded(recorder), [
+            [(1010.0, b'frame2'), (1015.0, b'frame3')],
+            [(1020.0, b'frame4'), (1025.0, b'frame5')],
+            ])
+
+    def test_max_size(self):
+        recorder = self.make_one(segment_duration=10, max_size=1)
+        for n in range(6):
+            recorder.record(VideoFrame(b'frame%d' % n))
+            self.t += 5
+        self.stop(recorder)
+        # The current segment is never deleted
+        self.assertEqual(self.recorded(recorder), [
+            [(1020.0, b'frame4'), (1025.0, b'frame5')],
+            ])
+
+    def test_drops_frames_if_queue_full(self):
+        recorder = self.make_one(max_queue=0)
+        recorder.record(VideoFrame(b'frame1'))
+        self.assertEqual(recorder.n_dropped, 1)
+        self.stop(recorder)
+        self.assertEqual(self.recorded(recorder), [])
+
+    def test_from_settings(self):
+        from puppyserv.recorder import FrameRecorder
+        directory = self.make_directory()
+        recorder = FrameRecorder.from_settings({
+            'webcam.record.directory': directory,
+            'webcam.record.segment_duration': '30',
+            'webcam.record.max_size': '1000000',
+            'webcam.record.max_age': '3600',
+            }, camera='front')
+        self.addCleanup(recorder.close)
+        self.assertEqual(recorder.directory, os.path.join(directory, 'front'))
+        self.assertEqual(recorder.segment_duration, 30.0)
+        self.assertEqual(recorder.max_size, 1000000)
+        self.assertEqual(recorder.max_age, 3600.0)
+
+    def test_from_settings_not_configured(self):
+        from puppyserv.recorder import FrameRecorder
+        self.assertIs(FrameRecorder.from_settings({}), None)
+
+def write_frames(directory, start, frames):
+    from puppyserv.recorder import Segment, SegmentWriter
+    segment = Segment(directory, start)
+    writer = SegmentWriter(segment)
+    for timestamp, image_data in frames:
+        writer.write(timestamp, VideoFrame(image_data))
+    writer.close()
+    return segment
+
+class TestSegmentReader(RecorderTestBase):
+    def make_one(self, segment):
+        from puppyserv.recorder import SegmentReader
+        reader = SegmentReader(segment)
+        self.addCleanup(reader.close)
+        return reader
+
+    def test_frame(self):
+        segment = write_frames(self.make_directory(), 1.0,
+                               [(1.0, b'frame1'), (2.0, b'frame2')])
+        reader = self.make_one(segment)
+        self.assertEqual(len(reader), 2)
+        frame = reader.frame(1)
+        self.assertEqual(frame.image_data, b'frame2')
+        self.assertEqual(frame.content_type, 'image/jpeg')
+        self.assertEqual(frame.timestamp, 2.0)
+
+    def test_find(self):
+        segment = write_frames(self.make_directory(), 1.0,
+                               [(1.0, b'frame1'), (2.0, b'frame2')])
+        reader = self.make_one(segment)
+        self.assertEqual(reader.find(0.0), 0)
+        self.assertEqual(reader.find(1.5), 1)
+        self.assertEqual(reader.find(2.0), 1)
+        self.assertEqual(reader.find(3.0), 2)
+
+    def test_refresh(self):
+        from puppyserv.recorder import Segment, SegmentWriter
+        segment = Segment(self.make_directory(), 1.0)
+        writer = SegmentWriter(segment)
+        self.addCleanup(writer.close)
+        writer.write(1.0, VideoFrame(b'frame1'))
+        writer.flush()
+        reader = self.make_one(segment)
+        self.assertEqual(reader.frame(0).image_data, b'frame1')
+        writer.write(2.0, VideoFrame(b'frame2'))
+        writer.flush()
+        self.assertEqual(len(reader), 1)
+        reader.refresh()
+        self.assertEqual(len(reader), 2)
+        self.assertEqual(reader.frame(1).image_data, b'frame2')
+
+class TestRecording(RecorderTestBase):
+    def make_one(self, directory):
+        from puppyserv.recorder import Recording
+        recording = Recording(directory)
+        recording.sleep = self.sleep
+        self.sleeps = []
+        self.on_sleep = []
+        return recording
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        if not self.on_sleep:
+            raise AssertionError("Unexpected sleep")
+        self.on_sleep.pop(0)()
+
+    def replay(self, recording, start, follow=False, n=None):
+        frames = recording.frames(start, follow=follow)
+        if n is not None:
+            frames = [next(frames) for i in range(n)]
+        return [(frame.timestamp, frame.image_data) for frame in frames]
+
+    def test_empty(self):
+        recording = self.make_one(self.make_directory())
+        self.assertEqual(self.replay(recording, 0.0), [])
+
+    def test_frames(self):
+        directory = self.make_directory()
+        write_frames(directory, 1.0, [(1.0, b'frame1'), (2.0, b'frame2')])
+        write_frames(directory, 3.0, [(3.0, b'frame3'), (4.0, b'frame4')])
+        recording = self.make_one(directory)
+        self.assertEqual(self.replay(recording, 0.0), [
+            (1.0, b'frame1'), (2.0, b'frame2'),
+            (3.0, b'frame3'), (4.0, b'frame4'),
+            ])
+        self.assertEqual(self.replay(recording, 2.0), [
+            (2.0, b'frame2'), (3.0, b'frame3'), (4.0, b'frame4'),
+            ])
+        self.assertEqual(self.replay(recording, 3.5), [(4.0, b'frame4')])
+        self.assertEqual(self.replay(recording, 5.0), [])
+
+    def test_skips_deleted_segment(self):
+        directory = self.make_directory()
+        write_frames(directory, 1.0, [(1.0, b'frame1')])
+        expired = write_frames(directory, 2.0, [(2.0, b'frame2')])
+        write_frames(directory, 3.0, [(3.0, b'frame3')])
+        recording = self.make_one(directory)
+        frames = recording.frames(0.0, follow=False)
+        self.assertEqual(next(frames).image_data, b'frame1')
+        # Expiry in progress
+        os.unlink(expired.index_path)
+        self.assertEqual(next(frames).image_data, b'frame3')
+
+    def test_file_io_off_hub(self):
+        from puppyserv.greenlet import call_in_threadpool
+        directory = self.make_directory()
+        write_frames(directory, 1.0, [(1.0, b'frame1')])
+        write_frames(directory, 2.0, [(2.0, b'frame2')])
+        recording = self.make_one(directory)
+        calls = []
+        def call(func, *args):
+            calls.append(getattr(func, '__name__', func))
+            return call_in_threadpool(func, *args)
+        recording.call_in_threadpool = call
+        self.assertEqual(len(self.replay(recording, 0.0)), 2)
+        self.assertEqual(calls, ['list_segments', '_open_reader',
+                                 '_next_reader', '_next_reader'])
+
+    def test_follow(self):
+        directory = self.make_directory()
+        write_frames(directory, 1.0, [(1.0, b'frame1')])
+        recording = self.make_one(directory)
+        self.on_sleep.append(
+            lambda: write_frames(directory, 2.0, [(2.0, b'frame2')]))
+        self.assertEqual(self.replay(recording, 0.0, follow=True, n=2),
+                         [(1.0, b'frame1'), (2.0, b'frame2')])
+        self.assertEqual(self.sleeps, [0.5])
+
+    def test_follow_waits_for_recording(self):
+        directory = self.make_directory()
+        recording = self.make_one(directory)
+        self.on_sleep.append(
+            lambda: write_frames(directory, 1.0, [(1.0, b'frame1')]))
+        self.assertEqual(self.replay(recording, 0.0, follow=True, n=1),
+                         [(1.0, b'frame1')])
+
+class TestClip(RecorderTestBase):
+    def make_one(self, directory, start, end):
+        from puppyserv.recorder import Clip
+        return Clip(directory, start, end)
+
+    def make_recording(self):
+        directory = self.make_directory()
+        write_frames(directory, 1.0, [(1.0, b'frame1'), (2.0, b'frame2')])
+        write_frames(directory, 3.0, [(3.0, b'frame3'), (4.0, b'frame4')])
+        write_frames(directory, 5.0, [(5.0, b'frame5')])
+        return directory
+
+    def test_frames(self):
+        clip = self.make_one(self.make_recording(), 2.0, 4.5)
+        self.assertEqual(len(clip), 3)
+        self.assertEqual([frame.image_data for frame in clip.frames()],
+                         [b'frame2', b'frame3', b'frame4'])
+        self.assertEqual(len(clip.ranges), 2)
+
+    def test_frame_infos(self):
+        clip = self.make_one(self.make_recording(), 4.0, 6.0)
+        self.assertEqual(list(clip.frame_infos()),
+                         [(4.0, 'image/jpeg', 6), (5.0, 'image/jpeg', 6)])
+
+    def test_empty(self):
+        clip = self.make_one(self.make_recording(), 5.5, 10.0)
+        self.assertEqual(len(clip), 0)
+        self.assertEqual(list(clip.frames()), [])
+
+    def test_opens_one_segment_at_a_time(self):
+        from puppyserv import recorder
+        clip = self.make_one(self.make_recording(), 0.0, 10.0)
+        opened = []
+        def open_reader(segment):
+            self.assertFalse([reader for reader in opened
+                              if reader.map is not None
+                              or not reader.data_fp.closed])
+            reader = recorder.SegmentReader(segment)
+            opened.append(reader)
+            return reader
+        with patch.object(recorder, '_open_reader', open_reader):
+            self.assertEqual(len(list(clip.frames())), 5)
+        self.assertEqual(len(opened), 3)
+        self.assertTrue(all(reader.data_fp.closed for reader in opened))
+
+    def test_closing_frames_closes_segment(self):
+        from puppyserv import recorder
+        clip = self.make_one(self.make_recording(), 0.0, 10.0)
+        opened = []
+        def open_reader(segment):
+            opened.append(recorder.SegmentReader(segment))
+            return opened[-1]
+        with patch.object(recorder, '_open_reader', open_reader):
+            frames = clip.frames()
+            next(frames)
+            frames.close()
+        reader, = opened
+        self.assertTrue(reader.data_fp.closed)
+
+    def test_skips_expired_segments(self):
+        from puppyserv.recorder import list_segments
+        directory = self.make_recording()
+        clip = self.make_one(directory, 0.0, 10.0)
+        list_segments(directory)[1].remove()
+        self.assertEqual([frame.image_data for frame in clip.frames()],
+                         [b'frame1', b'frame2', b'frame5'])
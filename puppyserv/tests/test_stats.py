@@ -7,7 +7,7 @@ import unittest
 
 import gevent
 
-from mock import call, patch
+from mock import Mock, call, patch
 
 from puppyserv.interfaces import VideoFrame
 
@@ -24,6 +24,23 @@ class Test_dummy_stream_stat_manager(unittest.TestCase):
         with self.call_it(stream) as wrapped:
             self.assertEqual(list(wrapped), [0,1,2,3])
 
+    def test_record(self):
+        with self.call_it([]) as wrapped:
+            wrapped.record(VideoFrame(b'data'))
+
+    def test_for_camera(self):
+        from puppyserv.stats import dummy_stream_stat_manager
+        self.assertIs(dummy_stream_stat_manager.for_camera('front'),
+                      dummy_stream_stat_manager)
+
+    def test_count(self):
+        from puppyserv.stats import dummy_stream_stat_manager
+        dummy_stream_stat_manager.count('failovers')
+
+    def test_add_loop_lag(self):
+        from puppyserv.stats import dummy_stream_stat_manager
+        dummy_stream_stat_manager.add_loop_lag(0.1)
+
 class TestStreamStatManager(unittest.TestCase):
     def make_one(self, **kwargs):
         from puppyserv.stats import StreamStatManager
@@ -44,6 +61,30 @@ class TestStreamStatManager(unittest.TestCase):
         with manager(stream) as monitored:
             self.assertEqual(monitored.stream_name, repr((1,)))
 
+    def test_camera(self):
+        manager = self.make_one()
+        with manager([], 'NAME', camera='front') as monitored:
+            self.assertEqual(monitored.camera, 'front')
+            self.assertEqual(monitored.label, 'front:NAME')
+
+    def test_for_camera(self):
+        manager = self.make_one()
+        camera_manager = manager.for_camera('front')
+        with camera_manager([], 'NAME') as monitored:
+            self.assertEqual(monitored.camera, 'front')
+            self.assertIn(monitored, manager.streams)
+        self.assertNotIn(monitored, manager.streams)
+
+    def test_count(self):
+        manager = self.make_one()
+        manager.count('failovers')
+        manager.count('failovers', 2)
+        manager.for_camera('front').count('failovers')
+        self.assertEqual(manager.counters, {
+            ('', 'failovers'): 3,
+            ('front', 'failovers'): 1,
+            })
+
     def test_log_stats(self):
         # not a real test yet, but here for coverage
         manager = self.make_one()
@@ -51,6 +92,262 @@ class TestStreamStatManager(unittest.TestCase):
         with manager([], 'NAME') as monitored:
             manager.log_stats()        # with streams
 
+    def test_log_stats_summarizes(self):
+        manager = self.make_one(top_streams=2)
+        clients = []
+        with patch('puppyserv.stats.StatMonitoredStream.time',
+                   return_value=0.0):
+            for n in range(3):
+                context = manager([], '> %d' % n)
+                clients.append(context.__enter__())
+                self.addCleanup(context.__exit__, None, None, None)
+        for n, client in enumerate(clients):
+            for i in range(n + 1):
+                client.record(VideoFrame(b'data'))
+        with patch('puppyserv.stats.StatMonitoredStream.time',
+                   return_value=1.0):
+            with patch('puppyserv.stats.log') as log:
+                manager.log_stats()
+        summary, busiest = log.info.mock_calls
+        self.assertEqual(summary, call(
+            u"%s:\n %s", 'Current streams',
+            u"client           :     3 streams,    6.00 f/s,   24 B/s;"
+            u" per stream 1.00/2.00/3.00 f/s"))
+        name, args, kwargs = busiest
+        self.assertEqual(args[:4], (u"%s: busiest %d of %d:\n %s",
+                                    'Current streams', 2, 3))
+        self.assertEqual([line.split(':')[0].strip()
+                          for line in args[4].split('\n')],
+                         [u"> 2", u"> 1"])
+        for client in clients:
+            self.assertEqual(client.d_frames, 0)
+
+    def test_log_stats_groups_by_camera_and_role(self):
+        manager = self.make_one(top_streams=0)
+        with manager([], 'a', camera='front', role='ingest'):
+            with manager([], 'b', camera='front'):
+                with patch('puppyserv.stats.log') as log:
+                    manager.log_stats()
+        summary, = log.info.mock_calls
+        lines = summary[1][2].split(u'\n ')
+        self.assertEqual([line.split()[0] for line in lines],
+                         [u'front:client', u'front:ingest'])
+
+    def test_log_stats_logs_counters(self):
+        manager = self.make_one()
+        manager.for_camera('front').count('failovers')
+        with patch('puppyserv.stats.log') as log:
+            manager.log_stats()
+        self.assertEqual(log.info.mock_calls, [
+            call(u"%s: %s", 'Current streams', u"front:failovers=1")])
+
+    def test_role(self):
+        manager = self.make_one()
+        with manager.for_camera('front')([], 'NAME', role='ingest') \
+                 as monitored:
+            self.assertEqual(monitored.role, 'ingest')
+        with manager([], 'NAME') as monitored:
+            self.assertEqual(monitored.role, 'client')
+
+    def test_totals(self):
+        manager = self.make_one()
+        with manager([VideoFrame(b'data')] * 3, 'NAME') as monitored:
+            list(monitored)
+        with manager([VideoFrame(b'data')], 'NAME') as monitored:
+            list(monitored)
+        self.assertEqual(manager.totals, {('', 'client'): (4, 16)})
+
+    def test_status(self):
+        def frame(ingest_seq):
+            frame = VideoFrame(b'data', source='http://cam/')
+            frame.ingest_seq = ingest_seq
+            frame.ingest_time = 100.0 + ingest_seq
+            return frame
+        manager = self.make_one()
+        manager.for_camera('front').count('failovers')
+        limiter = Mock(max_rate=2.5)
+        ingest_frames = [frame(n) for n in range(5)]
+        with manager(iter(ingest_frames), '< video', camera='front',
+                     role='ingest', buffer=[1, 2]) as ingest:
+            with manager(iter(ingest_frames[0:5:2]), '> client',
+                         camera='front', client='10.0.0.1',
+                         limiter=limiter) as client:
+                list(ingest)
+                next(client)
+                next(client)
+                status = manager.status()
+        self.assertEqual(status['counters'], {'front': {'failovers': 1}})
+        ingest_status, = status['ingest']
+        self.assertEqual(ingest_status['name'], '< video')
+        self.assertEqual(ingest_status['camera'], 'front')
+        self.assertEqual(ingest_status['frames'], 5)
+        self.assertEqual(ingest_status['source'], 'http://cam/')
+        self.assertEqual(ingest_status['buffered_frames'], 2)
+        self.assertEqual(ingest_status['last_frame_at'], 104.0)
+        client_status, = status['clients']
+        self.assertEqual(client_status['client'], '10.0.0.1')
+        self.assertEqual(client_status['role'], 'client')
+        self.assertEqual(client_status['frames'], 2)
+        self.assertEqual(client_status['dropped_frames'], 1)
+        self.assertEqual(client_status['max_rate'], 2.5)
+        self.assertEqual(client_status['lag_frames'], 2)
+        self.assertEqual(client_status['lag_seconds'], 2.0)
+
+    def test_status_does_not_reset_rates(self):
+        manager = self.make_one()
+        with manager([VideoFrame(b'data')], 'NAME') as monitored:
+            next(monitored)
+            manager.status()
+            self.assertEqual(monitored.d_frames, 1)
+
+    def test_sample(self):
+        manager = self.make_one(series_lengths=[('second', 1, 10)])
+        manager.sample(t=100.0)
+        with manager([VideoFrame(b'data')] * 3, '< video',
+                     role='ingest') as ingest:
+            list(ingest)
+            with manager([VideoFrame(b'xx')] * 2, '> client') as client:
+                next(client)
+                manager.count('frames_dropped', 2)
+                manager.sample(t=101.0)
+                next(client)
+        manager.sample(t=102.0)
+        series = manager.series['second'].query(t=102.5)
+        self.assertEqual(series['time'], [100, 101, 102])
+        self.assertEqual(series['viewers'], [0, 1, 0])
+        self.assertEqual(series['egress_bytes'], [0, 2, 2])
+        self.assertEqual(series['delivered_fps'], [0.0, 1.0, 1.0])
+        self.assertEqual(series['ingest_fps'], [0.0, 3.0, 0.0])
+        self.assertEqual(series['dropped_fps'], [0.0, 2.0, 0.0])
+
+    def test_sampler(self):
+        manager = self.make_one(sample_interval=0.01)
+        with patch.object(manager, 'sample') as sample:
+            gevent.sleep(0.025)
+        self.assertEqual(sample.mock_calls, [call(), call()])
+
+    def test_metrics(self):
+        manager = self.make_one()
+        manager.for_camera('front').count('failovers')
+        manager.count('clips', 2)
+        with manager([VideoFrame(b'data')], 'old') as monitored:
+            list(monitored)
+        buffer = [1, 2, 3]
+        with manager([VideoFrame(b'data')] * 2, 'NAME', camera='front',
+                     role='ingest', buffer=buffer) as monitored:
+            with manager([VideoFrame(b'xx')] * 2, 'client') as client:
+                next(monitored)
+                next(client)
+                client.stats()          # resets
+                next(client)
+                lines = manager.metrics().splitlines()
+        self.assertIn(u'# TYPE puppyserv_streams gauge', lines)
+        self.assertIn(u'puppyserv_streams{camera="",role="client"} 1', lines)
+        self.assertIn(u'puppyserv_streams{camera="front",role="ingest"} 1',
+                      lines)
+        self.assertIn(u'# TYPE puppyserv_frames_total counter', lines)
+        self.assertIn(u'puppyserv_frames_total{camera="",role="client"} 3',
+                      lines)
+        self.assertIn(
+            u'puppyserv_frames_total{camera="front",role="ingest"} 1', lines)
+        self.assertIn(u'puppyserv_bytes_total{camera="",role="client"} 8',
+                      lines)
+        self.assertIn(u'puppyserv_buffered_frames{camera="front"} 3', lines)
+        self.assertIn(u'# TYPE puppyserv_failovers_total counter', lines)
+        self.assertIn(u'puppyserv_failovers_total{camera="front"} 1', lines)
+        self.assertIn(u'puppyserv_clips_total{camera=""} 2', lines)
+
+    def test_metrics_after_streams_terminate(self):
+        manager = self.make_one()
+        with manager([VideoFrame(b'data')], 'NAME') as monitored:
+            list(monitored)
+        lines = manager.metrics().splitlines()
+        self.assertIn(u'puppyserv_streams{camera="",role="client"} 0', lines)
+        self.assertIn(u'puppyserv_frames_total{camera="",role="client"} 1',
+                      lines)
+
+    def test_metrics_escapes_labels(self):
+        manager = self.make_one()
+        manager.for_camera(u'a"b\\c').count('failovers')
+        self.assertIn(u'puppyserv_failovers_total{camera="a\\"b\\\\c"} 1',
+                      manager.metrics().splitlines())
+
+    def make_frame(self, ingest_time, image_data=b'data'):
+        frame = VideoFrame(image_data)
+        frame.ingest_time = ingest_time
+        return frame
+
+    def test_latency(self):
+        manager = self.make_one()
+        with patch('puppyserv.stats.StatMonitoredStream.time',
+                   return_value=1.0):
+            with manager([self.make_frame(0.999)], 'old') as monitored:
+                list(monitored)
+            with manager([self.make_frame(0.5)], 'NAME',
+                         camera='front') as monitored:
+                list(monitored)
+                with manager([self.make_frame(0.0)], 'ingest',
+                             role='ingest') as ingest:
+                    list(ingest)
+                latency = manager.latency()
+        self.assertEqual(sorted(latency), ['', 'front'])
+        self.assertEqual(latency[''].count, 1)
+        self.assertEqual(latency['front'].count, 1)
+        self.assertEqual(latency['front'].quantile(0.5), 0.512)
+        self.assertEqual(manager.latency_totals['front'].count, 1)
+
+    def test_metrics_latency(self):
+        manager = self.make_one()
+        with patch('puppyserv.stats.StatMonitoredStream.time',
+                   return_value=1.0):
+            with manager([self.make_frame(0.9995)] * 2, 'NAME') as monitored:
+                list(monitored)
+        lines = manager.metrics().splitlines()
+        self.assertIn(u'# TYPE puppyserv_frame_latency_seconds histogram',
+                      lines)
+        self.assertIn(u'puppyserv_frame_latency_seconds_bucket'
+                      u'{camera="",le="0.001"} 2', lines)
+        self.assertIn(u'puppyserv_frame_latency_seconds_bucket'
+                      u'{camera="",le="+Inf"} 2', lines)
+        self.assertIn(u'puppyserv_frame_latency_seconds_count{camera=""} 2',
+                      lines)
+
+    def test_log_stats_logs_latency(self):
+        manager = self.make_one()
+        with patch('puppyserv.stats.StatMonitoredStream.time',
+                   return_value=1.0):
+            with manager([self.make_frame(0.9)], 'NAME') as monitored:
+                list(monitored)
+        with patch('puppyserv.stats.log') as log:
+            manager.log_stats()
+        self.assertEqual(log.info.mock_calls, [
+            call(u"%s: %s", 'Current streams',
+                 u"frame latency: p50 128ms p90 128ms p99 128ms (1 frames)"),
+            ])
+
+    def test_loop_lag(self):
+        manager = self.make_one()
+        manager.add_loop_lag(0.0015)
+        lines = manager.metrics().splitlines()
+        self.assertIn(u'# TYPE puppyserv_loop_lag_seconds histogram', lines)
+        self.assertIn(u'puppyserv_loop_lag_seconds_bucket{le="0.001"} 0',
+                      lines)
+        self.assertIn(u'puppyserv_loop_lag_seconds_bucket{le="0.002"} 1',
+                      lines)
+        self.assertIn(u'puppyserv_loop_lag_seconds_count 1', lines)
+        with patch('puppyserv.stats.log') as log:
+            manager.log_stats()
+        self.assertEqual(log.info.mock_calls, [
+            call(u"%s: %s", 'Current streams',
+                 u"loop lag: p50 2ms p90 2ms p99 2ms (1 samples)"),
+            ])
+
+    def test_metrics_without_loop_lag(self):
+        manager = self.make_one()
+        lines = manager.metrics().splitlines()
+        self.assertFalse([line for line in lines
+                          if line.startswith(u'puppyserv_loop_lag')])
+
     def test_logger(self):
         manager = self.make_one(log_interval=0.1)
         with patch.object(manager, 'log_stats') as log_stats:
@@ -100,6 +397,67 @@ class TestStatMonitoredStream(unittest.TestCase):
         self.assertEqual(monitored.d_frames, 2)
         self.assertEqual(monitored.d_bytes, 13)
 
+    def test_record(self):
+        monitored = self.make_one([], 'NAME')
+        monitored.record(VideoFrame(b'data'))
+        monitored.record(None)
+        self.assertEqual(monitored.d_frames, 1)
+        self.assertEqual(monitored.d_bytes, 4)
+
+    def test_no_dict(self):
+        monitored = self.make_one([], 'NAME')
+        with self.assertRaises(AttributeError):
+            monitored.foo = 1
+
+    def test_current_rates(self):
+        monitored = self.make_one([VideoFrame(b'data')] * 2, 'NAME')
+        list(monitored)
+        self.t = 4
+        self.assertEqual(monitored.current_rates(), (0.5, 2.0))
+        self.assertEqual(monitored.current_rates(t=2), (1.0, 4.0))
+
+    def test_next_measures_latency(self):
+        frame = VideoFrame(b'data')
+        frame.ingest_time = -0.1
+        stream = [VideoFrame(b'data'), frame]
+        monitored = self.make_one(stream, 'NAME')
+        list(monitored)
+        self.assertEqual(monitored.latency.count, 1)
+        self.assertAlmostEqual(monitored.latency.sum, 0.1)
+
+    def test_ingest_streams_do_not_measure_latency(self):
+        from puppyserv.stats import StatMonitoredStream
+        monitored = StatMonitoredStream([], 'NAME', role='ingest')
+        self.assertIs(monitored.latency, None)
+        self.assertEqual(monitored.stats("{latency_p50}"), u'-')
+
+    def test_stats_latency(self):
+        frame = VideoFrame(b'data')
+        frame.ingest_time = -0.003
+        monitored = self.make_one([frame], 'NAME')
+        list(monitored)
+        self.assertEqual(monitored.stats("{latency_p50} {latency_p99}"),
+                         u'4ms 4ms')
+
+    def test_next_counts_dropped_frames(self):
+        def frame(ingest_seq, source='a'):
+            frame = VideoFrame(b'data', source=source)
+            frame.ingest_seq = ingest_seq
+            return frame
+        stream = [frame(3), frame(4), frame(7), frame(0, 'b'), frame(2, 'b'),
+                  VideoFrame(b'retained'), frame(5, 'b')]
+        monitored = self.make_one(stream, 'NAME')
+        list(monitored)
+        self.assertEqual(monitored.dropped, 3)
+
+    def test_status_without_frames(self):
+        monitored = self.make_one([], 'NAME')
+        status = monitored.status()
+        self.assertEqual(status['frames'], 0)
+        self.assertIs(status['client'], None)
+        self.assertIs(status['max_rate'], None)
+        self.assertIs(status['lag_frames'], None)
+
     def test_stats(self):
         stream = [VideoFrame(b'data' * 4)]
         monitored = self.make_one(stream, 'NAME')
@@ -146,6 +504,100 @@ class TestStatMonitoredStream(unittest.TestCase):
         self.assertEqual(monitored.d_frames, 0)
         self.assertEqual(monitored.d_bytes, 0)
 
+class TestHistogram(unittest.TestCase):
+    def make_one(self, bounds=(1, 2, 4)):
+        from puppyserv.stats import Histogram
+        return Histogram(list(bounds))
+
+    def test_add(self):
+        histogram = self.make_one()
+        for value in 0.5, 1, 1.5, 4, 5, 6:
+            histogram.add(value)
+        self.assertEqual(histogram.counts, [2, 1, 1, 2])
+        self.assertEqual(histogram.count, 6)
+        self.assertEqual(histogram.sum, 18.0)
+
+    def test_merge(self):
+        histogram = self.make_one()
+        histogram.add(1)
+        other = self.make_one()
+        other.add(3)
+        other.add(1)
+        histogram.merge(other)
+        self.assertEqual(histogram.counts, [2, 0, 1, 0])
+        self.assertEqual(histogram.count, 3)
+        self.assertEqual(histogram.sum, 5.0)
+
+    def test_quantile(self):
+        histogram = self.make_one()
+        self.assertIs(histogram.quantile(0.5), None)
+        for value in 0.5, 1.5, 3, 3:
+            histogram.add(value)
+        self.assertEqual(histogram.quantile(0.25), 1)
+        self.assertEqual(histogram.quantile(0.5), 2)
+        self.assertEqual(histogram.quantile(0.99), 4)
+        histogram.add(10)
+        self.assertEqual(histogram.quantile(0.99), float('inf'))
+
+    def test_default_bounds(self):
+        from puppyserv.stats import Histogram
+        histogram = Histogram()
+        self.assertEqual(histogram.bounds[0], 0.001)
+        self.assertEqual(histogram.bounds[-1], 65.536)
+
+class TestTimeSeries(unittest.TestCase):
+    def make_one(self, interval=10, length=3):
+        from puppyserv.stats import TimeSeries
+        return TimeSeries(interval, length)
+
+    def test_add(self):
+        series = self.make_one()
+        series.add(100, 2, egress_bytes=10, delivered_frames=5)
+        series.add(105, 1, egress_bytes=10, ingest_frames=20,
+                   dropped_frames=1)
+        series.add(110, 3, delivered_frames=10)
+        result = series.query(t=115)
+        self.assertEqual(result['interval'], 10)
+        self.assertEqual(result['time'], [100, 110])
+        self.assertEqual(result['viewers'], [2, 3])
+        self.assertEqual(result['egress_bytes'], [20, 0])
+        self.assertEqual(result['delivered_fps'], [0.5, 1.0])
+        self.assertEqual(result['ingest_fps'], [2.0, 0.0])
+        self.assertEqual(result['dropped_fps'], [0.1, 0.0])
+
+    def test_wraps(self):
+        series = self.make_one()
+        for t in range(0, 50, 10):
+            series.add(t, t)
+        self.assertEqual(len(series.slots), 3)
+        result = series.query(t=45)
+        self.assertEqual(result['time'], [20, 30, 40])
+        self.assertEqual(result['viewers'], [20, 30, 40])
+
+    def test_query_skips_stale_slots(self):
+        series = self.make_one()
+        series.add(0, 1)
+        self.assertEqual(series.query(t=5)['time'], [0])
+        self.assertEqual(series.query(t=25)['time'], [0])
+        self.assertEqual(series.query(t=35)['time'], [])
+
+    def test_query_since(self):
+        series = self.make_one()
+        for t in range(0, 30, 10):
+            series.add(t, 1)
+        self.assertEqual(series.query(since=15, t=25)['time'], [10, 20])
+
+class Test_format_latency(unittest.TestCase):
+    def call_it(self, seconds):
+        from puppyserv.stats import format_latency
+        return format_latency(seconds)
+
+    def test(self):
+        self.assertEqual(self.call_it(None), u'-')
+        self.assertEqual(self.call_it(0.016), u'16ms')
+        self.assertEqual(self.call_it(2.048), u'2.0s')
+        self.assertEqual(self.call_it(float('inf')), u'inf')
+
 class Test_format_byte_size(unittest.TestCase):
     def call_it(self, nbytes):
         from puppyserv.stats import format_byte_size
@@ -3,6 +3,8 @@
 """
 from __future__ import absolute_import, division
 
+import os
+import shutil
 import tempfile
 import time
 import unittest
@@ -11,7 +13,8 @@ from pkg_resources import resource_filename
 from six.moves import queue
 import gevent
 import gevent.event
-from mock import patch
+import gevent.queue
+from mock import call, patch, MagicMock
 
 from puppyserv.interfaces import VideoBuffer, VideoStream
 
@@ -36,6 +39,7 @@ class TestStaticFrame(unittest.TestCase):
         self.assertEqual(frame.content_type, 'image/jpeg')
         self.assertEqual(frame.image_data, 'IMAGE DATA')
         self.assertEqual(frame.filename, filename)
+        self.assertEqual(frame.source, filename)
 
     def test_unguessable_type(self):
         with self.assertRaises(ValueError):
@@ -51,11 +55,71 @@ class TestStaticFrame(unittest.TestCase):
         frame1 = self.make_one(filename)
         frame2 = self.make_one(filename)
         frame3 = self.make_one(self.make_image_file())
+        self.assertNotEqual(frame1.seq, frame2.seq)
         self.assertTrue(frame1 == frame2)
         self.assertFalse(frame1 != frame2)
         self.assertFalse(frame1 == frame3)
         self.assertTrue(frame1 != frame3)
 
+    def test_empty_file(self):
+        tmpfile = tempfile.NamedTemporaryFile(suffix='.jpg')
+        self.addCleanup(tmpfile.close)
+        frame = self.make_one(tmpfile.name)
+        self.assertEqual(frame.image_data, b'')
+
+class TestStaticFrames(unittest.TestCase):
+    def make_one(self, filenames, cache_size=2):
+        from puppyserv.stream import StaticFrames
+        return StaticFrames(filenames, cache_size)
+
+    def make_image_files(self, n):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filenames = []
+        for i in range(n):
+            filename = os.path.join(directory, 'image%d.jpg' % i)
+            with open(filename, 'wb') as fp:
+                fp.write(b'image%d' % i)
+            filenames.append(filename)
+        return filenames
+
+    def test_getitem(self):
+        frames = self.make_one(self.make_image_files(3))
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(frames[1].image_data, b'image1')
+        self.assertEqual(frames[-1].image_data, b'image2')
+        with self.assertRaises(IndexError):
+            frames[3]
+
+    def test_loads_lazily(self):
+        filenames = self.make_image_files(2)
+        frames = self.make_one(filenames)
+        with open(filenames[0], 'wb') as fp:
+            fp.write(b'changed')
+        self.assertEqual(frames[0].image_data, b'changed')
+
+    def test_caches_frames(self):
+        frames = self.make_one(self.make_image_files(3))
+        frame0 = frames[0]
+        frames[1]
+        self.assertIs(frames[0], frame0)
+        frames[2]                       # evicts frame 1
+        self.assertIs(frames[0], frame0)
+        frames[1]                       # evicts frame 2
+        frames[2]                       # evicts frame 0
+        self.assertIsNot(frames[0], frame0)
+        self.assertEqual(len(frames._cache), 2)
+
+    def test_skips_directories(self):
+        filenames = self.make_image_files(1)
+        frames = self.make_one(filenames + [os.path.dirname(filenames[0])])
+        self.assertEqual(len(frames), 1)
+
+    def test_unguessable_type(self):
+        filename, = self.make_image_files(1)
+        os.rename(filename, filename[:-4])
+        with self.assertRaises(ValueError):
+            self.make_one([filename[:-4]])
 
 class TestStaticVideoStreamBuffer(unittest.TestCase):
     def setUp(self):
@@ -86,10 +150,23 @@ class TestStaticVideoStreamBuffer(unittest.TestCase):
             }
         buf = StaticVideoStreamBuffer.from_settings(settings)
         self.assertEqual(len(buf.frames), 1)
+        self.assertEqual(buf.frames.cache_size, 16)
         self.assertEqual(buf.frames[0].content_type, 'image/jpeg')
         self.assertIs(buf.loop, True)
         self.assertAlmostEqual(buf.frame_rate, 42.0)
 
+    def test_from_settings_archive(self):
+        from puppyserv.stream import ArchiveFrames, StaticVideoStreamBuffer
+        from puppyserv.tests.test_archive import make_archive
+        archive = make_archive(self, [(10.0, b'frame1'), (10.5, b'frame2')])
+        buf = StaticVideoStreamBuffer.from_settings({
+            'static.archive': archive,
+            'static.images': 'ignored',
+            })
+        self.assertIsInstance(buf.frames, ArchiveFrames)
+        self.assertEqual(buf.frames[1].image_data, b'frame2')
+        self.assertEqual(buf.offsets, [0.0, 0.5])
+
     def test_close(self):
         buf = self.make_one(['frame1'], loop=True)
         stream = buf.stream()
@@ -97,6 +174,17 @@ class TestStaticVideoStreamBuffer(unittest.TestCase):
         with self.assertRaises(StopIteration):
             next(stream)
 
+    def test_close_closes_archive(self):
+        from puppyserv.stream import StaticVideoStreamBuffer
+        from puppyserv.tests.test_archive import make_archive
+        archive = make_archive(self, [(10.0, b'frame1')])
+        buf = StaticVideoStreamBuffer.from_settings({
+            'static.archive': archive,
+            })
+        buf.close()
+        with self.assertRaises(ValueError):
+            buf.frames.archive.map[:1]
+
     def test_loop(self):
         buf = self.make_one(['frame1', 'frame2'], loop=True)
         stream = buf.stream()
@@ -119,6 +207,113 @@ class TestStaticVideoStreamBuffer(unittest.TestCase):
         with self.assertRaises(StopIteration):
             next(stream)
 
+    def test_timed(self):
+        buf = self.make_one(['frame1', 'frame2', 'frame3'], loop=True,
+                            timestamps=[10.0, 11.0, 13.0])
+        # The loop includes the mean frame interval after the last frame
+        self.assertEqual(buf.period, 4.5)
+        stream = buf.stream()
+        self.assertEqual(next(stream), 'frame1')
+        self.assertEqual(self.t, 0)
+        self.assertEqual(next(stream), 'frame2')
+        self.assertEqual(self.t, 1.0)
+        self.assertEqual(next(stream), 'frame3')
+        self.assertEqual(self.t, 3.0)
+        self.assertEqual(next(stream), 'frame1')
+        self.assertEqual(self.t, 4.5)
+        self.assertEqual(next(stream), 'frame2')
+        self.assertEqual(self.t, 5.5)
+
+    def test_timed_skips_frames(self):
+        buf = self.make_one(['frame1', 'frame2', 'frame3'], loop=True,
+                            timestamps=[10.0, 11.0, 13.0])
+        stream = buf.stream()
+        self.assertEqual(next(stream), 'frame1')
+        self.t = 3.5
+        self.assertEqual(next(stream), 'frame3')
+        self.t = 10.0
+        self.assertEqual(next(stream), 'frame2')
+
+    def test_timed_noloop(self):
+        buf = self.make_one(['frame1', 'frame2'], loop=False,
+                            timestamps=[10.0, 10.5])
+        stream = buf.stream()
+        self.assertEqual(next(stream), 'frame1')
+        self.assertEqual(next(stream), 'frame2')
+        self.assertEqual(self.t, 0.5)
+        with self.assertRaises(StopIteration):
+            next(stream)
+
+    def test_timed_single_frame(self):
+        buf = self.make_one(['frame1'], loop=True, frame_rate=2.0,
+                            timestamps=[10.0])
+        stream = buf.stream()
+        self.assertEqual(next(stream), 'frame1')
+        self.assertEqual(next(stream), 'frame1')
+        self.assertEqual(self.t, 0.5)
+
+class TestArchiveFrames(unittest.TestCase):
+    def test(self):
+        from puppyserv.archive import FrameArchive
+        from puppyserv.stream import ArchiveFrames
+        from puppyserv.tests.test_archive import make_archive
+        archive = FrameArchive(make_archive(self, [(1.0, b'frame1'),
+                                                   (2.0, b'frame2')]))
+        self.addCleanup(archive.close)
+        frames = ArchiveFrames(archive)
+        self.assertEqual(len(frames), 2)
+        self.assertEqual(frames.timestamps, [1.0, 2.0])
+        self.assertEqual(frames[0].image_data, b'frame1')
+        self.assertIs(frames[0], frames[0])
+
+class TestFrameRing(unittest.TestCase):
+    def make_one(self, size=3):
+        from puppyserv.stream import FrameRing
+        return FrameRing(size)
+
+    def test_empty(self):
+        ring = self.make_one()
+        self.assertEqual(ring.length, 0)
+        self.assertEqual(len(ring), 0)
+
+    def test_get(self):
+        ring = self.make_one()
+        ring.append('frame0')
+        ring.append('frame1')
+        self.assertEqual(ring.length, 2)
+        self.assertEqual(len(ring), 2)
+        self.assertEqual(ring.get(0), (0, 'frame0'))
+        self.assertEqual(ring.get(1), (1, 'frame1'))
+
+    def test_get_overwritten(self):
+        ring = self.make_one()
+        for n in range(5):
+            ring.append('frame%d' % n)
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(ring.get(0), (2, 'frame2'))
+        self.assertEqual(ring.get(1), (2, 'frame2'))
+        self.assertEqual(ring.get(4), (4, 'frame4'))
+
+    def test_get_lapped_while_reading(self):
+        ring = self.make_one()
+        for n in range(3):
+            ring.append('frame%d' % n)
+        class LappingSlots(list):
+            def __getitem__(slots, i):
+                # The writer laps the reader just before it reads
+                for n in range(3, 6):
+                    ring.append('frame%d' % n)
+                del slots.__class__.__getitem__
+                return slots[i]
+        ring.slots = LappingSlots(ring.slots)
+        self.assertEqual(ring.get(0), (3, 'frame3'))
+
+    def test_get_future(self):
+        ring = self.make_one()
+        ring.append('frame0')
+        with self.assertRaises(AssertionError):
+            ring.get(1)
+
 class TestThreadedStreamBuffer(unittest.TestCase):
     def make_one(self, stream, **kwargs):
         from puppyserv.stream import ThreadedStreamBuffer
@@ -185,6 +380,46 @@ class TestThreadedStreamBuffer(unittest.TestCase):
         self.assertIs(next(stream), 'frame3')
         self.assertIs(next(stream), None) # timeout
 
+    def test_counts_dropped_frames(self):
+        source = DummyVideoStream()
+        stream_stat_manager = MagicMock()
+        stream_buffer = self.make_one(source, timeout=0.1, buffer_size=2,
+                                      stream_stat_manager=stream_stat_manager)
+        stream = stream_buffer.stream()
+        source.put('frame0')
+        self.assertIs(next(stream), 'frame0')
+        for n in range(1, 4):
+            source.put('frame%d' % n)
+        gevent.sleep(0.05)
+        self.assertEqual(next(stream), 'frame2')
+        self.assertEqual(stream_stat_manager.count.mock_calls,
+                         [call('frames_dropped', 1)])
+        self.assertEqual(stream_stat_manager.mock_calls[0],
+                         call(source, stream_buffer.stream_name,
+                              role='ingest', buffer=stream_buffer.framebuf))
+
+    def test_stamps_ingest_time(self):
+        from puppyserv.interfaces import VideoFrame
+        source = DummyVideoStream()
+        stream_buffer = self.make_one(source, timeout=0.1)
+        stream_buffer.time = lambda: 42.0
+        stream = stream_buffer.stream()
+        source.put(VideoFrame(b'frame'))
+        frame = next(stream)
+        self.assertEqual(frame.ingest_time, 42.0)
+        self.assertEqual(frame.ingest_seq, 0)
+
+    def test_records_stats(self):
+        source = DummyVideoStream()
+        stream_stat_manager = MagicMock()
+        stream_buffer = self.make_one(source, timeout=0.1,
+                                      stream_stat_manager=stream_stat_manager)
+        stream = stream_buffer.stream()
+        source.put('frame')
+        self.assertEqual(next(stream), 'frame')
+        monitored = stream_stat_manager.return_value.__enter__.return_value
+        self.assertEqual(monitored.record.mock_calls, [call('frame')])
+
     def test_wait_for_frame(self):
         source = DummyVideoStream(timeout=0.5)
         stream_buffer = self.make_one(source, timeout=0.5, buffer_size=1)
@@ -193,10 +428,138 @@ class TestThreadedStreamBuffer(unittest.TestCase):
         gevent.spawn_later(0.2, source.put, 'frame1')
         self.assertIs(next(stream), 'frame1')
 
+    def test_demand(self):
+        source = DummyVideoStream()
+        stream_buffer = self.make_one(source)
+        self.assertIs(stream_buffer.demand, None)
+        stream_buffer.demand = 4.0
+        self.assertEqual(source.demand, 4.0)
+        self.assertEqual(stream_buffer.demand, 4.0)
+
+    def test_recorder(self):
+        from mock import Mock
+        recorder = Mock()
+        source = DummyVideoStream(timeout=0.01)
+        stream_buffer = self.make_one(source, timeout=1, recorder=recorder)
+        stream = stream_buffer.stream()
+        source.put('frame1')
+        self.assertEqual(next(stream), 'frame1')
+        source.close()
+        stream_buffer.runner.join(1)
+        self.assertEqual(recorder.mock_calls, [call.record('frame1'),
+                                               call.close()])
+
+    def test_unhealthy_source(self):
+        source = DummyVideoStream()
+        stream_buffer = self.make_one(source, timeout=10, buffer_size=2)
+        stream = stream_buffer.stream()
+        source.put('frame0')
+        self.assertIs(next(stream), 'frame0')
+
+        source.healthy = False
+        t0 = time.time()
+        self.assertIs(next(stream), None)
+        self.assertLess(time.time() - t0, 0.1)
+        # Only reported once
+        gevent.spawn_later(0.05, source.put, 'frame1')
+        self.assertIs(next(stream), 'frame1')
+
+class TestGreenletStreamBuffer(unittest.TestCase):
+    def make_one(self, stream, **kwargs):
+        from puppyserv.stream import GreenletStreamBuffer
+        kwargs.setdefault('timeout', 0.1)
+        stream_buffer = GreenletStreamBuffer(stream, **kwargs)
+        self.addCleanup(stream_buffer.close)
+        return stream_buffer
+
+    def test_repr(self):
+        source = DummyGreenletVideoStream()
+        stream_buffer = self.make_one(source)
+        self.assertRegexpMatches(
+            repr(stream_buffer),
+            r'<GreenletStreamBuffer <.*DummyGreenletVideoStream.*>>')
+
+    def test_close(self):
+        source = DummyGreenletVideoStream()
+        stream_buffer = self.make_one(source)
+        self.assertTrue(stream_buffer.is_alive())
+        stream_buffer.close()
+        source.put('frame')
+        gevent.sleep(0.01)
+        self.assertFalse(stream_buffer.is_alive())
+
+    def test_stream(self):
+        source = DummyGreenletVideoStream(timeout=0.1)
+        stream_buffer = self.make_one(source, timeout=0.05, buffer_size=2)
+        stream = stream_buffer.stream()
+
+        self.assertIs(next(stream), None) # timeout
+
+        source.put('frame1')
+        source.put('frame2')
+        self.assertIs(next(stream), 'frame1')
+        self.assertIs(next(stream), 'frame2')
+
+    def test_wait_for_frame(self):
+        source = DummyGreenletVideoStream(timeout=0.5)
+        stream_buffer = self.make_one(source, timeout=0.5, buffer_size=1)
+        stream = stream_buffer.stream()
+
+        gevent.spawn_later(0.2, source.put, 'frame1')
+        self.assertIs(next(stream), 'frame1')
+
+class TestReactorStreamBuffer(unittest.TestCase):
+    def make_one(self, stream, **kwargs):
+        from puppyserv.greenlet import HubThread
+        from puppyserv.stream import ReactorStreamBuffer
+        kwargs.setdefault('timeout', 0.1)
+        if 'reactor' not in kwargs:
+            # The dummy sources block, so don't share a reactor between tests
+            kwargs['reactor'] = reactor = HubThread('TestReactor')
+            self.addCleanup(reactor.stop)
+        stream_buffer = ReactorStreamBuffer(stream, **kwargs)
+        self.addCleanup(stream_buffer.close)
+        return stream_buffer
+
+    def test_repr(self):
+        source = DummyVideoStream()
+        stream_buffer = self.make_one(source)
+        self.assertRegexpMatches(
+            repr(stream_buffer),
+            r'<ReactorStreamBuffer \[TestReactor\] <.*DummyVideoStream.*>>')
+
+    def test_shared_reactor(self):
+        buf1 = self.make_one(DummyVideoStream(timeout=0.01), reactor=None)
+        buf2 = self.make_one(DummyVideoStream(timeout=0.01), reactor=None)
+        self.assertIs(buf1.reactor, buf2.reactor)
+        self.assertEqual(buf1.reactor.thread.name, 'IngestReactor')
+
+    def test_close(self):
+        source = DummyVideoStream()
+        stream_buffer = self.make_one(source)
+        self.assertTrue(stream_buffer.is_alive())
+        stream_buffer.close()
+        source.put('frame')
+        self.assertTrue(stream_buffer.runner.wait(1))
+        self.assertFalse(stream_buffer.is_alive())
+
+    def test_stream(self):
+        source = DummyVideoStream(timeout=0.1)
+        stream_buffer = self.make_one(source, timeout=0.05, buffer_size=2)
+        stream = stream_buffer.stream()
+
+        self.assertIs(next(stream), None) # timeout
+
+        source.put('frame1')
+        source.put('frame2')
+        self.assertIs(next(stream), 'frame1')
+        self.assertIs(next(stream), 'frame2')
+
 class TestFailsafeStreamBuffer(unittest.TestCase):
-    def make_one(self, primary_buffer, backup_buffer_factory):
+    def make_one(self, primary_buffer, backup_buffer_factory, **kwargs):
         from puppyserv.stream import FailsafeStreamBuffer
-        buffer = FailsafeStreamBuffer(primary_buffer, backup_buffer_factory)
+        buffer = FailsafeStreamBuffer(primary_buffer, backup_buffer_factory,
+                                      **kwargs)
         self.addCleanup(buffer.close)
         return buffer
 
@@ -255,6 +618,19 @@ class TestFailsafeStreamBuffer(unittest.TestCase):
         primary_buffer.put('frame5')
         self.assertEqual(next(stream), 'frame5')
 
+    def test_demand(self):
+        primary_buffer = DummyBuffer()
+        backup_buffer = DummyBuffer()
+        failsafe = self.make_one(primary_buffer, backup_buffer)
+        failsafe.demand = 2.0
+        self.assertEqual(failsafe.demand, 2.0)
+        self.assertEqual(primary_buffer.demand, 2.0)
+        self.assertIs(backup_buffer.demand, None)
+        failsafe.switch_to_backup()
+        self.assertEqual(backup_buffer.demand, 2.0)
+        failsafe.demand = 3.0
+        self.assertEqual(backup_buffer.demand, 3.0)
+
     def test_primary_stream_terminates_while_on_backup(self):
         primary_buffer = DummyBuffer()
         backup_buffer_factory = DummyBuffer
@@ -272,6 +648,141 @@ class TestFailsafeStreamBuffer(unittest.TestCase):
         with self.assertRaises(StopIteration):
             next(stream)
 
+    def test_backup_kept_for_cool_down(self):
+        primary_buffer = DummyBuffer()
+        backup_buffer = DummyBuffer()
+        failsafe = self.make_one(primary_buffer, backup_buffer,
+                                 cool_down=0.05)
+        failsafe.switch_to_backup()
+        for frame in 'frame1', 'frame2', 'frame3':
+            primary_buffer.put(frame)
+        self.assertIs(failsafe.backup_buffer, None)
+        self.assertIs(failsafe.standby_buffer, backup_buffer)
+        self.assertFalse(backup_buffer.closed)
+        gevent.sleep(0.1)
+        self.assertIs(failsafe.standby_buffer, None)
+        self.assertTrue(backup_buffer.closed)
+
+    def test_flap_reuses_backup(self):
+        primary_buffer = DummyBuffer()
+        backup_buffer = DummyBuffer()
+        failsafe = self.make_one(primary_buffer, backup_buffer,
+                                 cool_down=0.05)
+        failsafe.switch_to_backup()
+        for frame in 'frame1', 'frame2', 'frame3':
+            primary_buffer.put(frame)
+        failsafe.backup_buffer_factory = None
+        failsafe.switch_to_backup()
+        self.assertIs(failsafe.backup_buffer, backup_buffer)
+        self.assertEqual(failsafe.flaps, 1)
+        gevent.sleep(0.1)
+        self.assertFalse(backup_buffer.closed)
+
+    def test_flap_hold_down(self):
+        from mock import Mock
+        stream_stat_manager = Mock()
+        primary_buffer = DummyBuffer()
+        failsafe = self.make_one(primary_buffer, DummyBuffer(),
+                                 hold_down=2, max_hold_down=5,
+                                 stream_stat_manager=stream_stat_manager)
+        self.t = 0
+        failsafe.time = lambda: self.t
+
+        def flap():
+            failsafe.switch_to_backup()
+            gevent.sleep()
+            hold_down = failsafe.current_hold_down
+            t0 = self.t
+            for n in range(3):
+                primary_buffer.put('frame')
+            while self.t - t0 < hold_down:
+                self.assertIsNot(failsafe.backup_buffer, None)
+                self.t += 1
+                primary_buffer.put('frame')
+            self.assertIs(failsafe.backup_buffer, None)
+            return hold_down
+
+        self.assertEqual(flap(), 0)
+        self.t = 10
+        self.assertEqual(flap(), 2)
+        self.t += 1
+        self.assertEqual(flap(), 4)
+        self.t += 1
+        self.assertEqual(flap(), 5)
+        self.assertEqual(failsafe.flaps, 3)
+        self.assertEqual(stream_stat_manager.count.mock_calls.count(
+            call('flaps')), 3)
+
+        # A failure after the cool-down window is not a flap
+        self.t += 30
+        self.assertEqual(flap(), 0)
+        self.assertEqual(failsafe.flaps, 0)
+
+    def test_counts_failovers(self):
+        from mock import Mock
+        stream_stat_manager = Mock()
+        failsafe = self.make_one(DummyBuffer(), DummyBuffer(),
+                                 stream_stat_manager=stream_stat_manager)
+        failsafe.switch_to_backup()
+        stream_stat_manager.count.assert_called_once_with('failovers')
+
+    def test_hot_standby(self):
+        primary_buffer = DummyBuffer()
+        backup_buffer = DummyBuffer()
+        failsafe = self.make_one(primary_buffer, backup_buffer,
+                                 standby_rate=0.2)
+        self.assertIs(failsafe.standby_buffer, backup_buffer)
+        self.assertEqual(backup_buffer.demand, 0.2)
+        failsafe.demand = 5.0
+        self.assertEqual(backup_buffer.demand, 0.2)
+
+        stream = failsafe.stream()
+        backup_buffer.put('backup1')
+        primary_buffer.put(None)
+        # No timeout frame: go straight to the standby
+        self.assertEqual(next(stream), 'backup1')
+        self.assertIs(failsafe.backup_buffer, backup_buffer)
+        self.assertIs(failsafe.standby_buffer, None)
+        self.assertEqual(backup_buffer.demand, 5.0)
+
+        for frame in 'frame1', 'frame2', 'frame3':
+            primary_buffer.put(frame)
+        self.assertIs(failsafe.backup_buffer, None)
+        self.assertIs(failsafe.standby_buffer, backup_buffer)
+        self.assertFalse(backup_buffer.closed)
+        self.assertEqual(backup_buffer.demand, 0.2)
+
+    def test_hot_standby_for_all_clients(self):
+        primary_buffer = DummyBuffer()
+        backup_buffer = DummyBuffer()
+        failsafe = self.make_one(primary_buffer, backup_buffer,
+                                 standby_rate=0.2)
+        backup_buffer.put('backup1')
+        clients = [gevent.spawn(next, failsafe.stream()) for n in range(2)]
+        gevent.sleep(0)                 # clients wait on the primary
+        primary_buffer.put(None)
+        gevent.joinall(clients, timeout=1)
+        self.assertEqual([client.value for client in clients],
+                         ['backup1', 'backup1'])
+
+    def test_closes_standby(self):
+        backup_buffer = DummyBuffer()
+        failsafe = self.make_one(DummyBuffer(), backup_buffer,
+                                 standby_rate=0.2)
+        failsafe.close()
+        self.assertTrue(backup_buffer.closed)
+        self.assertIs(failsafe.standby_buffer, None)
+
+    def test_replaces_dead_standby(self):
+        backup_buffer = DummyBuffer()
+        failsafe = self.make_one(DummyBuffer(), backup_buffer,
+                                 standby_rate=0.2)
+        backup_buffer.closed = True
+        new_backup_buffer = DummyBuffer()
+        failsafe.backup_buffer_factory = new_backup_buffer
+        failsafe.switch_to_backup()
+        self.assertIs(failsafe.backup_buffer, new_backup_buffer)
+
 
 class DummyFrame(object):
     pass
@@ -298,6 +809,11 @@ class DummyVideoStream(VideoStream):
             raise StopIteration()
         return frame
 
+class DummyGreenletVideoStream(DummyVideoStream):
+    def __init__(self, timeout=None):
+        super(DummyGreenletVideoStream, self).__init__(timeout)
+        self.frame_queue = gevent.queue.Queue()
+
 class DummyBuffer(VideoBuffer):
     def __init__(self):
         self.buf = []
@@ -305,7 +821,8 @@ class DummyBuffer(VideoBuffer):
         self.closed = False
 
     # hokism - serve as own factory
-    def __call__(self):
+    def __call__(self, demand=None):
+        self.demand = demand
         return self
 
     def close(self):
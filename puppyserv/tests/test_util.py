@@ -47,6 +47,38 @@ class Test_asbool(unittest.TestCase):
         result = self._callFUT(1)
         self.assertEqual(result, True)
 
+class Test_parse_iso8601(unittest.TestCase):
+    def call_it(self, s):
+        from puppyserv.util import parse_iso8601
+        return parse_iso8601(s)
+
+    def test_utc(self):
+        self.assertEqual(self.call_it('2014-05-13T14:20:00Z'), 1399990800.0)
+
+    def test_offset(self):
+        self.assertEqual(self.call_it('2014-05-13T07:20:00-07:00'),
+                         1399990800.0)
+        self.assertEqual(self.call_it('2014-05-13 16:20+0200'), 1399990800.0)
+
+    def test_fractional_seconds(self):
+        self.assertEqual(self.call_it('2014-05-13T14:20:00.25Z'),
+                         1399990800.25)
+
+    def test_local_time(self):
+        import time
+        expected = time.mktime((2014, 5, 13, 14, 20, 0, 0, 0, -1))
+        self.assertEqual(self.call_it('2014-05-13T14:20'), expected)
+
+    def test_date_only(self):
+        import time
+        expected = time.mktime((2014, 5, 13, 0, 0, 0, 0, 0, -1))
+        self.assertEqual(self.call_it('2014-05-13'), expected)
+
+    def test_invalid(self):
+        for s in ('', 'yesterday', '2014-13-01T00:00Z', '2014-05-13T14'):
+            with self.assertRaises(ValueError):
+                self.call_it(s)
+
 class RateLimiterTestBase(unittest.TestCase):
     def setUp(self):
         self.t = 0
@@ -183,6 +215,64 @@ class TestBackofRateLimiter(RateLimiterTestBase, RateLimiterTestMixin):
         next(limiter)
         self.assertEqual(self.t, 2)
 
+    def test_probe_delay(self):
+        limiter = self.make_one(initial_delay=2, backoff=2, max_delay=10,
+                                probe_delay=0.5)
+        next(limiter)
+        next(limiter)
+        self.assertEqual(self.t, 0.5)
+        next(limiter)
+        self.assertEqual(self.t, 2.5)
+        next(limiter)
+        self.assertEqual(self.t, 6.5)
+
+    def test_jitter(self):
+        limiter = self.make_one(initial_delay=1, backoff=2, max_delay=10,
+                                jitter=True)
+        ranges = []
+        def uniform(a, b):
+            ranges.append((a, b))
+            return b
+        limiter.uniform = uniform
+        for n in range(5):
+            next(limiter)
+        self.assertEqual(self.t, 3 + 9 + 10 + 10)
+        self.assertEqual(ranges, [(1, 3), (1, 9), (1, 27), (1, 30), (1, 30)])
+
+    def test_jittered_probe(self):
+        limiter = self.make_one(initial_delay=1, probe_delay=0.5,
+                                jitter=True)
+        limiter.uniform = lambda a, b: a
+        next(limiter)
+        next(limiter)
+        self.assertEqual(self.t, 0.25)
+
+    def test_state(self):
+        limiter = self.make_one(initial_delay=1, backoff=2, max_delay=10)
+        self.assertEqual(limiter.state, limiter.CLOSED)
+        next(limiter)
+        self.assertEqual(limiter.state, limiter.CLOSED)
+        limiter.failure()
+        self.assertEqual(limiter.state, limiter.HALF_OPEN)
+        next(limiter)
+        self.assertEqual(limiter.state, limiter.HALF_OPEN)
+        limiter.failure()
+        self.assertEqual(limiter.state, limiter.OPEN)
+        self.sleep(2)
+        self.assertEqual(limiter.state, limiter.HALF_OPEN)
+        next(limiter)
+        limiter.reset()
+        self.assertEqual(limiter.state, limiter.CLOSED)
+
+    def test_next_implies_failure(self):
+        limiter = self.make_one(initial_delay=1, backoff=2, max_delay=10)
+        next(limiter)
+        next(limiter)
+        self.assertEqual(limiter.failures, 1)
+        next(limiter)
+        self.assertEqual(limiter.failures, 2)
+        self.assertEqual(limiter.state, limiter.HALF_OPEN)
+
 
 class TestReadlineAdapter(unittest.TestCase):
     def make_one(self, fp):
@@ -220,6 +310,34 @@ class TestReadlineAdapter(unittest.TestCase):
         self.assertEqual(fp.readline(4), b'ghi\n')
         self.assertEqual(fp.readline(4), b'')
 
+    def test_readheaders(self):
+        headers = b'Content-Type: image/jpeg\r\nContent-Length: 4\r\n'
+        fp = self.make_one(BytesIO(headers + b'\r\ndata'))
+        self.assertEqual(fp.readheaders(), headers)
+        self.assertEqual(fp.read(), b'data')
+
+    def test_readheaders_bare_newlines(self):
+        fp = self.make_one(BytesIO(b'a: b\n\ndata'))
+        self.assertEqual(fp.readheaders(), b'a: b\n')
+        self.assertEqual(fp.read(), b'data')
+
+    def test_readheaders_empty(self):
+        fp = self.make_one(BytesIO(b'\r\ndata'))
+        self.assertEqual(fp.readheaders(), b'')
+        self.assertEqual(fp.read(), b'data')
+
+    def test_readheaders_long(self):
+        headers = b''.join(b'X-%d: %s\r\n' % (n, b'y' * n)
+                           for n in range(100))
+        fp = self.make_one(BytesIO(headers + b'\r\ndata'))
+        self.assertEqual(fp.readheaders(), headers)
+        self.assertEqual(fp.read(), b'data')
+
+    def test_readheaders_eof(self):
+        fp = self.make_one(BytesIO(b'a: b\r\n'))
+        with self.assertRaises(EOFError):
+            fp.readheaders()
+
     def test_read(self):
         data = b'abc\ndef\nghi\n'
         fp = self.make_one(BytesIO(data))
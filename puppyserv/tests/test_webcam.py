@@ -4,9 +4,11 @@
 from __future__ import absolute_import, division
 
 from itertools import count
+import os
 import time
 import unittest
 
+import gevent
 from six.moves.queue import Queue
 
 from webob.dec import wsgify
@@ -59,11 +61,158 @@ class Test_stream_buffer_from_settings(unittest.TestCase):
         buf = self.call_it(settings)
         self.assertIsInstance(buf.source, WebcamStillStream)
 
+    def test_greenlet_ingest(self):
+        from puppyserv.stream import GreenletStreamBuffer
+        from puppyserv.webcam import CooperativeHTTPConnection
+        settings = {
+            'webcam.ingest': 'greenlet',
+            'webcam.stream.url': 'http://example.com/',
+            }
+        buf = self.call_it(settings)
+        self.addCleanup(buf.close)
+        self.assertIsInstance(buf, GreenletStreamBuffer)
+        self.assertIsInstance(buf.source.conn, CooperativeHTTPConnection)
+
+    def test_standby_rate(self):
+        settings = {
+            'webcam.stream.url': 'http://example.com/',
+            'webcam.still.url': 'http://example.com/snap',
+            'webcam.standby_rate': '0.1',
+            }
+        buf = self.call_it(settings)
+        self.addCleanup(buf.close)
+        self.assertEqual(buf.standby_rate, 0.1)
+        self.assertEqual(buf.standby_buffer.source.rate_limiter.max_rate, 0.1)
+
+    def test_flap_damping_settings(self):
+        settings = {
+            'webcam.stream.url': 'http://example.com/',
+            'webcam.still.url': 'http://example.com/snap',
+            'webcam.hold_down': '2',
+            'webcam.max_hold_down': '60',
+            'webcam.cool_down': '10',
+            }
+        buf = self.call_it(settings)
+        self.addCleanup(buf.close)
+        self.assertEqual(buf.hold_down, 2.0)
+        self.assertEqual(buf.max_hold_down, 60.0)
+        self.assertEqual(buf.cool_down, 10.0)
+
+    def test_recorder(self):
+        import shutil, tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings = {
+            'webcam.stream.url': 'http://example.com/',
+            'webcam.still.url': 'http://example.com/snap',
+            'webcam.record.directory': directory,
+            }
+        buf = self.call_it(settings, camera='front')
+        self.addCleanup(buf.close)
+        self.assertEqual(buf.primary_buffer.recorder.directory,
+                         os.path.join(directory, 'front'))
+        still_buffer = buf.backup_buffer_factory()
+        self.addCleanup(still_buffer.close)
+        self.assertIs(still_buffer.recorder, None)
+
+    def test_https_streams_share_tls_client(self):
+        from puppyserv.webcam import HTTPSConnection
+        settings = {
+            'webcam.stream.url': 'https://example.com/',
+            'webcam.still.url': 'https://example.com/snap',
+            'webcam.verify_tls': 'false',
+            }
+        buf = self.call_it(settings)
+        self.addCleanup(buf.close)
+        conn = buf.primary_buffer.source.conn
+        self.assertIsInstance(conn, HTTPSConnection)
+        self.assertFalse(conn.tls_client.verify_tls)
+        still_buffer = buf.backup_buffer_factory()
+        self.addCleanup(still_buffer.close)
+        self.assertIs(still_buffer.source.conn.tls_client, conn.tls_client)
+
+    def test_unknown_ingest(self):
+        settings = {
+            'webcam.ingest': 'carrier pigeon',
+            'webcam.stream.url': 'http://example.com/',
+            }
+        with self.assertRaises(ValueError):
+            self.call_it(settings)
+
+    def test_camera_tags_stats(self):
+        from puppyserv.stats import StreamStatManager
+        stream_stat_manager = StreamStatManager(log_interval=0)
+        settings = {
+            'webcam.stream.url': 'http://example.com/',
+            }
+        buf = self.call_it(settings, camera='front',
+                           stream_stat_manager=stream_stat_manager)
+        self.addCleanup(buf.close)
+        gevent.sleep(0.01)
+        monitored, = stream_stat_manager.streams
+        self.assertEqual(monitored.camera, 'front')
+
     def test_unconfigured(self):
         from puppyserv.webcam import NotConfiguredError
         with self.assertRaises(NotConfiguredError):
             self.call_it({})
 
+class Test_split_camera_settings(unittest.TestCase):
+    def call_it(self, settings, **kwargs):
+        from puppyserv.webcam import split_camera_settings
+        return split_camera_settings(settings, **kwargs)
+
+    def test(self):
+        settings = {
+            'static.images': 'foo',
+            'webcam.socket_timeout': '1',
+            'webcam.stream.url': 'URL',
+            'webcam.still.url': 'STILL',
+            'webcam.front.stream.url': 'FRONT',
+            'webcam.front.socket_timeout': '2',
+            'webcam.back.still.url': 'BACK',
+            }
+        default_settings, camera_settings = self.call_it(settings)
+        self.assertEqual(default_settings, {
+            'webcam.socket_timeout': '1',
+            'webcam.stream.url': 'URL',
+            'webcam.still.url': 'STILL',
+            })
+        self.assertEqual(camera_settings, {
+            'front': {
+                'webcam.socket_timeout': '2',
+                'webcam.stream.url': 'FRONT',
+                },
+            'back': {
+                'webcam.socket_timeout': '1',
+                'webcam.still.url': 'BACK',
+                },
+            })
+
+    def test_urls_are_not_inherited(self):
+        settings = {
+            'webcam.url': 'URL',
+            'webcam.stream.url': 'STREAM',
+            'webcam.still.max_rate': '1',
+            'webcam.back.still.url': 'BACK',
+            }
+        default_settings, camera_settings = self.call_it(settings)
+        self.assertEqual(camera_settings, {
+            'back': {
+                'webcam.still.max_rate': '1',
+                'webcam.still.url': 'BACK',
+                },
+            })
+
+    def test_record_is_not_a_camera(self):
+        settings = {
+            'webcam.stream.url': 'URL',
+            'webcam.record.directory': '/tmp',
+            }
+        default_settings, camera_settings = self.call_it(settings)
+        self.assertEqual(default_settings, settings)
+        self.assertEqual(camera_settings, {})
+
 class WebcamStreamTests(object):
     def make_one(self, path=None, **kwargs):
         if path is None:
@@ -106,6 +255,25 @@ class WebcamStreamTests(object):
         stream = self.make_one('not_found')
         self.assertIs(next(stream), None)
 
+    def test_healthy(self):
+        stream = self.make_one('not_found', probe_delay=0.01)
+        self.assertTrue(stream.healthy)
+        self.assertIs(next(stream), None)
+        self.assertTrue(stream.healthy)
+        self.assertIs(next(stream), None)
+        self.assertFalse(stream.healthy)
+
+    def test_counts_connections(self):
+        from puppyserv.stats import StreamStatManager
+        stream_stat_manager = StreamStatManager(log_interval=0)
+        stream = self.make_one('not_found', probe_delay=0.01,
+                               stream_stat_manager=stream_stat_manager)
+        self.assertIs(next(stream), None)
+        self.assertEqual(stream_stat_manager.counters, {
+            ('', 'upstream_connects'): 1,
+            ('', 'upstream_failures'): 1,
+            })
+
     def test_bad_content_type(self):
         stream = self.make_one('')
         self.assertIs(next(stream), None)
@@ -157,6 +325,21 @@ class TestWebcamVideoStream(unittest.TestCase, WebcamStreamTests):
         self.send_frame()
         self.assertIs(next(stream), None)
 
+    def test_passthrough(self):
+        stream = self.make_one(passthrough=True)
+        source_frame = DummyVideoFrame()
+        self.send_frame(source_frame)
+        frame = next(stream)
+        self.assertEqual(frame, source_frame)
+        self.assertEqual(frame.part_headers,
+                         b'Content-Type: image/jpeg\r\n'
+                         b'Content-Length: 4096\r\n')
+
+    def test_no_passthrough(self):
+        stream = self.make_one()
+        self.send_frame()
+        self.assertIs(next(stream).part_headers, None)
+
     def test_non_image_in_stream(self):
         stream = self.make_one()
         self.send_frame(DummyVideoFrame(content_type='text/plain'))
@@ -169,6 +352,12 @@ class TestWebcamVideoStream(unittest.TestCase, WebcamStreamTests):
         self.send_frame(DummyVideoFrame(content_type='image/png'))
         self.assertIs(next(stream), None)
 
+class TestCooperativeWebcamVideoStream(TestWebcamVideoStream):
+    def make_one(self, path=None, **kwargs):
+        kwargs.setdefault('cooperative', True)
+        return super(TestCooperativeWebcamVideoStream, self).make_one(
+            path, **kwargs)
+
 class TestWebcamStillStream(unittest.TestCase, WebcamStreamTests):
     default_path = 'snapshot'
 
@@ -177,6 +366,222 @@ class TestWebcamStillStream(unittest.TestCase, WebcamStreamTests):
         from puppyserv.webcam import WebcamStillStream
         return WebcamStillStream
 
+class TestWebcamStreamBaseDemand(unittest.TestCase):
+    def setUp(self):
+        self.t = 0
+
+    def time(self):
+        return self.t
+
+    def make_one(self, url='http://example.com/stream', **kwargs):
+        from puppyserv.webcam import WebcamVideoStream
+        stream = WebcamVideoStream(url, **kwargs)
+        stream.time = self.time
+        self.addCleanup(stream.close)
+        return stream
+
+    def test_initial_demand(self):
+        stream = self.make_one('http://example.com/stream?rate={rate}',
+                               max_rate=10, demand=0.5)
+        self.assertEqual(stream.rate_limiter.max_rate, 0.5)
+        self.assertEqual(stream.path, '/stream?rate=1')
+
+    def test_no_demand(self):
+        stream = self.make_one(max_rate=10)
+        stream._adjust_rate()
+        self.assertEqual(stream.rate_limiter.max_rate, 10)
+
+    def test_demand_never_exceeds_max_rate(self):
+        stream = self.make_one(max_rate=10)
+        stream.demand = 20
+        stream._adjust_rate()
+        self.assertEqual(stream.rate_limiter.max_rate, 10)
+
+    def test_decrease_after_holdoff(self):
+        stream = self.make_one(max_rate=10, rate_holdoff=5)
+        stream.demand = 2
+        stream._adjust_rate()
+        self.assertEqual(stream.rate_limiter.max_rate, 10)
+        self.t = 4.9
+        stream._adjust_rate()
+        self.assertEqual(stream.rate_limiter.max_rate, 10)
+        self.t = 5
+        stream._adjust_rate()
+        self.assertEqual(stream.rate_limiter.max_rate, 2)
+
+    def test_increase_is_immediate(self):
+        stream = self.make_one(max_rate=10, rate_holdoff=0)
+        stream.demand = 2
+        stream._adjust_rate()
+        self.assertEqual(stream.rate_limiter.max_rate, 2)
+        stream.demand = 5
+        stream._adjust_rate()
+        self.assertEqual(stream.rate_limiter.max_rate, 5)
+
+    def test_hysteresis(self):
+        stream = self.make_one(max_rate=10, rate_holdoff=0)
+        stream.demand = 9
+        stream._adjust_rate()
+        self.assertEqual(stream.rate_limiter.max_rate, 10)
+
+    def test_brief_dip_in_demand_is_ignored(self):
+        stream = self.make_one(max_rate=10, rate_holdoff=5)
+        stream.demand = 2
+        stream._adjust_rate()
+        self.t = 3
+        stream.demand = 10
+        stream._adjust_rate()
+        stream.demand = 2
+        stream._adjust_rate()
+        self.t = 6
+        stream._adjust_rate()
+        self.assertEqual(stream.rate_limiter.max_rate, 10)
+
+    def test_rate_in_url(self):
+        stream = self.make_one('http://example.com/stream?rate={rate}',
+                               max_rate=10, rate_holdoff=0)
+        self.assertEqual(stream.path, '/stream?rate=10')
+        stream.stream = iter([])
+        stream.demand = 2.5
+        stream._adjust_rate()
+        self.assertEqual(stream.path, '/stream?rate=3')
+        self.assertIs(stream.stream, None)
+
+class TestUpstream(unittest.TestCase):
+    def make_one(self, url):
+        from puppyserv.webcam import HTTPConnection, Upstream
+        def connection_factory(scheme, netloc):
+            return HTTPConnection(netloc)
+        return Upstream(url, connection_factory)
+
+    def test_repr(self):
+        upstream = self.make_one('http://example.com/foo')
+        self.assertEqual(repr(upstream), '<Upstream http://example.com/foo>')
+
+    def test_probe(self):
+        upstream = self.make_one(test_server.application_url)
+        upstream.probe(1.0)
+        self.assertTrue(upstream.healthy)
+        self.assertLess(upstream.latency, 0.5)
+        latency = upstream.latency
+        upstream.probe(1.0)
+        self.assertNotEqual(upstream.latency, latency)
+
+    def test_probe_failure(self):
+        import socket
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        upstream = self.make_one('http://127.0.0.1:%d/' % port)
+        upstream.probe(1.0)
+        self.assertFalse(upstream.healthy)
+        self.assertIs(upstream.latency, None)
+
+class TestWebcamStreamBaseUpstreams(unittest.TestCase):
+    def make_one(self, url='http://a.example.com/ http://b.example.com/',
+                 **kwargs):
+        from puppyserv.webcam import WebcamVideoStream
+        kwargs.setdefault('upstream_probe_interval', 3600)
+        stream = WebcamVideoStream(url, **kwargs)
+        self.addCleanup(stream.close)
+        return stream
+
+    def set_latencies(self, stream, *latencies):
+        for upstream, latency in zip(stream.upstreams, latencies):
+            upstream.latency = latency
+            upstream.healthy = latency is not None
+
+    def test_single_url(self):
+        stream = self.make_one('http://example.com/')
+        self.assertEqual(len(stream.upstreams), 1)
+        self.assertIs(stream.conn, stream.upstream.conn)
+
+    def test_empty_url(self):
+        with self.assertRaises(ValueError):
+            self.make_one(' ')
+
+    def test_starts_with_first(self):
+        stream = self.make_one()
+        self.assertEqual(stream.url, 'http://a.example.com/')
+
+    def test_switches_to_faster(self):
+        stream = self.make_one()
+        self.set_latencies(stream, 0.1, 0.01)
+        self.assertIs(stream._best_upstream(), stream.upstreams[1])
+
+    def test_hysteresis(self):
+        stream = self.make_one()
+        self.set_latencies(stream, 0.1, 0.06)
+        self.assertIs(stream._best_upstream(), stream.upstreams[0])
+
+    def test_switches_from_unhealthy(self):
+        stream = self.make_one()
+        self.set_latencies(stream, None, 1.0)
+        self.assertIs(stream._best_upstream(), stream.upstreams[1])
+
+    def test_tries_next_if_none_healthy(self):
+        stream = self.make_one()
+        self.set_latencies(stream, None, None)
+        self.assertIs(stream._best_upstream(), stream.upstreams[1])
+
+    def test_switch_reopens_stream(self):
+        url = (test_server.application_url + 'stream?a '
+               + test_server.application_url + 'stream?b')
+        stream = self.make_one(url, socket_timeout=1)
+        global frame_queue
+        frame_queue = Queue()
+        frame_queue.put(DummyVideoFrame())
+        self.assertIsNot(next(stream), None)
+        self.assertIsNot(stream.stream, None)
+
+        self.set_latencies(stream, 0.1, 0.01)
+        stream._switch_upstream()
+        self.assertIs(stream.stream, None)
+        self.assertEqual(stream.path, '/stream?b')
+        self.assertIs(stream.conn, stream.upstreams[1].conn)
+
+    def test_failure_marks_upstream_unhealthy(self):
+        url = (test_server.application_url + 'not_found '
+               + test_server.application_url + 'stream')
+        stream = self.make_one(url, socket_timeout=1)
+        self.assertIs(next(stream), None)
+        self.assertFalse(stream.upstreams[0].healthy)
+        global frame_queue
+        frame_queue = Queue()
+        frame_queue.put(DummyVideoFrame())
+        self.assertIsNot(next(stream), None)
+        self.assertEqual(stream.path, '/stream')
+
+    def test_probes_upstreams(self):
+        url = ' '.join([test_server.application_url] * 2)
+        stream = self.make_one(url)
+        gevent.sleep(0.1)
+        for upstream in stream.upstreams:
+            self.assertIsNot(upstream.latency, None)
+
+    def test_close_stops_prober(self):
+        stream = self.make_one()
+        stream.close()
+        gevent.sleep(0)
+        self.assertTrue(stream._prober.dead)
+
+    def test_close_closes_all_upstreams(self):
+        from mock import Mock
+        stream = self.make_one()
+        for upstream in stream.upstreams:
+            upstream.conn.sock = Mock(name='sock')
+        stream.close()
+        for upstream in stream.upstreams:
+            self.assertIs(upstream.conn.sock, None)
+
+    def test_no_switch_once_closed(self):
+        stream = self.make_one()
+        stream.close()
+        self.set_latencies(stream, 0.1, 0.01)
+        stream._switch_upstream()
+        self.assertIs(stream.upstream, stream.upstreams[0])
+
 class Test_config_from_settings(unittest.TestCase):
     def call_it(self, settings, *args, **kwargs):
         from puppyserv.webcam import config_from_settings
@@ -188,12 +593,22 @@ class Test_config_from_settings(unittest.TestCase):
             'webcam.max_rate': ' 3.5 ',
             'webcam.socket_timeout': ' 2.5 ',
             'webcam.user_agent': ' joe ',
+            'webcam.ingest': ' greenlet ',
+            'webcam.rate_holdoff': ' 60 ',
+            'webcam.ca_certs': ' /etc/ca.pem ',
+            'webcam.verify_tls': 'no',
+            'webcam.passthrough': 'true',
             })
         self.assertEqual(config, {
             'url': 'URL',
             'max_rate': 3.5,
             'socket_timeout': 2.5,
             'user_agent': 'joe',
+            'ingest': 'greenlet',
+            'rate_holdoff': 60.0,
+            'ca_certs': '/etc/ca.pem',
+            'verify_tls': False,
+            'passthrough': True,
             })
 
     def test_defaults(self):
@@ -213,6 +628,74 @@ class Test_config_from_settings(unittest.TestCase):
         with self.assertRaises(NotConfiguredError):
             self.call_it({})
 
+class Test_parse_url(unittest.TestCase):
+    def call_it(self, url):
+        from puppyserv.webcam import _parse_url
+        return _parse_url(url)
+
+    def test_http(self):
+        self.assertEqual(self.call_it('http://example.com/foo?x=1'),
+                         ('http', 'example.com', '/foo?x=1'))
+
+    def test_https(self):
+        self.assertEqual(self.call_it('https://example.com:8443/foo'),
+                         ('https', 'example.com:8443', '/foo'))
+
+    def test_unsupported_scheme(self):
+        with self.assertRaises(ValueError):
+            self.call_it('ftp://example.com/')
+
+    def test_authentication_unsupported(self):
+        with self.assertRaises(ValueError):
+            self.call_it('http://user:pw@example.com/')
+
+class TestTLSClient(unittest.TestCase):
+    def make_one(self, **kwargs):
+        from puppyserv.webcam import TLSClient
+        return TLSClient(**kwargs)
+
+    def test_verifies_by_default(self):
+        import ssl
+        context = self.make_one()._get_context(False)
+        self.assertEqual(context.verify_mode, ssl.CERT_REQUIRED)
+        self.assertTrue(context.check_hostname)
+
+    def test_no_verify(self):
+        import ssl
+        context = self.make_one(verify_tls=False)._get_context(False)
+        self.assertEqual(context.verify_mode, ssl.CERT_NONE)
+        self.assertFalse(context.check_hostname)
+
+    def test_cooperative_context(self):
+        import gevent.ssl
+        tls_client = self.make_one()
+        context = tls_client._get_context(True)
+        self.assertIsInstance(context, gevent.ssl.SSLContext)
+        self.assertIs(tls_client._get_context(True), context)
+
+    def test_wrap_socket(self):
+        tls_client = self.make_one()
+        context = DummySSLContext()
+        tls_client.contexts[False] = context
+        sock = tls_client.wrap_socket('sock', 'example.com', 443)
+        self.assertEqual(sock, ('sock', {'server_hostname': 'example.com'}))
+
+class TestHTTPSConnection(unittest.TestCase):
+    def make_one(self, host='example.com'):
+        from puppyserv.webcam import HTTPSConnection
+        return HTTPSConnection(host)
+
+    def test_requires_ssl_context(self):
+        from mock import patch
+        from puppyserv.webcam import Error
+        with patch('puppyserv.webcam.HAVE_SSL_CONTEXT', False):
+            with self.assertRaises(Error):
+                self.make_one()
+
+class DummySSLContext(object):
+    def wrap_socket(self, sock, **kwargs):
+        return sock, kwargs
+
 class DummyVideoFrame(VideoFrame):
     counter = count(1)
 
@@ -3,6 +3,10 @@
 """
 from __future__ import absolute_import, division
 
+import calendar
+from datetime import datetime
+import random
+import re
 import time
 
 import gevent
@@ -24,6 +28,40 @@ def asbool(s):
     s = str(s).strip()
     return s.lower() in truthy
 
+_iso8601_re = re.compile(r"""
+    \A\s*
+    (?P<date>\d{4}-\d\d-\d\d)
+    (?:[T\s](?P<time>\d\d:\d\d(?::\d\d)?)(?P<frac>\.\d+)?)?
+    (?:(?P<utc>Z)|(?P<sign>[-+])(?P<tzh>\d\d):?(?P<tzm>\d\d))?
+    \s*\Z
+    """, re.I | re.X)
+
+def parse_iso8601(s):
+    """ Parse an ISO 8601 date/time into a timestamp (seconds since
+    the epoch.)
+
+    Times without a time zone are taken to be local times.  Raises
+    ``ValueError`` if ``s`` can not be parsed.
+
+    """
+    m = _iso8601_re.match(s)
+    if not m:
+        raise ValueError("Can not parse date/time %r" % s)
+    time_ = m.group('time') or '00:00'
+    if len(time_) == 5:
+        time_ += ':00'
+    dt = datetime.strptime(m.group('date') + ' ' + time_, '%Y-%m-%d %H:%M:%S')
+    frac = float(m.group('frac') or 0)
+    if m.group('utc'):
+        offset = 0
+    elif m.group('sign'):
+        offset = int(m.group('tzh')) * 3600 + int(m.group('tzm')) * 60
+        if m.group('sign') == '-':
+            offset = -offset
+    else:
+        return time.mktime(dt.timetuple()) + frac
+    return calendar.timegm(dt.timetuple()) - offset + frac
+
 class RateLimiterBase(object):
     time = staticmethod(time.time)
     sleep = staticmethod(gevent.sleep)
@@ -84,32 +122,97 @@ class BucketRateLimiter(RateLimiterBase):
             self._tokens = 0
 
 class BackoffRateLimiter(RateLimiterBase):
-    def __init__(self, initial_delay, backoff=2, max_delay=300):
+    """ Rate limiter for connection attempts, with exponential backoff.
+
+    This also acts as a simple circuit breaker.  Its ``state`` is
+    ``CLOSED`` while things are working; ``HALF_OPEN`` after a
+    single failure, or while a retry is in progress; and ``OPEN``
+    while waiting out the backoff delay following repeated failures.
+
+    The first retry after a failure is made after ``probe_delay``
+    (which defaults to ``initial_delay``.)  Subsequent delays grow by
+    a factor of ``backoff`` up to ``max_delay``.  If ``jitter`` is
+    set, delays are randomized (using "decorrelated jitter") so
+    that many clients which fail at once do not retry in lock-step.
+
+    Call ``next()`` before each attempt, ``reset()`` after a
+    success, and ``failure()`` after a failure.  (Calling ``next()``
+    again without an intervening ``reset()`` also implies failure.)
+
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    uniform = staticmethod(random.uniform)
+
+    def __init__(self, initial_delay, backoff=2, max_delay=300,
+                 probe_delay=None, jitter=False):
         self.initial_delay = initial_delay
         self.backoff = backoff
         self.max_delay = max_delay
+        self.probe_delay = probe_delay
+        self.jitter = jitter
         self.reset()
 
     def reset(self):
         self.wait_until = 0
         self.delay = self.initial_delay
+        self.attempts = 0
+        self.failures = 0
+        self._attempting = False
+
+    def failure(self):
+        self._attempting = False
+        self.failures += 1
+
+    @property
+    def state(self):
+        if self.failures == 0:
+            return self.CLOSED
+        elif self.failures > 1 and not self._attempting \
+                 and self.time() < self.wait_until:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def _next_delay(self):
+        """ Compute the delay between this attempt and the next.
+        """
+        if self.attempts == 1 and self.probe_delay is not None:
+            if self.jitter:
+                return self.probe_delay * self.uniform(0.5, 1.5)
+            return self.probe_delay
+        delay = self.delay
+        if self.jitter:
+            delay = self.delay = min(self.uniform(self.initial_delay,
+                                                  delay * 3),
+                                     self.max_delay)
+        else:
+            self.delay = min(delay * self.backoff, self.max_delay)
+        return delay
 
     def next(self):
+        if self._attempting:
+            self.failure()
         now = self.time()
         wait_until = self.wait_until
-        delay = self.delay
         if wait_until > now:
             self.sleep(wait_until - now)
-            self.wait_until += delay
-        else:
-            self.wait_until = now + delay
-        self.delay = min(delay * self.backoff, self.max_delay)
+            now = wait_until
+        self.attempts += 1
+        self._attempting = True
+        self.wait_until = now + self._next_delay()
+
+_END_OF_HEADERS_RE = re.compile(br'(\n|^)\r?\n')
 
 class ReadlineAdapter(object):
     """ This adapter add a .readline() method to basic file-like objects
     which need only provide a working .read() method.
 
     """
+    #: The maximum size of the header block read by `readheaders`
+    max_header_size = 65536
+
     def __init__(self, fp):
         self.fp = fp
         self.buf = b''
@@ -133,6 +236,31 @@ class ReadlineAdapter(object):
             self.buf = b''
             return buf + self.fp.read(size - len(buf))
 
+    def readheaders(self):
+        """ Read an RFC 822 style header block.
+
+        The block is read up to and including the blank line which
+        terminates it.  Returns the raw bytes of the header lines
+        (without the blank line.)
+
+        """
+        buf = self.buf
+        pos = 0
+        while True:
+            m = _END_OF_HEADERS_RE.search(buf, pos)
+            if m:
+                break
+            if len(buf) > self.max_header_size:
+                raise ValueError("Header block too long")
+            data = self.fp.read(128)
+            if not data:
+                raise EOFError("EOF while reading headers")
+            # The terminator may straddle the chunks
+            pos = max(0, len(buf) - 2)
+            buf += data
+        self.buf = buf[m.end():]
+        return buf[:m.end(1)]
+
     def readline(self, size=-1):
         if size is not None and size > 0:
             line, nl, self.buf = self.read(size).partition('\n')
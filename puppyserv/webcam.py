@@ -4,19 +4,32 @@
 from __future__ import absolute_import, division
 
 import logging
-from mimetools import Message
+import math
+import socket
+import ssl
+import time
 import urlparse
 
+import gevent.socket
+import gevent.ssl
 from six import text_type
 from six.moves.http_client import HTTPConnection
 
+from puppyserv.greenlet import get_ident
 from puppyserv.interfaces import VideoFrame, VideoStream
+from puppyserv.recorder import FrameRecorder
 from puppyserv.stats import dummy_stream_stat_manager
-from puppyserv.stream import FailsafeStreamBuffer, ThreadedStreamBuffer
+from puppyserv.stream import (
+    FailsafeStreamBuffer,
+    GreenletStreamBuffer,
+    ReactorStreamBuffer,
+    ThreadedStreamBuffer,
+    )
 from puppyserv.util import (
     BucketRateLimiter,
     BackoffRateLimiter,
     ReadlineAdapter,
+    asbool,
     )
 
 DEFAULT_USER_AGENT = 'puppyserv (<dairiki@dairiki.org>)'
@@ -33,9 +46,66 @@ class StreamingError(Error):
 class NotConfiguredError(Error, ValueError):
     pass
 
+# Ingest modes: the class of buffer to use and whether the webcam
+# streams should use cooperative (gevent) sockets.
+INGEST_MODES = {
+    'thread': (ThreadedStreamBuffer, False),
+    'greenlet': (GreenletStreamBuffer, True),
+    'reactor': (ReactorStreamBuffer, True),
+    }
+
+# Sub-prefixes of ``webcam.`` which are not camera names
+RESERVED_SUBPREFIXES = frozenset(['stream', 'still', 'record'])
+
+# Settings which identify a source, and so are not inherited by cameras
+SOURCE_KEYS = frozenset(['url'])
+
+def split_camera_settings(settings, prefix='webcam.'):
+    """ Split out the settings for named cameras.
+
+    Settings of the form ``webcam.<name>.<key>`` (where ``<name>`` is
+    not one of the reserved sub-prefixes, e.g. ``stream``, ``still``
+    or ``record``)
+    configure the camera named ``<name>``.
+
+    Returns a pair ``(default_settings, camera_settings)``.
+    ``Default_settings`` contains the ``webcam.`` settings which do
+    not belong to any named camera.  ``Camera_settings`` maps each
+    camera name to that camera's settings: the default settings
+    overridden by the camera's own, with the camera name removed from
+    the keys.  Cameras do not inherit the default sources (the
+    ``url`` settings), only those they declare themselves.
+
+    """
+    default_settings = {}
+    own_settings = {}
+    for key, value in settings.items():
+        if not key.startswith(prefix):
+            continue
+        parts = key[len(prefix):].split('.', 1)
+        if len(parts) == 2 and parts[0] not in RESERVED_SUBPREFIXES:
+            name, subkey = parts
+            own_settings.setdefault(name, {})[prefix + subkey] = value
+        else:
+            default_settings[key] = value
+
+    inherited = dict((key, value)
+                     for key, value in default_settings.items()
+                     if key.rsplit('.', 1)[-1] not in SOURCE_KEYS)
+    camera_settings = {}
+    for name, own in own_settings.items():
+        camera_settings[name] = dict(inherited)
+        camera_settings[name].update(own)
+    return default_settings, camera_settings
+
 def stream_buffer_from_settings(settings, frame_timeout=5.0,
                                 stream_stat_manager=dummy_stream_stat_manager,
+                                camera=None,
                                 **kwargs):
+    if camera is not None:
+        stream_stat_manager = stream_stat_manager.for_camera(camera)
+    # The video and still streams share TLS contexts
+    tls_clients = {}
     try:
         stream_config = config_from_settings(settings, subprefix='stream.',
                                              **kwargs)
@@ -43,57 +113,306 @@ def stream_buffer_from_settings(settings, frame_timeout=5.0,
         video_buffer = None
     else:
         frame_timeout = stream_config.pop('frame_timeout', frame_timeout)
-        video_stream = WebcamVideoStream(**stream_config)
-        video_buffer = ThreadedStreamBuffer(
+        _pop_failsafe_config(stream_config)
+        buffer_class = _ingest_buffer_class(stream_config)
+        _share_tls_client(stream_config, tls_clients)
+        video_stream = WebcamVideoStream(
+            stream_stat_manager=stream_stat_manager, **stream_config)
+        video_buffer = buffer_class(
             video_stream,
             timeout=frame_timeout,
             stream_name='< video stream',
-            stream_stat_manager=stream_stat_manager)
+            stream_stat_manager=stream_stat_manager,
+            recorder=FrameRecorder.from_settings(settings, camera=camera))
 
     try:
         still_config = config_from_settings(settings, subprefix='still.',
                                             **kwargs)
     except NotConfiguredError:
         still_buffer_factory = None
+        failsafe_config = {}
     else:
         frame_timeout = still_config.pop('frame_timeout', frame_timeout)
-        def still_buffer_factory():
-            still_stream = WebcamStillStream(**still_config)
-            return ThreadedStreamBuffer(
+        failsafe_config = _pop_failsafe_config(still_config)
+        still_buffer_class = _ingest_buffer_class(still_config)
+        _share_tls_client(still_config, tls_clients)
+        def still_buffer_factory(demand=None, recorder=None):
+            still_stream = WebcamStillStream(
+                demand=demand, stream_stat_manager=stream_stat_manager,
+                **still_config)
+            return still_buffer_class(
                 still_stream,
                 timeout=frame_timeout,
                 stream_name='< still stream',
-                stream_stat_manager=stream_stat_manager)
+                stream_stat_manager=stream_stat_manager,
+                recorder=recorder)
 
     if video_buffer and still_buffer_factory:
-        return FailsafeStreamBuffer(video_buffer, still_buffer_factory)
+        return FailsafeStreamBuffer(video_buffer, still_buffer_factory,
+                                    stream_stat_manager=stream_stat_manager,
+                                    **failsafe_config)
     elif video_buffer:
         return video_buffer
     elif still_buffer_factory:
-        return still_buffer_factory()
+        # With no video stream, record the stills
+        return still_buffer_factory(
+            recorder=FrameRecorder.from_settings(settings, camera=camera))
     raise NotConfiguredError(
         'Neither webcam streaming nor still capture was configured')
 
+def _ingest_buffer_class(config):
+    """ Pop the ``ingest`` mode from ``config``.
+
+    Returns the class of buffer to use.  Sets ``cooperative`` in
+    ``config`` as required by the mode.
+
+    """
+    ingest = config.pop('ingest', 'thread')
+    try:
+        buffer_class, cooperative = INGEST_MODES[ingest]
+    except KeyError:
+        raise ValueError("Unknown ingest mode %r" % ingest)
+    config['cooperative'] = cooperative
+    return buffer_class
+
+# Settings which configure the FailsafeStreamBuffer
+FAILSAFE_KEYS = ('standby_rate', 'hold_down', 'max_hold_down', 'cool_down')
+
+def _pop_failsafe_config(config):
+    """ Pop the `FailsafeStreamBuffer` settings from ``config``.
+    """
+    return dict((key, config.pop(key))
+                for key in FAILSAFE_KEYS if key in config)
+
+def _share_tls_client(config, tls_clients):
+    """ Replace the TLS settings in ``config`` with a shared `TLSClient`.
+
+    ``Tls_clients`` is a dict of the already created clients.
+    """
+    key = (config.pop('ca_certs', None), config.pop('verify_tls', True))
+    if key not in tls_clients:
+        tls_clients[key] = TLSClient(*key)
+    config['tls_client'] = tls_clients[key]
+
+# Whether the ssl module supports SSL contexts (python >= 2.7.9)
+HAVE_SSL_CONTEXT = hasattr(ssl, 'create_default_context')
+
+class TLSClient(object):
+    """ The TLS configuration for connections to a webcam.
+
+    The SSL contexts are shared by all connections using this client.
+    (Python 2's ``ssl`` module can not resume TLS sessions, so the
+    handshake is only avoided by keeping connections alive.)
+
+    """
+    def __init__(self, ca_certs=None, verify_tls=True):
+        self.ca_certs = ca_certs
+        self.verify_tls = verify_tls
+        self.contexts = {}
+
+    def _get_context(self, cooperative):
+        context = self.contexts.get(cooperative)
+        if context is None:
+            ssl_module = gevent.ssl if cooperative else ssl
+            context = ssl_module.create_default_context(cafile=self.ca_certs)
+            if not self.verify_tls:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            self.contexts[cooperative] = context
+        return context
+
+    def wrap_socket(self, sock, host, port, cooperative=False):
+        context = self._get_context(cooperative)
+        return context.wrap_socket(sock, server_hostname=host)
+
+class CooperativeHTTPConnection(HTTPConnection):
+    """ An HTTPConnection which uses gevent's cooperative sockets.
+
+    This can be used from a greenlet without blocking the hub.
+
+    """
+    def connect(self):
+        self.sock = gevent.socket.create_connection(
+            (self.host, self.port), self.timeout, self.source_address)
+        if self._tunnel_host:
+            self._tunnel()
+
+class HTTPSConnection(HTTPConnection):
+    """ An HTTP connection over TLS.
+
+    ``Tls_client`` is the `TLSClient` used to establish the TLS layer.
+
+    """
+    default_port = 443
+
+    cooperative = False
+    create_connection = staticmethod(socket.create_connection)
+
+    def __init__(self, host, port=None, tls_client=None, **kwargs):
+        if not HAVE_SSL_CONTEXT:
+            raise Error("https webcam URLs require python >= 2.7.9")
+        HTTPConnection.__init__(self, host, port, **kwargs)
+        if tls_client is None:
+            tls_client = TLSClient()
+        self.tls_client = tls_client
+
+    def connect(self):
+        self.sock = self.create_connection(
+            (self.host, self.port), self.timeout, self.source_address)
+        host, port = self.host, self.port
+        if self._tunnel_host:
+            self._tunnel()
+            host, port = self._tunnel_host, self._tunnel_port
+        self.sock = self.tls_client.wrap_socket(
+            self.sock, host, port or self.default_port, self.cooperative)
+
+class CooperativeHTTPSConnection(HTTPSConnection):
+    """ An HTTPSConnection which uses gevent's cooperative sockets.
+    """
+    cooperative = True
+    create_connection = staticmethod(gevent.socket.create_connection)
+
+# Connection classes, by URL scheme and cooperativeness
+CONNECTION_CLASSES = {
+    ('http', False): HTTPConnection,
+    ('http', True): CooperativeHTTPConnection,
+    ('https', False): HTTPSConnection,
+    ('https', True): CooperativeHTTPSConnection,
+    }
+
+class Upstream(object):
+    """ One of the URLs from which a webcam stream can be fetched.
+
+    ``Latency`` is a smoothed measure of the time taken to connect to
+    the upstream server.  It is ``None`` until the upstream has been
+    probed.
+
+    """
+    smoothing = 0.5
+
+    def __init__(self, url, connection_factory):
+        self.url = url
+        scheme, netloc, self.path_template = _parse_url(url)
+        self.conn = connection_factory(scheme, netloc)
+        self.healthy = True
+        self.latency = None
+
+    def __repr__(self):
+        return u"<%s %s>" % (self.__class__.__name__, self.url)
+
+    def probe(self, timeout):
+        """ Measure the time taken to connect to the upstream server.
+        """
+        t0 = time.time()
+        try:
+            sock = gevent.socket.create_connection(
+                (self.conn.host, self.conn.port), timeout)
+        except Exception as ex:
+            log.debug("Probe of %s failed: %s",
+                      self.url, text_type(ex) or repr(ex))
+            self.healthy = False
+        else:
+            sock.close()
+            latency = time.time() - t0
+            if self.latency is not None:
+                latency += self.smoothing * (self.latency - latency)
+            self.latency = latency
+            self.healthy = True
 
 class WebcamStreamBase(VideoStream):
+    """ Base class for webcam streams.
+
+    The acquisition rate follows ``demand`` (when set), but never
+    exceeds ``max_rate``.  Increases in demand take effect immediately.
+    To avoid thrashing, the rate is only decreased once demand has
+    remained significantly (by more than ``rate_hysteresis``) lower
+    for ``rate_holdoff`` seconds.  An initial ``demand`` may be given,
+    in which case acquisition starts at that rate.
+
+    If the URL contains ``{rate}``, that is replaced by the current
+    acquisition rate (rounded up to an integer.)  The connection is
+    re-opened whenever that changes.
+
+    The ``url`` may be a whitespace-separated list of alternative
+    URLs for the same camera.  In that case, each is probed for
+    connection latency every ``upstream_probe_interval`` seconds,
+    and frames are fetched from the fastest healthy one.  Only the
+    upstream connection is switched; the stream itself continues.
+    To avoid thrashing, a healthy upstream is only abandoned in favor
+    of one which is significantly (by more than
+    ``upstream_hysteresis``) faster.
+
+    If ``passthrough`` is set, video stream frames keep the exact
+    headers of the upstream part, so that they can be relayed
+    unchanged.  This is useful when the upstream is another
+    puppyserv.
+
+    """
+    time = staticmethod(time.time)
+
     request_headers = {
         'Accept': '*/*',
         }
 
+    rate_hysteresis = 0.2
+    upstream_hysteresis = 0.5
+
     def __init__(self, url,
                  max_rate=3.0,
                  rate_bucket_size=None,
                  socket_timeout=10,
-                 user_agent=DEFAULT_USER_AGENT):
-        self.url = url
-        netloc, self.path = _parse_url(url)
-        self.conn = HTTPConnection(netloc, timeout=socket_timeout)
+                 user_agent=DEFAULT_USER_AGENT,
+                 cooperative=False,
+                 rate_holdoff=30.0,
+                 probe_delay=1.0,
+                 ca_certs=None,
+                 verify_tls=True,
+                 tls_client=None,
+                 demand=None,
+                 upstream_probe_interval=30.0,
+                 passthrough=False,
+                 stream_stat_manager=dummy_stream_stat_manager):
+        if tls_client is None:
+            tls_client = TLSClient(ca_certs, verify_tls)
+
+        def connection_factory(scheme, netloc):
+            connection_class = CONNECTION_CLASSES[scheme, cooperative]
+            kwargs = {}
+            if scheme == 'https':
+                kwargs['tls_client'] = tls_client
+            return connection_class(netloc, timeout=socket_timeout, **kwargs)
+
+        self.upstreams = [Upstream(u, connection_factory) for u in url.split()]
+        if not self.upstreams:
+            raise ValueError("No url given")
+        upstream = self.upstream = self.upstreams[0]
+        self.url = upstream.url
+        self.path_template = upstream.path_template
+        self.conn = upstream.conn
+        rate = max_rate if demand is None else min(max_rate, demand)
+        self.path = self._format_path(rate)
         self.request_headers = self.request_headers.copy()
         self.request_headers['User-Agent'] = user_agent
 
         self.stream = None
+        self.max_rate = max_rate
+        self.rate_holdoff = rate_holdoff
+        self.demand = demand
+        self._lower_demand_since = None
         self.rate_limiter = BucketRateLimiter(max_rate, rate_bucket_size)
-        self.open_rate_limiter = BackoffRateLimiter(socket_timeout)
+        self.rate_limiter.max_rate = rate
+        self.open_rate_limiter = BackoffRateLimiter(
+            socket_timeout, probe_delay=probe_delay, jitter=True)
+
+        self.passthrough = passthrough
+        self.stream_stat_manager = stream_stat_manager
+        self.socket_timeout = socket_timeout
+        self.upstream_probe_interval = upstream_probe_interval
+        self._closed = False
+        self._prober = None
+        if len(self.upstreams) > 1:
+            self._prober = gevent.spawn(self._probe_upstreams)
+            self._prober_thread = get_ident()
 
     def __repr__(self):
         return u"<%s at 0x%x: %s>" % (
@@ -108,30 +427,129 @@ class WebcamStreamBase(VideoStream):
 
 
     def close(self):
-        if self.stream:
-            self.stream = None
-        if self.conn:
-            self.conn.close()
-            self.conn = None
+        self._closed = True
+        self.stream = None
+        prober = self._prober
+        if prober is not None and self._prober_thread == get_ident():
+            # (From another thread, the prober exits when it next wakes)
+            prober.kill(block=False)
+        for upstream in self.upstreams:
+            upstream.conn.close()
 
     @property
     def closed(self):
-        return not self.conn
+        return self._closed
+
+    @property
+    def healthy(self):
+        """ False if the webcam connection is known to be down.
+
+        This is the case while we are backing off after repeated
+        connection failures.
+        """
+        return self.open_rate_limiter.state != BackoffRateLimiter.OPEN
+
+    def _probe_upstreams(self):
+        while not self.closed:
+            probes = [gevent.spawn(upstream.probe, self.socket_timeout)
+                      for upstream in self.upstreams]
+            try:
+                gevent.joinall(probes)
+            finally:
+                gevent.killall(probes, block=False)
+            if self.closed:
+                break
+            gevent.sleep(self.upstream_probe_interval)
+
+    def _best_upstream(self):
+        """ Choose the upstream from which to fetch frames.
+        """
+        current = self.upstream
+        best = current if current.healthy else None
+        for upstream in self.upstreams:
+            if not upstream.healthy or upstream.latency is None:
+                continue
+            if (best is None or best.latency is None
+                or upstream.latency < (best.latency
+                                       * (1 - self.upstream_hysteresis))):
+                best = upstream
+        if best is None:
+            # None are known to be healthy, try the next one
+            upstreams = self.upstreams
+            best = upstreams[(upstreams.index(current) + 1) % len(upstreams)]
+        return best
+
+    def _switch_upstream(self):
+        if self.closed:
+            return
+        upstream = self._best_upstream()
+        if upstream is self.upstream:
+            return
+        log.info("%r: switching to %s", self, upstream.url)
+        if self.stream is not None:
+            self.stream = None
+            self.conn.close()
+        self.upstream = upstream
+        self.url = upstream.url
+        self.path_template = upstream.path_template
+        self.conn = upstream.conn
+        self.path = self._format_path(self.rate_limiter.max_rate)
+
+    def _format_path(self, rate):
+        if '{rate}' not in self.path_template:
+            return self.path_template
+        return self.path_template.format(rate=int(math.ceil(rate)))
+
+    def _adjust_rate(self):
+        """ Adjust the acquisition rate to match demand.
+        """
+        target = self.max_rate
+        if self.demand is not None:
+            target = min(target, self.demand)
+        current = self.rate_limiter.max_rate
+
+        if target < current * (1 - self.rate_hysteresis):
+            now = self.time()
+            if self._lower_demand_since is None:
+                self._lower_demand_since = now
+            if now - self._lower_demand_since < self.rate_holdoff:
+                return
+        elif target <= current:
+            self._lower_demand_since = None
+            return
+
+        self._lower_demand_since = None
+        log.info("%r: adjusting rate to %.2f/s", self, target)
+        self.rate_limiter.max_rate = target
+        path = self._format_path(target)
+        if path != self.path:
+            self.path = path
+            if self.stream is not None:
+                # Re-open the stream at the new rate
+                self.stream = None
+                self.conn.close()
 
     def next(self):
         # FIXME: check closed more often?
         if self.closed:
             raise StopIteration()
+        self._adjust_rate()
+        self._switch_upstream()
         next(self.rate_limiter)
         try:
             if self.stream is None:
                 next(self.open_rate_limiter)
+                self.stream_stat_manager.count('upstream_connects')
                 self.stream = self._open_stream()
             frame = next(self.stream)
             self.open_rate_limiter.reset()
+            self.upstream.healthy = True
             return frame
         except Exception as ex:
             self.stream = None
+            self.open_rate_limiter.failure()
+            self.upstream.healthy = False
+            self.stream_stat_manager.count('upstream_failures')
             log.warn("Streaming failed: %s", text_type(ex) or repr(ex))
             self.conn.close()
             return None
@@ -164,21 +582,26 @@ class WebcamVideoStream(WebcamStreamBase):
                     if sep != b'--' + boundary + b'--':
                         raise StreamingError(u"Bad boundary %r" % sep)
                     break
-                msg = Message(fp, seekable=0)
-                content_length = int(msg['content-length'])
+                raw_headers = fp.readheaders()
+                headers = _parse_headers(raw_headers)
+                content_length = int(headers['content-length'])
                 # XXX: impose maximum limit on content_length?
                 data = fp.read(content_length)
+                part_type = headers.get('content-type', '')
+                part_type = part_type.split(';', 1)[0].strip().lower()
                 if content_type:
-                    bad_type = msg.gettype() != content_type
+                    bad_type = part_type != content_type
                 else:
-                    bad_type = msg.getmaintype() != 'image'
-                    content_type = msg.gettype()
+                    bad_type = not part_type.startswith('image/')
+                    content_type = part_type
                 if bad_type:
                     raise StreamingError(
-                        u"Unexpected content-type\n{msg}\n{data}"
+                        u"Unexpected content-type\n{raw_headers}\n{data}"
                         .format(**locals()))
-                log.debug("Got part\n%s", msg)
-                yield VideoFrame(data, msg.gettype())
+                log.debug("Got part\n%s", raw_headers)
+                part_headers = raw_headers if self.passthrough else None
+                yield VideoFrame(data, part_type, part_headers,
+                                 source=self.url)
 
         finally:
             resp.close()
@@ -205,7 +628,7 @@ class WebcamStillStream(WebcamStreamBase):
                     u"{resp.msg}\n{data}"
                     .format(**locals()))
             log.debug("Got image\n%s", resp.msg)
-            yield VideoFrame(data, resp.msg.gettype())
+            yield VideoFrame(data, resp.msg.gettype(), source=self.url)
 
 def config_from_settings(settings, prefix='webcam.', subprefix=None,
                          **defaults):
@@ -233,19 +656,45 @@ def _get_config(settings, prefix='webcam.'):
                         ('socket_timeout', float),
                         ('frame_timeout', float),
                         ('user_agent', _strip),
+                        ('ingest', _strip),
+                        ('rate_holdoff', float),
+                        ('probe_delay', float),
+                        ('standby_rate', float),
+                        ('hold_down', float),
+                        ('max_hold_down', float),
+                        ('cool_down', float),
+                        ('upstream_probe_interval', float),
+                        ('passthrough', asbool),
+                        ('ca_certs', _strip),
+                        ('verify_tls', asbool),
                         ('connect_timeout', float)]:
         if prefix + key in settings:
             config[key] = coerce(settings[prefix + key])
 
     return config
 
+def _parse_headers(raw_headers):
+    """ Parse a raw header block into a dict.
+
+    The keys are the lower-cased header names.  (This is much cheaper
+    than using `mimetools.Message`, and suffices for multipart part
+    headers.)
+
+    """
+    headers = {}
+    for line in raw_headers.splitlines():
+        name, sep, value = line.partition(b':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
 def _parse_url(url):
     u = urlparse.urlsplit(url)
-    if u.scheme != 'http':
-        raise ValueError("Only http URLs are currently supported")
+    if u.scheme not in ('http', 'https'):
+        raise ValueError("Only http and https URLs are currently supported")
     if u.username or u.password:
         raise ValueError("HTTP authentication is not currently supported")
     path = u.path
     if u.query:
         path += '?' + u.query
-    return u.netloc, path
+    return u.scheme, u.netloc, path
@@ -74,6 +74,9 @@ setup(name='puppyserv',
           'paste.filter_factory': [
               'add_server_headers = puppyserv.paste:add_server_headers_filter',
               ],
+          'console_scripts': [
+              'puppyserv-archive = puppyserv.archive:main',
+              ],
           },
 
       extras_require={